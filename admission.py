@@ -0,0 +1,286 @@
+import asyncio
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+import metrics
+
+# ==============================================================================
+# 准入控制：全局上游限流 (令牌桶) + 按客户端公平排队 + 有界等待队列 (超出即快速拒绝)
+# ==============================================================================
+# 状态保存在所有 gunicorn worker 共享的 SQLite 中：
+#   buckets  上游每分钟请求数 (RPM) 与每分钟 token 数 (TPM) 两个令牌桶
+#   tickets  每次生成一张票据，waiting → active → (释放后删除)
+# 排队顺序按 "该客户端已占用的名额 + 在该客户端自己队列中的序号" 排序，再按入队时间，
+# 即各客户端轮流获得名额，连续点击的用户不会挤占其他人。
+
+ADMISSION_ENABLED = os.environ.get('ADMISSION', '1') != '0'
+ADMISSION_DB_PATH = os.environ.get('ADMISSION_DB', 'admission.sqlite3')
+# 上游配额：按账号实际配额调整；设为 0 表示不限制该维度
+UPSTREAM_RPM = float(os.environ.get('DEEPSEEK_RPM', '120'))
+UPSTREAM_TPM = float(os.environ.get('DEEPSEEK_TPM', '400000'))
+# 令牌桶容量 = 速率 × BURST_SECONDS，允许短时突发
+BURST_SECONDS = float(os.environ.get('ADMISSION_BURST_SECONDS', '10'))
+# 所有 worker 合计同时执行的生成数，超出的进入等待队列
+MAX_ACTIVE = int(os.environ.get('ADMISSION_MAX_ACTIVE', '16'))
+QUEUE_LIMIT = int(os.environ.get('ADMISSION_QUEUE_LIMIT', '64'))
+PER_CLIENT_LIMIT = int(os.environ.get('ADMISSION_PER_CLIENT', '3'))
+MAX_WAIT_SECONDS = float(os.environ.get('ADMISSION_MAX_WAIT', '120'))
+# 一次调用的输出 token 预估 (输入按字数估算)，用于 TPM 令牌桶
+COMPLETION_TOKENS_ESTIMATE = int(os.environ.get('ADMISSION_COMPLETION_TOKENS', '800'))
+POLL_SECONDS = 0.25
+# 票据超过该时长仍未释放 (worker 崩溃等) 视为失效，应大于 排队上限 + 任务超时
+TICKET_TTL_SECONDS = float(os.environ.get('ADMISSION_TICKET_TTL', '600'))
+
+ADMISSION_WAIT = metrics.Histogram(
+    'prompt_admission_wait_seconds', "准入等待耗时 (kind: queue 为排队等待名额，rate_limit 为等待上游令牌)", ('kind',))
+ADMISSION_REJECTIONS = metrics.Counter(
+    'prompt_admission_rejections_total', "被准入控制拒绝的请求 (reason: queue_full / client_limit / timeout)", ('reason',))
+
+
+class AdmissionRejected(Exception):
+    """等待名额或上游令牌超时。"""
+
+
+def estimate_tokens(payload: Dict[str, Any]) -> int:
+    """按消息字数粗略估算一次调用消耗的 token (中文约 1 字 1 token)。"""
+    prompt_chars = sum(len(m.get('content') or '') for m in payload.get('messages') or [])
+    return prompt_chars + COMPLETION_TOKENS_ESTIMATE
+
+
+class AdmissionController:
+    """SQLite 实现的跨进程准入控制，每个 (线程, PID) 使用独立连接。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS tickets ("
+                " id TEXT PRIMARY KEY, client TEXT NOT NULL, status TEXT NOT NULL,"
+                " enqueued REAL NOT NULL, admitted REAL)"
+            )
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    # --------------------------------------------------------------------------
+    # 令牌桶
+    # --------------------------------------------------------------------------
+
+    @staticmethod
+    def _bucket(conn: sqlite3.Connection, name: str, per_minute: float, now: float) -> Tuple[float, float, float]:
+        """返回 (当前水位, 容量, 每秒补充速率)。"""
+        rate = per_minute / 60.0
+        capacity = max(1.0, rate * BURST_SECONDS)
+        row = conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+        level = capacity if row is None else min(capacity, row[0] + (now - row[1]) * rate)
+        return level, capacity, rate
+
+    def try_acquire(self, tokens: int) -> float:
+        """尝试从 RPM 与 TPM 两个桶中同时扣除；成功返回 0，否则返回建议等待的秒数 (不扣除)。"""
+        now = time.time()
+        wanted = [(name, per_minute, amount) for name, per_minute, amount in
+                  (('rpm', UPSTREAM_RPM, 1.0), ('tpm', UPSTREAM_TPM, float(tokens))) if per_minute > 0]
+        with self._transaction() as conn:
+            levels = []
+            wait = 0.0
+            for name, per_minute, amount in wanted:
+                level, capacity, rate = self._bucket(conn, name, per_minute, now)
+                # 单次请求超过桶容量时按满桶计，否则永远无法获得令牌
+                amount = min(amount, capacity)
+                levels.append((name, level - amount))
+                if level < amount:
+                    wait = max(wait, (amount - level) / rate)
+            if wait > 0:
+                return wait
+            conn.executemany("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                             [(name, level, now) for name, level in levels])
+        return 0.0
+
+    def acquire_upstream(self, tokens: int) -> None:
+        """阻塞直到获得一次上游调用的令牌；超过 MAX_WAIT_SECONDS 抛出 AdmissionRejected。"""
+        if not ADMISSION_ENABLED:
+            return
+        started = time.time()
+        while True:
+            wait = self.try_acquire(tokens)
+            if wait == 0:
+                break
+            if time.time() - started + wait > MAX_WAIT_SECONDS:
+                ADMISSION_REJECTIONS.inc(reason='timeout')
+                raise AdmissionRejected(f"上游配额已用尽，预计需等待 {wait:.0f}s")
+            time.sleep(min(wait, 1.0))
+        ADMISSION_WAIT.observe(time.time() - started, kind='rate_limit')
+
+    async def acquire_upstream_async(self, tokens: int) -> None:
+        """acquire_upstream 的异步版本 (SQLite 事务在线程池中执行，不阻塞事件循环)。"""
+        if not ADMISSION_ENABLED:
+            return
+        started = time.time()
+        while True:
+            wait = await asyncio.to_thread(self.try_acquire, tokens)
+            if wait == 0:
+                break
+            if time.time() - started + wait > MAX_WAIT_SECONDS:
+                ADMISSION_REJECTIONS.inc(reason='timeout')
+                raise AdmissionRejected(f"上游配额已用尽，预计需等待 {wait:.0f}s")
+            await asyncio.sleep(min(wait, 1.0))
+        ADMISSION_WAIT.observe(time.time() - started, kind='rate_limit')
+
+    # --------------------------------------------------------------------------
+    # 公平排队
+    # --------------------------------------------------------------------------
+
+    @staticmethod
+    def _fair_order(conn: sqlite3.Connection) -> Tuple[List[str], int]:
+        """返回 (按公平顺序排列的等待票据 ID, 当前 active 数)。"""
+        active: Dict[str, int] = {}
+        for client, count in conn.execute(
+                "SELECT client, COUNT(*) FROM tickets WHERE status = 'active' GROUP BY client"):
+            active[client] = count
+        seen: Dict[str, int] = {}
+        ranked = []
+        for ticket_id, client, enqueued in conn.execute(
+                "SELECT id, client, enqueued FROM tickets WHERE status = 'waiting' ORDER BY enqueued"):
+            rank = active.get(client, 0) + seen.get(client, 0)
+            seen[client] = seen.get(client, 0) + 1
+            ranked.append((rank, enqueued, ticket_id))
+        ranked.sort()
+        return [ticket_id for _, _, ticket_id in ranked], sum(active.values())
+
+    def enqueue(self, ticket_id: str, client: str) -> Optional[str]:
+        """登记一张等待票据；队列已满或该客户端排队过多时立即拒绝，返回拒绝原因。"""
+        if not ADMISSION_ENABLED:
+            return None
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM tickets WHERE enqueued < ?", (now - TICKET_TTL_SECONDS,))
+            waiting = conn.execute("SELECT COUNT(*) FROM tickets WHERE status = 'waiting'").fetchone()[0]
+            if waiting >= QUEUE_LIMIT:
+                ADMISSION_REJECTIONS.inc(reason='queue_full')
+                return f"排队人数已满 ({waiting} 人)，请稍后再试。"
+            mine = conn.execute("SELECT COUNT(*) FROM tickets WHERE client = ?", (client,)).fetchone()[0]
+            if mine >= PER_CLIENT_LIMIT:
+                ADMISSION_REJECTIONS.inc(reason='client_limit')
+                return f"您已有 {mine} 个请求在处理中，请等待完成后再提交。"
+            conn.execute("INSERT OR REPLACE INTO tickets (id, client, status, enqueued) VALUES (?, ?, 'waiting', ?)",
+                         (ticket_id, client, now))
+        return None
+
+    def try_admit(self, ticket_id: str) -> Tuple[bool, int]:
+        """轮到该票据且有空闲名额时将其转为 active，返回 (是否获准, 排队位置)；票据不存在时位置为 0。"""
+        with self._transaction() as conn:
+            row = conn.execute("SELECT status FROM tickets WHERE id = ?", (ticket_id,)).fetchone()
+            if row is None:
+                return False, 0
+            if row[0] == 'active':
+                return True, 0
+            order, active = self._fair_order(conn)
+            position = order.index(ticket_id) + 1
+            if position <= MAX_ACTIVE - active:
+                conn.execute("UPDATE tickets SET status = 'active', admitted = ? WHERE id = ?", (time.time(), ticket_id))
+                return True, 0
+            return False, position
+
+    def position(self, ticket_id: Optional[str]) -> int:
+        """票据在等待队列中的位置 (从 1 开始)；已获准或不存在时为 0。"""
+        if not ADMISSION_ENABLED or not ticket_id:
+            return 0
+        conn = self._conn()
+        order, _ = self._fair_order(conn)
+        return order.index(ticket_id) + 1 if ticket_id in order else 0
+
+    def release(self, ticket_id: Optional[str]) -> None:
+        if ADMISSION_ENABLED and ticket_id:
+            self._conn().execute("DELETE FROM tickets WHERE id = ?", (ticket_id,))
+
+    def wait_for_turn(self, ticket_id: str, client: str, on_position: Optional[Callable[[int], None]] = None,
+                      check: Optional[Callable[[], None]] = None) -> None:
+        """阻塞直到票据获准执行；位置变化时回调 on_position，每轮调用 check (可抛出取消异常)。"""
+        if not ADMISSION_ENABLED:
+            return
+        started = time.time()
+        last_position = None
+        while True:
+            admitted, position = self.try_admit(ticket_id)
+            if admitted:
+                break
+            if position == 0:
+                # 票据已失效 (例如被清理)，重新登记到队尾
+                self.enqueue(ticket_id, client)
+            if time.time() - started > MAX_WAIT_SECONDS:
+                ADMISSION_REJECTIONS.inc(reason='timeout')
+                raise AdmissionRejected(f"排队超时 (>{MAX_WAIT_SECONDS:.0f}s)，请稍后重试。")
+            if check is not None:
+                check()
+            if on_position is not None and position != last_position:
+                on_position(position)
+            last_position = position
+            time.sleep(POLL_SECONDS)
+        ADMISSION_WAIT.observe(time.time() - started, kind='queue')
+
+    async def wait_for_turn_async(self, ticket_id: str, client: str, on_position: Optional[Callable[[int], None]] = None,
+                                  check: Optional[Callable[[], None]] = None) -> None:
+        """wait_for_turn 的异步版本；check 与 on_position 在事件循环线程上调用，不能阻塞。"""
+        if not ADMISSION_ENABLED:
+            return
+        started = time.time()
+        last_position = None
+        while True:
+            admitted, position = await asyncio.to_thread(self.try_admit, ticket_id)
+            if admitted:
+                break
+            if position == 0:
+                await asyncio.to_thread(self.enqueue, ticket_id, client)
+            if time.time() - started > MAX_WAIT_SECONDS:
+                ADMISSION_REJECTIONS.inc(reason='timeout')
+                raise AdmissionRejected(f"排队超时 (>{MAX_WAIT_SECONDS:.0f}s)，请稍后重试。")
+            if check is not None:
+                check()
+            if on_position is not None and position != last_position:
+                on_position(position)
+            last_position = position
+            await asyncio.sleep(POLL_SECONDS)
+        ADMISSION_WAIT.observe(time.time() - started, kind='queue')
+
+    def snapshot(self) -> Dict[str, Any]:
+        conn = self._conn()
+        now = time.time()
+        counts = {status: count for status, count in
+                  conn.execute("SELECT status, COUNT(*) FROM tickets GROUP BY status")}
+        clients = conn.execute("SELECT COUNT(DISTINCT client) FROM tickets").fetchone()[0]
+        buckets = {}
+        for name, per_minute in (('rpm', UPSTREAM_RPM), ('tpm', UPSTREAM_TPM)):
+            if per_minute > 0:
+                level, capacity, _ = self._bucket(conn, name, per_minute, now)
+                buckets[name] = {'per_minute': per_minute, 'available': round(level, 1), 'capacity': round(capacity, 1)}
+        return {
+            'enabled': ADMISSION_ENABLED, 'max_active': MAX_ACTIVE, 'queue_limit': QUEUE_LIMIT,
+            'per_client_limit': PER_CLIENT_LIMIT, 'active': counts.get('active', 0),
+            'waiting': counts.get('waiting', 0), 'clients': clients, 'buckets': buckets,
+        }
+
+
+controller = AdmissionController(ADMISSION_DB_PATH)
@@ -1,12 +1,33 @@
 import dash
 from dash import dcc, html, callback
-from dash.dependencies import Input, Output, State
+from dash.dependencies import Input, Output, State, ALL
 import dash_bootstrap_components as dbc
+import flask
+from werkzeug.middleware.proxy_fix import ProxyFix
+import asyncio
+import contextvars
 import json
-import requests
-import re
 import os
-from typing import List, Dict, Any, Tuple, Optional
+import re
+import secrets
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import List, Dict, Any, Tuple, Optional, Callable, Generator, FrozenSet
+
+import admission
+import batch
+import cache
+import history
+import jobs
+import llm_client
+import metrics
+import similarity
+import structured_output
+import styles
+import tag_index
+import usage
 
 # ==============================================================================
 # 0. 配置信息 & API Key
@@ -14,8 +35,10 @@ from typing import List, Dict, Any, Tuple, Optional
 APP_THEME = dbc.themes.PULSE 
 PORT_NUMBER = 9989
 
-DEEPSEEK_API_BASE = "https://api.deepseek.com/v1/chat/completions"
+# 压测或本地调试时可指向 mock_deepseek.py 启动的替身服务
+DEEPSEEK_API_BASE = os.environ.get('DEEPSEEK_API_BASE', "https://api.deepseek.com/v1/chat/completions")
 DEEPSEEK_MODEL_NAME = "deepseek-chat"
+DEEPSEEK_TEMPERATURE = 0.7
 # ⚠️ 请在这里替换为您的 DeepSeek 密钥，或者使用 os.environ.get()
 # 在生产环境中，强烈建议使用 os.environ.get('DEEPSEEK_API_KEY', 'YOUR_FALLBACK_KEY')
 DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY') 
@@ -23,6 +46,37 @@ if not DEEPSEEK_API_KEY:
     # 如果环境变量未设置，则尝试从本地文件或返回错误
     print("警告：DEEPSEEK_API_KEY 环境变量未设置！")
 
+# 流式输出：创意生成阶段逐 token 推送到前端；设置为 0 则该阶段一次性返回
+STREAMING_ENABLED = os.environ.get('DEEPSEEK_STREAMING', '1') != '0'
+# 后台任务：回调立即返回 job_id，由前端轮询进度；设置为 0 则回退到在回调中同步执行
+BACKGROUND_JOBS_ENABLED = os.environ.get('BACKGROUND_JOBS', '1') != '0'
+JOB_POLL_INTERVAL_MS = 250
+# 异步模式：后台任务以协程在每个 worker 进程的事件循环中执行 (需要 httpx)，等待上游时不占用线程，
+# 单个进程即可同时挂起数百个生成。并发上限见 ASYNC_JOB_CONCURRENCY / ASYNC_JOB_QUEUE_LIMIT / LLM_ASYNC_POOL_SIZE
+ASYNC_MODE_ENABLED = os.environ.get('ASYNC_MODE', '0') == '1'
+if ASYNC_MODE_ENABLED and llm_client.httpx is None:
+    print("警告：ASYNC_MODE=1 需要安装 httpx，已回退到线程池任务模式。")
+    ASYNC_MODE_ENABLED = False
+
+# 部署在反向代理之后时设置为代理的层数 (例如 nginx 一层为 1)，客户端地址取自代理追加的 X-Forwarded-For；
+# 默认 0 表示直接对外服务，X-Forwarded-For 可被客户端伪造，一律忽略
+TRUSTED_PROXY_HOPS = int(os.environ.get('TRUSTED_PROXY_HOPS', '0'))
+
+# 生成历史 (history.py)：默认每个浏览器只能浏览自己的记录；单人部署可设为 1 让所有访客共享
+HISTORY_SHARED = os.environ.get('HISTORY_SHARED', '0') == '1'
+# 历史记录的归属标识由服务端随机签发并保存在 Cookie 中 (不使用可被伪造或多人共用的 IP)
+HISTORY_COOKIE = 'prompt_history_owner'
+HISTORY_COOKIE_MAX_AGE = 365 * 86400
+# 历史面板的时间范围选项 (秒)
+HISTORY_RANGES = {'1h': ("最近 1 小时", 3600), '24h': ("最近 24 小时", 86400), '7d': ("最近 7 天", 7 * 86400),
+                  '30d': ("最近 30 天", 30 * 86400)}
+
+# 生成模式："two_pass" 为 创意生成 → 格式化 两次调用；"fused" 为一次结构化调用同时返回原始描述与格式化结果
+PIPELINE_MODE_TWO_PASS = "two_pass"
+PIPELINE_MODE_FUSED = "fused"
+PIPELINE_MODES = (PIPELINE_MODE_TWO_PASS, PIPELINE_MODE_FUSED)
+DEFAULT_PIPELINE_MODE = os.environ.get('PIPELINE_MODE', PIPELINE_MODE_TWO_PASS)
+
 DEEPSEEK_HEADERS = {
     'Authorization': f'Bearer {DEEPSEEK_API_KEY}',
     'Content-Type': 'application/json'
@@ -32,134 +86,183 @@ DEEPSEEK_HEADERS = {
 # 1. 通用 LLM 调用函数
 # ==============================================================================
 
-def llm_api_call(system_prompt: str, user_prompt: str, is_json_output: bool = True) -> Tuple[Optional[Any], Optional[str]]:
-    """通用 LLM 调用函数，可用于文本生成或 JSON 格式化"""
-    
+def _chat_payload(system_prompt: str, user_prompt: str, is_json_output: bool, stream: bool,
+                  temperature: float = DEEPSEEK_TEMPERATURE) -> Dict[str, Any]:
     messages = [
         {"role": "system", "content": system_prompt},
         {"role": "user", "content": user_prompt}
     ]
 
-    payload = {"model": DEEPSEEK_MODEL_NAME, "messages": messages, "stream": False, "temperature": 0.7}
-    
+    payload = {"model": DEEPSEEK_MODEL_NAME, "messages": messages, "stream": stream, "temperature": temperature}
+    if is_json_output:
+        # 要求上游以 JSON 对象模式输出 (提示词中必须出现 "JSON" 字样)
+        payload["response_format"] = {"type": "json_object"}
+    if stream:
+        # include_usage：最后一个事件携带整次调用的 usage (choices 为空)
+        payload["stream_options"] = {"include_usage": True}
+    return payload
+
+def llm_api_call(system_prompt: str, user_prompt: str, is_json_output: bool = True, stage: str = "other",
+                 temperature: float = DEEPSEEK_TEMPERATURE) -> Tuple[Optional[Any], Optional[str]]:
+    """通用 LLM 调用函数，可用于文本生成或 JSON 格式化 (JSON 模式下启用 response_format 并容错解析)
+
+    stage 用于 token 用量、延迟指标和追踪日志的分类 (creative / formatting / fused / reask)。
+    """
+    started = time.perf_counter()
+    with metrics.INFLIGHT.track_inprogress(stage=stage), metrics.span('llm_call', stage=stage, stream=False) as trace:
+        # 通过共享连接池发送请求 (含 429/5xx 重试和熔断)，失败时直接返回错误信息
+        response, error = llm_client.post_json(DEEPSEEK_API_BASE, DEEPSEEK_HEADERS,
+                                               _chat_payload(system_prompt, user_prompt, is_json_output, stream=False,
+                                                             temperature=temperature))
+        result, error = (None, error) if error else _completion_result(response, is_json_output, stage, started)
+        trace['error'] = error[:200] if error else None
+    metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage=stage, style=usage.current_style())
+    return result, error
+
+def _completion_result(response: Any, is_json_output: bool, stage: str, started: float) -> Tuple[Optional[Any], Optional[str]]:
+    """解析非流式响应 (requests 与 httpx 的响应对象接口相同)"""
+    model_reply_str = ""
     try:
-        response = requests.post(DEEPSEEK_API_BASE, headers=DEEPSEEK_HEADERS, json=payload, timeout=90)
-        
-        if response.status_code != 200:
-            return None, f"API Error: Status {response.status_code}, {response.text}"
-            
         data = response.json()
         model_reply_str = data.get('choices', [{}])[0].get('message', {}).get('content', '').strip()
-        
-        if not model_reply_str:
-            return None, "API returned no content."
-
-        if not is_json_output:
-            # 返回纯文本 (用于创意生成阶段)
-            return model_reply_str, None
-        
-        # 尝试解析 JSON (用于格式化阶段)
-        temp_str = model_reply_str
-        temp_str = re.sub(r'```json\s*|```', '', temp_str).strip()
-        
-        # 如果模型返回了纯文本而不是 JSON，或者 JSON 格式不正确，则会引发异常
-        structured_data = json.loads(temp_str)
-        return structured_data, None
-        
     except Exception as e:
+        return None, f"API 响应解析错误: {e}"
+    usage.record(stage, data.get('usage'), time.perf_counter() - started)
+
+    if not model_reply_str:
+        return None, "API returned no content."
+
+    if not is_json_output:
+        # 返回纯文本 (用于创意生成阶段)
+        return model_reply_str, None
+
+    # 解析 JSON (用于格式化阶段)：容忍代码块、前后说明文字、尾随逗号和被截断的对象
+    parse_started = time.perf_counter()
+    structured_data, parse_error = structured_output.extract_json_object(model_reply_str)
+    metrics.STAGE_DURATION.observe(time.perf_counter() - parse_started, stage='json_parse', style=usage.current_style())
+    if parse_error:
         # 在错误信息中显示截断后的原始返回内容，便于调试
-        return None, f"API 异常或 JSON 解析错误: {e}. 原始返回: {model_reply_str[:100]}..."
+        return None, f"JSON 解析错误: {parse_error}. 原始返回: {model_reply_str[:100]}..."
+    return structured_data, None
+
+def llm_stream_call(system_prompt: str, user_prompt: str, on_delta: Callable[[str], None], stage: str = "other",
+                    temperature: float = DEEPSEEK_TEMPERATURE) -> Tuple[Optional[str], Optional[str]]:
+    """流式纯文本生成：每收到新的 token 就以累计文本调用 on_delta，结束后返回完整文本"""
+    started = time.perf_counter()
+    with metrics.INFLIGHT.track_inprogress(stage=stage), metrics.span('llm_call', stage=stage, stream=True) as trace:
+        result, error = _llm_stream_call(system_prompt, user_prompt, on_delta, stage, trace, temperature)
+        trace['error'] = error[:200] if error else None
+    metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage=stage, style=usage.current_style())
+    return result, error
+
+def _llm_stream_call(system_prompt: str, user_prompt: str, on_delta: Callable[[str], None], stage: str,
+                     trace: Dict[str, Any], temperature: float) -> Tuple[Optional[str], Optional[str]]:
+    started = time.perf_counter()
+    response, error = llm_client.post_json(DEEPSEEK_API_BASE, DEEPSEEK_HEADERS,
+                                           _chat_payload(system_prompt, user_prompt, False, stream=True, temperature=temperature),
+                                           stream=True)
+    if error:
+        return None, error
+
+    parts: List[str] = []
+    stream_usage = None
+    try:
+        for event in llm_client.iter_sse_events(response):
+            stream_usage = _stream_event(event, parts, on_delta, trace, started) or stream_usage
+    except jobs.JobCancelled:
+        # on_delta 写进度时发现任务已被取消：向上传递，由任务执行器标记为已取消，而不是当作流中断
+        raise
+    except Exception as e:
+        return _stream_error(e, parts)
+    finally:
+        usage.record(stage, stream_usage, time.perf_counter() - started)
+    return _stream_result(parts)
+
+def _stream_event(event: Dict[str, Any], parts: List[str], on_delta: Callable[[str], None],
+                  trace: Dict[str, Any], started: float) -> Optional[Dict[str, Any]]:
+    """处理一个 SSE 事件：追加增量文本并回调 on_delta，返回事件中携带的 usage (如有)"""
+    delta = (event.get('choices') or [{}])[0].get('delta', {}).get('content')
+    if delta:
+        if not parts:
+            trace['first_token_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        parts.append(delta)
+        on_delta(''.join(parts))
+    return event.get('usage')
+
+def _stream_error(e: Exception, parts: List[str]) -> Tuple[None, str]:
+    if llm_client.is_timeout(e):
+        metrics.UPSTREAM_TIMEOUTS.inc()
+    return None, f"API 流式传输中断: {e}. 已接收: {''.join(parts)[:100]}..."
+
+def _stream_result(parts: List[str]) -> Tuple[Optional[str], Optional[str]]:
+    model_reply_str = ''.join(parts).strip()
+    if not model_reply_str:
+        return None, "API returned no content."
+    return model_reply_str, None
 
 # ==============================================================================
 # 2. 第一次调用：AI 创意生成
 # ==============================================================================
 
+CREATIVE_BASE_PROMPT = (
+    "你是一位专业的图像生成提示词灵感大师。你的任务是根据用户提供的**核心主题**和下方**风格要求**，"
+    "生成一个**高质量、细节丰富、富有想象力的中文自然语言提示词**。"
+    "**硬性要求：** 1. 人物主题必须严格围绕用户输入展开。2. **绝不能包含任何男性元素。** "
+    "3. **必须只返回最终的中文提示词，不包含任何解释或额外的文字。**\n\n"
+    "**🎯 描述焦点优先级：** 你的描述必须严格遵循以下层次结构："
+    "**第一优先级 (主体)：** 极度详细地描述**主要人物、人物间的构图、姿势、动作和服装配饰**，确保主体形象的完整性。"
+    # 🎯 关键更新：加强环境描写细节
+    "**第二优先级 (环境)：** 在主体描述完成后，请**必须转而对环境/背景、光线/色彩和整体氛围进行同样高水平的细节描写**。环境不应是敷衍的模糊背景，而是**精心构造的、细节丰富的场景**。"
+    "**注意：** 尽管背景必须细节丰富，但其功能始终是**烘托主体**，不得在视觉上削弱主要人物。"
+)
+
+# 风格说明、按钮与负面提示词档位都来自风格注册表 (styles.json，见 styles.py)，加载时预先拼接好全部系统提示词。
+# 共享的 CREATIVE_BASE_PROMPT 始终位于最前面，保证不同风格、不同请求之间的消息前缀逐字节一致，
+# 以最大化上游的上下文缓存 (prefix cache) 命中。融合模式的输出格式说明见 3.1。
+style_registry = styles.StyleRegistry(styles.STYLES_PATH, {
+    'creative': lambda text: CREATIVE_BASE_PROMPT + text,
+    'fused': lambda text: CREATIVE_BASE_PROMPT + FUSED_OUTPUT_INSTRUCTIONS + text,
+})
+
 def get_creative_system_prompt(style: str) -> str:
-    """根据风格生成定制化的创意系统提示词，以整合用户输入。"""
-    
-    base_prompt = (
-        "你是一位专业的图像生成提示词灵感大师。你的任务是根据用户提供的**核心主题**和下方**风格要求**，"
-        "生成一个**高质量、细节丰富、富有想象力的中文自然语言提示词**。"
-        "**硬性要求：** 1. 人物主题必须严格围绕用户输入展开。2. **绝不能包含任何男性元素。** "
-        "3. **必须只返回最终的中文提示词，不包含任何解释或额外的文字。**\n\n"
-        "**🎯 描述焦点优先级：** 你的描述必须严格遵循以下层次结构："
-        "**第一优先级 (主体)：** 极度详细地描述**主要人物、人物间的构图、姿势、动作和服装配饰**，确保主体形象的完整性。"
-        # 🎯 关键更新：加强环境描写细节
-        "**第二优先级 (环境)：** 在主体描述完成后，请**必须转而对环境/背景、光线/色彩和整体氛围进行同样高水平的细节描写**。环境不应是敷衍的模糊背景，而是**精心构造的、细节丰富的场景**。"
-        "**注意：** 尽管背景必须细节丰富，但其功能始终是**烘托主体**，不得在视觉上削弱主要人物。"
-    )
-    
-    # --- 30 种风格的具体要求 (省略大量重复内容，保证逻辑完整性) ---
-    if style == "NORMAL":
-        instructions = ("**【风格要求：1. 正常 SFW】** 描述必须是**日常、休闲、公共场所**的场景。姿势必须是**简单、静态、非诱惑性**的。服装必须**完全遮盖**。")
-    elif style == "ARTISTIC":
-        instructions = ("**【风格要求：2. 艺术 SFW】** 描述必须充满**戏剧性、叙事感和情绪深度**。姿势必须是**复杂、动态或具有强烈情感**的。")
-    elif style == "GRAND_SFW":
-        instructions = ("**【风格要求：3. 宏大 SFW (Grand Scale)】** 描述必须设定在**史诗级、超大规模**的 SFW 场景中。构图必须服从于**场景的震撼力**。")
-    elif style == "R16_BREASTS_ONLY":
-        instructions = ("**【风格要求：4. R16 擦边 (露胸/禁止露阴)】** 描述必须具有**诱惑性**。**硬性要求：** 必须明确包含**乳房/乳头（Breasts/Nipples）的暴露或特写**。**绝对禁止描述阴部。**")
-    elif style == "R16_GENITALS_ONLY":
-        instructions = ("**【风格要求：5. R16 擦边 (露阴/禁止露胸/极致反差)】** 上半身必须穿着**完全遮盖**的庄重/日常服装。**硬性要求：** 必须明确包含**阴部/生殖器（Genitals）的暴露或特写**。**绝对禁止描述乳房/乳头。**")
-    elif style == "GRAND_NSFW_POSITIVE":
-        instructions = ("**【风格要求：6. NSFW 宏大正面 (Majestic Positive Nude)】** 描述必须设定在**宏大、史诗、正面、神圣**的场景中。**硬性要求：** 必须包含**全身裸露（Full Nudity）**，强调**宏大构图和史诗感**。")
-    elif style == "GRAND_NSFW_EXPLICIT":
-        instructions = ("**【风格要求：7. NSFW 宏大 R-18 (Grand R-18 Explicit)】** 描述必须设定在**宏大、史诗、戏剧化**的场景中。**硬性要求：** 必须包含**乳头**和**阴户/生殖器**的清晰、露骨的描述。")
-    elif style == "NSFW_EXPLICIT":
-        instructions = ("**【风格要求：8. NSFW R-18 露骨 (Explicit)】** 描述必须是**明确的性主题或露骨的裸露场景**。**硬性要求：** 请在你的描述中**使用 R18 级别的中文关键词**。")
-    elif style == "CRIME_CAPTURE":
-        instructions = ("**【风格要求：9. R-18 犯罪 (被捕罪徒)】** **主题：** 强调被捕获、被约束。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**束缚和无助**。")
-    elif style == "CRIME_THIEF_ACTION":
-        instructions = ("**【风格要求：10. R-18 犯罪 (夜色盗贼)】** **主题：** 强调在潜入、攀爬中的危险瞬间。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**高风险、动态**的姿势。")
-    elif style == "CRIME_RITUAL":
-        instructions = ("**【风格要求：11. R-18 犯罪 (邪教仪式)】** **主题：** 强调秘密、非法、邪恶的宗教/邪教仪式。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**恐怖、神秘、仪式感**。")
-    elif style == "CRIME_HUMILIATION":
-        instructions = ("**【风格要求：12. R-18 犯罪 (极致羞辱/侵犯类型主题)】** **主题：** 强调**屈服、绝对弱势、公开暴露或被迫顺从**的场景。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**约束和绝对的暴露/弱势感**。")
-    elif style == "ART_NUDE_NSFW":
-        instructions = ("**【风格要求：13. 人体艺术 NSFW (Nude Art)】** 描述必须专注于**人体形态、雕塑感和光影美学**。**硬性要求：** 必须包含**全身裸露**，明确描述**乳头和阴户**，但**绝对排除性行为动作**。")
-    elif style == "GRAVURE_R17":
-        instructions = ("**【风格要求：14. 写真 R-17 (Suggestive Gravure)】** 描述必须是**高清晰度、商业级**的诱惑写真风格。**硬性要求：** 必须包含强烈暗示，但**绝对禁止描述乳头和阴户**。")
-    elif style == "GRAVURE_NSFW":
-        instructions = ("**【风格要求：15. 写真 NSFW (Explicit Gravure)】** 描述必须是**露骨、商业级**的成人写真风格。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**高清晰度、湿润感和皮肤光泽**。")
-    elif style == "COSPLAY_SFW":
-        instructions = ("**【风格要求：16. Cosplay SFW】** 描述必须**忠实还原**一个虚构角色的服装、道具和妆容。**服装必须完全遮盖**。")
-    elif style == "COSPLAY_R16":
-        instructions = ("**【风格要求：17. Cosplay 擦边 (Suggestive Cos)】** 描述必须**忠实还原**虚构角色的服装，但通过**服装的修改、破损或湿透**来增加诱惑力。**硬性要求：** 必须包含强烈擦边暗示，但**绝对禁止描述乳头和阴户**。")
-    elif style == "COSPLAY_NSFW":
-        instructions = ("**【风格要求：18. Cosplay NSFW (Explicit Cos)】** 描述必须**忠实还原**虚构角色的身份，但在**场景或姿势中展现露骨的 R-18 内容**。**硬性要求：** 必须包含**乳头和阴户**的明确描写。")
-    elif style == "UNIFORM_VIOLATION":
-        instructions = ("**【风格要求：19. R-18 制服失控 (Uniform Violation)】** **主题：** 强调制服被**撕裂、弄脏、或解开**。**硬性要求：** 必须包含**乳头和阴户**的明确描写。")
-    elif style == "WET_OILY_FOCUS":
-        instructions = ("**【风格要求：20. R-18 湿身/油光特写 (Wet & Oily Focus)】** **主题：** 纯粹聚焦于**水、油、汗液**在皮肤表面流淌的效果。**硬性要求：** 必须包含**乳头和阴户**的明确描写。")
-    elif style == "MYTH_EXPLICIT":
-        instructions = ("**【风格要求：21. R-18 神话/古典 (Mythology Explicit)】** **主题：** 设定在**古典、神话**背景下，人物必须是**神祇、圣徒**。**硬性要求：** 必须包含**乳头和阴户**的明确描写。")
-    elif style == "VOYEUR_UNAWARE":
-        instructions = ("**【风格要求：22. R-18 偷窥视角 (Voyeuristic View)】** **主题：** 强调从**隐蔽、狭窄**的角度捕捉到的**被观察者毫不知情**的私人瞬间。**硬性要求：** 必须包含**乳头和阴户**的明确描写。")
-    elif style == "MISTY_WATER_NUDE":
-        instructions = ("**【风格要求：23. R-18 雾气弥漫/水景裸体 (Misty/Water Nude)】** **主题：** 专注于**柔和、扩散光和雾气/水汽**对裸体身体的柔化效果。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**柔焦和水珠**。")
-    elif style == "GOTHIC_ROMANTIC_NUDE":
-        instructions = ("**【风格要求：24. R-18 哥特式浪漫裸体 (Gothic Romantic Nude)】** **主题：** 强调**黑暗、忧郁、古典和维多利亚时期**的美学。**硬性要求：** 必须包含**乳头和阴户**的明确描写，聚焦于**深色调和强烈的明暗对比**。")
-    elif style == "MINIMALIST_FORM_NUDE":
-        instructions = ("**【风格要求：25. R-18 极简主义形态 (Minimalist Form Nude)】** **主题：** 将人体视为**抽象雕塑**，强调**纯粹的线条、几何形状和光影构成**。**硬性要求：** 必须包含**乳头和阴户**的明确描写，强调**锐利的边缘、强烈的明暗对比**。")
-    elif style == "NUDE_SOCIETY_NORMAL":
-        instructions = ("**【风格要求：26. R-18 裸体社会 (Nude Society Normalcy)】** **主题：** 描绘一个**没有衣物**的社会中的**日常公共场景**。**硬性要求：** 必须包含**乳头和阴户**的明确描写，但强调**写实、日常、社会性**的氛围。")
-    elif style == "FASHION_NORMAL":
-        instructions = ("**【风格要求：27. 时尚 正常 (Commercial Fashion)】** **主题：** 专注于**高品质的商业/日常服装**展示。**硬性要求：** SFW，服装**完全遮盖**，将焦点置于服装本身。")
-    elif style == "FASHION_SFW":
-        instructions = ("**【风格要求：28. 时尚 艺术/高定 (Avant-Garde Fashion)】** **主题：** 专注于**前卫、概念性、高定艺术服装**的展示。**硬性要求：** SFW，服装**完全遮盖**，艺术性为核心。")
-    elif style == "FASHION_R16":
-        instructions = ("**【风格要求：29. 时尚 擦边 (Suggestive Fashion)】** **主题：** 专注于**内衣、泳装或极度透视**的高级时装展示。**硬性要求：** 擦边 R16，**绝对禁止描述乳头和阴户**，但暗示性极强。")
-    elif style == "FASHION_NSFW":
-        instructions = ("**【风格要求：30. 时尚 NSFW (Explicit Fashion)】** **主题：** 专注于**高度概念性、露骨的时尚大片**。**硬性要求：** 必须包含**乳头和阴户**的明确描写，将**时尚的艺术表现力与 R-18 元素**结合。")
-    else:
-        instructions = "未知风格，请使用正常 SFW 风格。"
-        
-    return base_prompt + instructions
+    """根据风格返回预先生成的创意系统提示词，以整合用户输入 (未知风格使用注册表中的默认说明)。"""
+    return style_registry.get(style).prompts['creative']
+
+def negative_profile(style: Optional[str]) -> str:
+    """本地格式化 (tag_index) 使用的负面提示词档位"""
+    return style_registry.get(style).negative_profile
+
+# 多变体生成时第 N 个变体 (从 0 开始) 的采样温度与追加在用户提示词后的差异化要求；第 0 个与普通生成完全相同 (共用缓存)
+VARIANT_TEMPERATURE_STEP = 0.25
+VARIANT_HINT = "（这是第 {number} 个备选方案：请在构图、视角、服装、姿态或场景上与常见方案明显不同。）"
+
+def variant_temperature(variant: int) -> float:
+    return round(min(2.0, DEEPSEEK_TEMPERATURE + VARIANT_TEMPERATURE_STEP * variant), 2)
 
-def ai_generate_raw_prompt(style: str, user_theme: str) -> Tuple[Optional[str], Optional[str]]:
-    """调用 LLM 生成高细节的中文原始提示词"""
+def _creative_request(style: str, user_theme: str, variant: int = 0) -> Tuple[str, str, float, str]:
+    """创意生成阶段的 (系统提示词, 用户提示词, 温度, 缓存键)"""
     system_prompt = get_creative_system_prompt(style)
     user_prompt = f"用户核心主题：【{user_theme}】。请根据此主题和系统要求，立即开始生成提示词。"
-    raw_prompt, error = llm_api_call(system_prompt, user_prompt, is_json_output=False)
+    if variant:
+        user_prompt += VARIANT_HINT.format(number=variant + 1)
+    temperature = variant_temperature(variant)
+    key = cache.make_key('creative', DEEPSEEK_MODEL_NAME, temperature, cache.text_digest(system_prompt), user_prompt)
+    return system_prompt, user_prompt, temperature, key
+
+def ai_generate_raw_prompt(style: str, user_theme: str, on_delta: Optional[Callable[[str], None]] = None,
+                           variant: int = 0) -> Tuple[Optional[str], Optional[str]]:
+    """调用 LLM 生成高细节的中文原始提示词；传入 on_delta 时以流式方式逐步返回，variant 见 _creative_request"""
+    system_prompt, user_prompt, temperature, key = _creative_request(style, user_theme, variant)
+
+    def compute():
+        if on_delta is not None:
+            return llm_stream_call(system_prompt, user_prompt, on_delta, stage="creative", temperature=temperature)
+        return llm_api_call(system_prompt, user_prompt, is_json_output=False, stage="creative", temperature=temperature)
+
+    raw_prompt, error = cache.cached_call(cache.creative_cache, key, compute)
+    if raw_prompt and on_delta is not None:
+        # 缓存命中时没有流式过程，一次性推送完整文本 (重复推送对前端无副作用)
+        on_delta(raw_prompt)
     return raw_prompt, error
 
 # ==============================================================================
@@ -176,9 +279,717 @@ SYSTEM_PROMPT_FORMATTING = (
     "final_chinese_natural 的值必须是你对原始中文提示词的**准确扩写和润色**后的中文版本。"
 )
 
-def deepseek_format_prompt(raw_chinese_prompt: str) -> Tuple[Optional[Dict], Optional[str]]:
-    """调用 LLM 进行最终的 JSON 格式化"""
-    return llm_api_call(SYSTEM_PROMPT_FORMATTING, raw_chinese_prompt, is_json_output=True)
+FORMAT_KEYS = ('final_tag', 'final_natural', 'final_negative', 'final_chinese_natural', 'final_chinese_negative')
+
+def _reask_prompt(raw_chinese_prompt: str, missing: List[str]) -> str:
+    # 复用格式化系统提示词作为前缀，只在用户消息末尾追加补充要求
+    return (
+        f"{raw_chinese_prompt}\n\n【补充请求】上一次回复缺少以下键或其值无效：{', '.join(missing)}。"
+        "请只返回包含这些键的纯 JSON 对象，不要重复其他键。"
+    )
+
+def reask_missing_keys(raw_chinese_prompt: str, data: Dict[str, Any], missing: List[str],
+                       system_prompt: str = SYSTEM_PROMPT_FORMATTING) -> Tuple[Optional[Dict], Optional[str]]:
+    """只针对缺失或无效的键追问一次并合并结果，代替重新执行完整流水线"""
+    structured_output.count('reasked')
+    patch, error = llm_api_call(system_prompt, _reask_prompt(raw_chinese_prompt, missing), is_json_output=True, stage="reask")
+    return _merge_reask(data, patch, error, missing)
+
+def _merge_reask(data: Dict[str, Any], patch: Optional[Dict[str, Any]], error: Optional[str],
+                 missing: List[str]) -> Tuple[Optional[Dict], Optional[str]]:
+    merged = dict(data)
+    if not error:
+        merged.update({key: patch[key] for key in missing if key in patch})
+    still_missing = structured_output.missing_keys(merged, missing)
+    if error or still_missing:
+        structured_output.count('reask_failed')
+        return None, error or f"格式化结果缺少键: {', '.join(still_missing)}"
+    structured_output.count('reask_recovered')
+    return merged, None
+
+def _format_call(system_prompt: str, user_prompt: str, keys: Tuple[str, ...]) -> Tuple[Optional[Dict], Optional[str]]:
+    data, error = llm_api_call(system_prompt, user_prompt, is_json_output=True, stage="formatting")
+    if error:
+        return None, error
+    missing = structured_output.missing_keys(data, keys)
+    if missing:
+        return reask_missing_keys(user_prompt, data, missing, system_prompt)
+    return data, None
+
+def deepseek_format_prompt(raw_chinese_prompt: str, style: Optional[str] = None) -> Tuple[Optional[Dict], Optional[str]]:
+    """调用 LLM 进行最终的 JSON 格式化 (以请求内容为键缓存)，缺失的键会被单独追问补齐。
+
+    本地标签索引覆盖率足够高时标签由本地给出，只请求两段自然语言描述；覆盖率中等时再请求补充标签 (见 _format_route)。
+    style 决定负面提示词模板，结果中的 format_path 记录实际执行的路径。
+    """
+    started = time.perf_counter()
+    path, analysis = _format_route(raw_chinese_prompt)
+    if path == tag_index.FORMAT_PATH_LOCAL and tag_index.TAG_INDEX_OFFLINE:
+        data, error = tag_index.offline_natural(raw_chinese_prompt, analysis), None
+    else:
+        system_prompt, user_prompt, keys, key = _format_request(raw_chinese_prompt, path, analysis)
+        data, error = cache.cached_call(cache.format_cache, key, lambda: _format_call(system_prompt, user_prompt, keys))
+    return _format_result(path, analysis, style, started, data, error)
+
+def _format_cache_key(raw_chinese_prompt: str) -> str:
+    return cache.make_key('format', DEEPSEEK_MODEL_NAME, DEEPSEEK_TEMPERATURE, cache.text_digest(SYSTEM_PROMPT_FORMATTING), raw_chinese_prompt)
+
+# ------------------------------------------------------------------------------
+# 本地标签索引：按覆盖率选择 纯本地 / 带提示的精简调用 / 完整调用
+# ------------------------------------------------------------------------------
+
+# 本地路径：标签和负面提示词全部由本地给出，模型只写两段自然语言描述
+SYSTEM_PROMPT_FORMATTING_NATURAL = (
+    "你是一位专业的 NovelAI/Stable Diffusion 提示词优化大师。用户会提供**中文原始提示词**，"
+    "以及本地词典已经从中匹配出的 Danbooru 标签 (标签与负面提示词由系统生成，**不需要输出**)。"
+    "final_natural 为完整原始提示词的流畅英文自然语言描述；final_chinese_natural 为对原始中文提示词的**准确扩写和润色**。"
+    "你必须以一个**纯 JSON 格式**的字符串作为最终回复，**绝不添加任何额外的文字或解释**。"
+    "JSON 结构必须包含以下两个键：'final_natural' 和 'final_chinese_natural'。"
+)
+NATURAL_FORMAT_KEYS = ('final_natural', 'final_chinese_natural')
+
+# 精简调用：已匹配的标签和负面提示词由本地给出，模型只补充未覆盖部分的标签并写两段自然语言描述
+SYSTEM_PROMPT_FORMATTING_HINTED = (
+    "你是一位专业的 NovelAI/Stable Diffusion 提示词优化大师。用户会提供**中文原始提示词**，"
+    "以及本地词典已经匹配出的 Danbooru 标签和尚未覆盖的描述片段。"
+    "1. **补充标签 (final_extra_tags)：** 只为【未覆盖的描述】补充 Danbooru 标签 (英文逗号分隔)，"
+    "**不要重复已匹配的标签，不要输出质量标签**；没有需要补充的标签时输出空字符串。"
+    "2. final_natural 为完整原始提示词的流畅英文自然语言描述；final_chinese_natural 为对原始中文提示词的**准确扩写和润色**。"
+    "负面提示词由系统模板生成，**不需要输出**。"
+    "你必须以一个**纯 JSON 格式**的字符串作为最终回复，**绝不添加任何额外的文字或解释**。"
+    "JSON 结构必须包含以下三个键：'final_extra_tags', 'final_natural', 和 'final_chinese_natural'。"
+)
+# final_extra_tags 为空表示没有需要补充的标签，不能当作缺失的键去追问，因此只校验两段描述
+HINTED_FORMAT_KEYS = NATURAL_FORMAT_KEYS
+
+def _format_route(raw_chinese_prompt: str) -> Tuple[str, Optional[tag_index.TagAnalysis]]:
+    if not tag_index.TAG_INDEX_ENABLED:
+        return tag_index.FORMAT_PATH_FULL, None
+    analysis = tag_index.analyze(raw_chinese_prompt)
+    return tag_index.choose_path(analysis), analysis
+
+def _format_request(raw_chinese_prompt: str, path: str,
+                    analysis: Optional[tag_index.TagAnalysis]) -> Tuple[str, str, Tuple[str, ...], str]:
+    """格式化调用的 (系统提示词, 用户提示词, 必需键, 缓存键)"""
+    if path == tag_index.FORMAT_PATH_FULL:
+        return SYSTEM_PROMPT_FORMATTING, raw_chinese_prompt, FORMAT_KEYS, _format_cache_key(raw_chinese_prompt)
+    if path == tag_index.FORMAT_PATH_LOCAL:
+        name, system_prompt, keys = 'format_natural', SYSTEM_PROMPT_FORMATTING_NATURAL, NATURAL_FORMAT_KEYS
+    else:
+        name, system_prompt, keys = 'format_hinted', SYSTEM_PROMPT_FORMATTING_HINTED, HINTED_FORMAT_KEYS
+    user_prompt = raw_chinese_prompt + tag_index.hint_text(analysis)
+    key = cache.make_key(name, DEEPSEEK_MODEL_NAME, DEEPSEEK_TEMPERATURE, cache.text_digest(system_prompt), user_prompt)
+    return system_prompt, user_prompt, keys, key
+
+def _format_result(path: str, analysis: Optional[tag_index.TagAnalysis], style: Optional[str], started: float,
+                   data: Optional[Dict[str, Any]], error: Optional[str]) -> Tuple[Optional[Dict], Optional[str]]:
+    tag_index.record(path, analysis, time.perf_counter() - started)
+    if error:
+        return None, error
+    if path != tag_index.FORMAT_PATH_FULL:
+        data = tag_index.merge_local(data, analysis, negative_profile(style))
+    return dict(data, format_path=path), None
+
+# ==============================================================================
+# 3.1 单次融合调用：创意生成与格式化合并为一次结构化输出
+# ==============================================================================
+
+FUSED_OUTPUT_INSTRUCTIONS = (
+    "\n\n**【输出格式 (覆盖上文“只返回中文提示词”的要求)】** 你需要在一次回复中同时完成创意生成和专业格式化。"
+    "先按本提示词中的全部要求 (包括末尾的风格要求) 在内部构思出中文提示词，然后以一个**纯 JSON 格式**的字符串作为最终回复，**绝不添加任何额外的文字或解释**。"
+    "JSON 结构必须包含以下六个键：'raw_chinese_prompt', 'final_tag', 'final_natural', 'final_negative', 'final_chinese_natural', 和 'final_chinese_negative'。"
+    "raw_chinese_prompt 的值是按上述风格要求生成的**完整中文提示词**。"
+    "final_tag 必须是 Danbooru 标签，包含质量标签（如 `masterpiece, best quality, ultra detailed`）和背景标签，**必须添加所有细节标签**。"
+    "final_natural 是流畅的英文自然语言描述。"
+    "final_negative 必须是完整、专业的英文负面提示词列表，**必须包含 no males/boys 等排除男性元素的标签**。"
+    "final_chinese_natural 是对 raw_chinese_prompt 的**准确扩写和润色**，final_chinese_negative 是负面提示词的中文版本。\n\n"
+)
+
+FUSED_KEYS = ('raw_chinese_prompt',) + FORMAT_KEYS
+
+def _fused_request(style: str, user_theme: str) -> Tuple[str, str, str]:
+    """融合调用的 (系统提示词, 用户提示词, 缓存键)"""
+    # 融合模式的输出格式说明与风格无关，放在风格说明之前，使 共享前缀 + 格式说明 在所有风格间保持一致
+    system_prompt = style_registry.get(style).prompts['fused']
+    user_prompt = f"用户核心主题：【{user_theme}】。请根据此主题和系统要求，立即开始生成提示词。"
+    key = cache.make_key('fused', DEEPSEEK_MODEL_NAME, DEEPSEEK_TEMPERATURE, cache.text_digest(system_prompt), user_prompt)
+    return system_prompt, user_prompt, key
+
+def ai_generate_fused(style: str, user_theme: str) -> Tuple[Optional[Dict], Optional[str]]:
+    """一次调用同时返回原始中文描述和五个格式化字段；校验失败时返回错误，由调用方回退到两阶段模式"""
+    system_prompt, user_prompt, key = _fused_request(style, user_theme)
+
+    def compute():
+        data, error = llm_api_call(system_prompt, user_prompt, is_json_output=True, stage="fused")
+        if error:
+            return None, error
+        missing = structured_output.missing_keys(data, FUSED_KEYS)
+        if 'raw_chinese_prompt' in missing:
+            return None, "融合输出缺少 raw_chinese_prompt"
+        if missing:
+            # 原始描述已经有了，只需补齐缺失的格式化字段
+            return reask_missing_keys(data['raw_chinese_prompt'], data, missing)
+        return data, None
+
+    return cache.cached_call(cache.creative_cache, key, compute)
+
+# ==============================================================================
+# 3.2 异步模式：各阶段的协程版本 (提示词、缓存键与校验逻辑与同步版本共用)
+# ==============================================================================
+
+async def llm_api_call_async(system_prompt: str, user_prompt: str, is_json_output: bool = True, stage: str = "other",
+                             temperature: float = DEEPSEEK_TEMPERATURE) -> Tuple[Optional[Any], Optional[str]]:
+    started = time.perf_counter()
+    with metrics.INFLIGHT.track_inprogress(stage=stage), metrics.span('llm_call', stage=stage, stream=False, runner='async') as trace:
+        response, error = await llm_client.post_json_async(DEEPSEEK_API_BASE, DEEPSEEK_HEADERS,
+                                                           _chat_payload(system_prompt, user_prompt, is_json_output, stream=False,
+                                                                         temperature=temperature))
+        result, error = (None, error) if error else _completion_result(response, is_json_output, stage, started)
+        trace['error'] = error[:200] if error else None
+    metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage=stage, style=usage.current_style())
+    return result, error
+
+async def llm_stream_call_async(system_prompt: str, user_prompt: str, on_delta: Callable[[str], None], stage: str = "other",
+                                temperature: float = DEEPSEEK_TEMPERATURE) -> Tuple[Optional[str], Optional[str]]:
+    started = time.perf_counter()
+    with metrics.INFLIGHT.track_inprogress(stage=stage), metrics.span('llm_call', stage=stage, stream=True, runner='async') as trace:
+        response, error = await llm_client.post_json_async(DEEPSEEK_API_BASE, DEEPSEEK_HEADERS,
+                                                           _chat_payload(system_prompt, user_prompt, False, stream=True,
+                                                                         temperature=temperature), stream=True)
+        if error:
+            result = None
+        else:
+            parts: List[str] = []
+            stream_usage = None
+            events = llm_client.aiter_sse_events(response)
+            try:
+                async for event in events:
+                    stream_usage = _stream_event(event, parts, on_delta, trace, started) or stream_usage
+                result, error = _stream_result(parts)
+            except jobs.JobCancelled:
+                raise
+            except Exception as e:
+                result, error = _stream_error(e, parts)
+            finally:
+                # 循环体内抛出异常时异步生成器不会自动结束，显式关闭以释放连接
+                await events.aclose()
+                usage.record(stage, stream_usage, time.perf_counter() - started)
+        trace['error'] = error[:200] if error else None
+    metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage=stage, style=usage.current_style())
+    return result, error
+
+async def ai_generate_raw_prompt_async(style: str, user_theme: str, on_delta: Optional[Callable[[str], None]] = None,
+                                       variant: int = 0) -> Tuple[Optional[str], Optional[str]]:
+    system_prompt, user_prompt, temperature, key = _creative_request(style, user_theme, variant)
+
+    async def compute():
+        if on_delta is not None:
+            return await llm_stream_call_async(system_prompt, user_prompt, on_delta, stage="creative", temperature=temperature)
+        return await llm_api_call_async(system_prompt, user_prompt, is_json_output=False, stage="creative",
+                                        temperature=temperature)
+
+    raw_prompt, error = await cache.cached_call_async(cache.creative_cache, key, compute)
+    if raw_prompt and on_delta is not None:
+        on_delta(raw_prompt)
+    return raw_prompt, error
+
+async def reask_missing_keys_async(raw_chinese_prompt: str, data: Dict[str, Any], missing: List[str],
+                                   system_prompt: str = SYSTEM_PROMPT_FORMATTING) -> Tuple[Optional[Dict], Optional[str]]:
+    structured_output.count('reasked')
+    patch, error = await llm_api_call_async(system_prompt, _reask_prompt(raw_chinese_prompt, missing),
+                                            is_json_output=True, stage="reask")
+    return _merge_reask(data, patch, error, missing)
+
+async def _format_call_async(system_prompt: str, user_prompt: str, keys: Tuple[str, ...]) -> Tuple[Optional[Dict], Optional[str]]:
+    data, error = await llm_api_call_async(system_prompt, user_prompt, is_json_output=True, stage="formatting")
+    if error:
+        return None, error
+    missing = structured_output.missing_keys(data, keys)
+    if missing:
+        return await reask_missing_keys_async(user_prompt, data, missing, system_prompt)
+    return data, None
+
+async def deepseek_format_prompt_async(raw_chinese_prompt: str, style: Optional[str] = None) -> Tuple[Optional[Dict], Optional[str]]:
+    started = time.perf_counter()
+    path, analysis = _format_route(raw_chinese_prompt)
+    if path == tag_index.FORMAT_PATH_LOCAL and tag_index.TAG_INDEX_OFFLINE:
+        data, error = tag_index.offline_natural(raw_chinese_prompt, analysis), None
+    else:
+        system_prompt, user_prompt, keys, key = _format_request(raw_chinese_prompt, path, analysis)
+        data, error = await cache.cached_call_async(cache.format_cache, key,
+                                                    lambda: _format_call_async(system_prompt, user_prompt, keys))
+    return _format_result(path, analysis, style, started, data, error)
+
+async def ai_generate_fused_async(style: str, user_theme: str) -> Tuple[Optional[Dict], Optional[str]]:
+    system_prompt, user_prompt, key = _fused_request(style, user_theme)
+
+    async def compute():
+        data, error = await llm_api_call_async(system_prompt, user_prompt, is_json_output=True, stage="fused")
+        if error:
+            return None, error
+        missing = structured_output.missing_keys(data, FUSED_KEYS)
+        if 'raw_chinese_prompt' in missing:
+            return None, "融合输出缺少 raw_chinese_prompt"
+        if missing:
+            return await reask_missing_keys_async(data['raw_chinese_prompt'], data, missing)
+        return data, None
+
+    return await cache.cached_call_async(cache.creative_cache, key, compute)
+
+# ==============================================================================
+# 3.5 生成流水线 & 后台任务
+# ==============================================================================
+
+# 各生成模式的端到端耗时 (本进程最近 PIPELINE_STATS_WINDOW 次)，用于并排比较两阶段与融合模式
+PIPELINE_STATS_WINDOW = 1000
+_pipeline_stats_lock = threading.Lock()
+_pipeline_stats: Dict[str, Dict[str, Any]] = {}
+
+def _record_pipeline_run(mode: str, seconds: float, result: Dict[str, Any]) -> None:
+    with _pipeline_stats_lock:
+        stats = _pipeline_stats.setdefault(mode, {
+            'runs': 0, 'failures': 0, 'fallbacks': 0, 'latencies': deque(maxlen=PIPELINE_STATS_WINDOW)})
+        stats['runs'] += 1
+        stats['failures'] += 1 if result['error'] else 0
+        stats['fallbacks'] += 1 if result.get('fallback') else 0
+        stats['latencies'].append(seconds)
+
+def pipeline_stats() -> Dict[str, Dict[str, Any]]:
+    """按生成模式汇总的运行次数、失败/回退次数与延迟分位数"""
+    snapshot = {}
+    with _pipeline_stats_lock:
+        for mode, stats in _pipeline_stats.items():
+            ordered = sorted(stats['latencies'])
+            pick = lambda p: round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+            snapshot[mode] = {
+                'runs': stats['runs'], 'failures': stats['failures'], 'fallbacks': stats['fallbacks'],
+                'latency_mean': round(sum(ordered) / len(ordered), 3),
+                'latency_p50': pick(0.50), 'latency_p95': pick(0.95),
+            }
+    return snapshot
+
+
+def run_generation_pipeline(style: str, user_theme: str,
+                            on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+                            stream: bool = False, mode: str = DEFAULT_PIPELINE_MODE) -> Dict[str, Any]:
+    """执行生成流水线，返回页面 6 个输出框的内容及各阶段耗时。
+
+    mode 为 "two_pass" 时依次执行【创意生成 → 专业格式化】；为 "fused" 时先尝试单次融合调用，
+    输出校验失败则自动回退到两阶段流程 (结果中的 fallback 字段记录原因)。
+    on_progress(stage, result) 在每个阶段开始时 (以及 stream=True 时每收到新 token) 回调当前结果快照，
+    stage 为 "fused"、"creative" 或 "formatting"。失败时结果中的 error 字段非空。
+    """
+    if mode not in PIPELINE_MODES:
+        mode = DEFAULT_PIPELINE_MODE
+    started = time.perf_counter()
+    result = _new_result(mode)
+    metrics.start_flusher()
+    with metrics.GENERATIONS_INFLIGHT.track_inprogress(), usage.track(style) as call_usage, \
+            metrics.span('generation', style=style, mode=mode) as trace:
+        steps = _pipeline_steps(style, user_theme, result, on_progress, stream)
+        outcome = None
+        while True:
+            try:
+                stage, args = steps.send(outcome)
+            except StopIteration:
+                break
+            outcome = SYNC_STAGE_CALLS[stage](*args)
+        trace.update(error=result['error'], fallback=result['fallback'], timings=result['timings'])
+    _finish_generation(style, mode, started, result, call_usage)
+    return result
+
+async def run_generation_pipeline_async(style: str, user_theme: str,
+                                        on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+                                        stream: bool = False, mode: str = DEFAULT_PIPELINE_MODE) -> Dict[str, Any]:
+    """run_generation_pipeline 的协程版本：各阶段的上游调用以 await 执行，等待期间不占用线程"""
+    if mode not in PIPELINE_MODES:
+        mode = DEFAULT_PIPELINE_MODE
+    started = time.perf_counter()
+    result = _new_result(mode)
+    metrics.start_flusher()
+    with metrics.GENERATIONS_INFLIGHT.track_inprogress(), usage.track(style) as call_usage, \
+            metrics.span('generation', style=style, mode=mode, runner='async') as trace:
+        steps = _pipeline_steps(style, user_theme, result, on_progress, stream)
+        outcome = None
+        while True:
+            try:
+                stage, args = steps.send(outcome)
+            except StopIteration:
+                break
+            outcome = await ASYNC_STAGE_CALLS[stage](*args)
+        trace.update(error=result['error'], fallback=result['fallback'], timings=result['timings'])
+    _finish_generation(style, mode, started, result, call_usage)
+    return result
+
+# 格式化阶段填入主结果卡片的四个字段
+FINAL_FIELDS = ('final_tag', 'final_natural', 'final_chinese_natural', 'final_negative')
+
+def _new_result(mode: str) -> Dict[str, Any]:
+    return {
+        'title': "", 'raw': "", 'final_tag': "", 'final_natural': "", 'final_chinese_natural': "", 'final_negative': "",
+        'mode': mode, 'timings': {}, 'usage': {}, 'error': None, 'fallback': None,
+    }
+
+def _finish_generation(style: str, mode: str, started: float, result: Dict[str, Any], call_usage: Dict[str, Any]) -> None:
+    result['usage'] = call_usage
+    elapsed = time.perf_counter() - started
+    _record_pipeline_run(mode, elapsed, result)
+    outcome = 'error' if result['error'] else ('fallback' if result['fallback'] else 'ok')
+    metrics.GENERATIONS.inc(style=style, mode=mode, outcome=outcome)
+    metrics.GENERATION_DURATION.observe(elapsed, style=style, mode=mode)
+
+# 流水线的阶段顺序只在 _pipeline_steps 中描述一次：它产出 (阶段名, 参数)，
+# 由同步或异步驱动循环调用对应的阶段函数，再把 (结果, 错误) 送回生成器
+SYNC_STAGE_CALLS: Dict[str, Callable[..., Tuple[Any, Optional[str]]]] = {
+    'fused': ai_generate_fused, 'creative': ai_generate_raw_prompt, 'formatting': deepseek_format_prompt}
+ASYNC_STAGE_CALLS: Dict[str, Callable[..., Any]] = {
+    'fused': ai_generate_fused_async, 'creative': ai_generate_raw_prompt_async, 'formatting': deepseek_format_prompt_async}
+
+def _pipeline_steps(style: str, user_theme: str, result: Dict[str, Any],
+                    on_progress: Optional[Callable[[str, Dict[str, Any]], None]],
+                    stream: bool) -> Generator[Tuple[str, tuple], Tuple[Any, Optional[str]], None]:
+    def report(stage: str, **changes):
+        result.update(changes)
+        if on_progress is not None:
+            on_progress(stage, dict(result))
+
+    creative_title = f"⚙️ 正在执行【DeepSeek 创意生成】... (风格: {style})"
+
+    if result['mode'] == PIPELINE_MODE_FUSED:
+        report('fused', title=f"⚙️ 正在执行【DeepSeek 单次融合生成】... (风格: {style})")
+        started = time.perf_counter()
+        fused_data, fused_error = yield 'fused', (style, user_theme)
+        result['timings']['fused'] = round(time.perf_counter() - started, 3)
+
+        if not fused_error:
+            result.update(
+                title=f"✅ 最终提示词输出：{style} 风格 (主题已整合，单次融合)",
+                raw=fused_data['raw_chinese_prompt'],
+                **{key: fused_data[key] for key in FINAL_FIELDS},
+            )
+            return
+        result['fallback'] = fused_error
+        creative_title = f"⚙️ 融合输出无效，回退到【DeepSeek 创意生成】... (风格: {style})"
+
+    report('creative', title=creative_title)
+    on_delta = (lambda text: report('creative', raw=text)) if stream else None
+    started = time.perf_counter()
+    raw_chinese_prompt, gen_error = yield 'creative', (style, user_theme, on_delta)
+    result['timings']['creative'] = round(time.perf_counter() - started, 3)
+
+    if gen_error:
+        result.update(title=f"❌ AI 创意生成失败: {gen_error}", raw="N/A", final_tag="N/A",
+                      final_natural="N/A", final_chinese_natural="N/A", final_negative="N/A", error=gen_error)
+        return
+
+    # 第一阶段结束后立即开始格式化
+    report('formatting', title="⚙️ 正在执行【DeepSeek 专业格式化】...", raw=raw_chinese_prompt)
+
+    started = time.perf_counter()
+    structured_data, format_error = yield 'formatting', (raw_chinese_prompt, style)
+    result['timings']['formatting'] = round(time.perf_counter() - started, 3)
+
+    if format_error:
+        result.update(title=f"❌ DeepSeek 格式化失败: {format_error}", final_tag="N/A",
+                      final_natural="N/A", final_chinese_natural="N/A", final_negative="N/A", error=format_error)
+        return
+
+    # 标签完全由本地标签索引给出时在标题中注明
+    source = "，本地标签索引" if structured_data.get('format_path') == tag_index.FORMAT_PATH_LOCAL else ""
+    result.update(
+        title=f"✅ 最终提示词输出：{style} 风格 (主题已整合{source})",
+        final_tag=structured_data.get('final_tag', 'N/A'),
+        final_natural=structured_data.get('final_natural', 'N/A'),
+        final_chinese_natural=structured_data.get('final_chinese_natural', 'N/A'),
+        final_negative=structured_data.get('final_negative', 'N/A'),
+    )
+
+
+def _record_history(style: str, user_theme: str, result: Dict[str, Any], owner: Optional[str]) -> None:
+    """把成功的生成追加到历史 (写入失败只告警，不影响本次结果)"""
+    if not history.HISTORY_ENABLED or result['error']:
+        return
+    # 多变体生成时每个保留下来的变体各记一条，整次生成的 token 用量记在第一条上
+    outputs = [variant for variant in result.get('variants', ()) if variant['status'] == 'done'] or [result]
+    try:
+        for position, output in enumerate(outputs):
+            record = {'style': style, 'theme': user_theme, 'mode': result['mode'], 'raw': output['raw'],
+                      **{key: output[key] for key in FINAL_FIELDS}, 'timings': output['timings'],
+                      'usage': result['usage'] if position == 0 else {}, 'fallback': result['fallback'],
+                      'request_id': metrics.current_request_id()}
+            if output is not result:
+                record.update(variant=output['index'], temperature=output['temperature'])
+            entry_id = history.history_store.append(record, client=owner)
+            result.setdefault('history_id', entry_id)
+        history.history_store.start_maintenance()
+    except OSError as e:
+        print(f"警告：写入生成历史失败: {e}")
+
+
+def batch_pipeline(style: str, user_theme: str, mode: Optional[str] = None) -> Dict[str, Any]:
+    """批量模式使用的流水线：不需要流式进度，每个条目使用独立的请求 ID"""
+    with metrics.trace_context(None):
+        result = run_generation_pipeline(style, user_theme, mode=mode or DEFAULT_PIPELINE_MODE)
+        _record_history(style, user_theme, result, None)
+        return result
+
+
+def _queue_reporter(job: jobs.JobHandle) -> Callable[[int], None]:
+    """等待准入期间，把排队位置写入任务表，前端标题显示为 "已排队，第 N 位" """
+    style, mode = job.params['style'], job.params.get('mode', DEFAULT_PIPELINE_MODE)
+    return lambda position: job.report('queued', dict(_new_result(mode), title=f"⏳ 已排队，当前第 {position} 位... (风格: {style})"))
+
+def _rejected_result(mode: str, reason: Any) -> Dict[str, Any]:
+    return dict(_new_result(mode), title=f"❌ 服务繁忙：{reason}", raw="N/A", final_tag="N/A", final_natural="N/A",
+                final_chinese_natural="N/A", final_negative="N/A", error=str(reason))
+
+def admitted_batch_pipeline(client: str) -> batch.Pipeline:
+    """/api/batch 使用的流水线：每个条目与页面上的生成一样先登记票据、在公平队列中等待名额，完成后归还"""
+    def pipeline(style: str, user_theme: str, mode: Optional[str] = None) -> Dict[str, Any]:
+        ticket = metrics.new_request_id()
+        rejected = admission.controller.enqueue(ticket, client)
+        if rejected:
+            return _rejected_result(mode or DEFAULT_PIPELINE_MODE, rejected)
+        try:
+            admission.controller.wait_for_turn(ticket, client)
+            return batch_pipeline(style, user_theme, mode)
+        except admission.AdmissionRejected as e:
+            return _rejected_result(mode or DEFAULT_PIPELINE_MODE, e)
+        finally:
+            admission.controller.release(ticket)
+    return pipeline
+
+def _cancel_job(job_id: str, job: Optional[Dict[str, Any]] = None) -> bool:
+    """取消任务并归还它的排队票据：排队中被取消的任务不会再执行，任务函数 finally 中的释放也就不会运行"""
+    job = job or jobs.job_store.get(job_id)
+    if job is None or not jobs.job_store.cancel(job_id):
+        return False
+    admission.controller.release(job['params'].get('ticket'))
+    return True
+
+def generation_task(job: jobs.JobHandle) -> Dict[str, Any]:
+    """后台任务入口：先在全局公平队列中等待准入，再执行流水线，并把每个阶段的进度写入任务表供前端轮询。"""
+    ticket, mode = job.params['ticket'], job.params.get('mode', DEFAULT_PIPELINE_MODE)
+    with metrics.trace_context(job.params.get('request_id')):
+        metrics.log_event('job_start', job_id=job.job_id)
+        try:
+            admission.controller.wait_for_turn(ticket, job.params['client'], on_position=_queue_reporter(job), check=job.check)
+            if job.params.get('variants', 1) > 1:
+                result = run_variant_pipeline(job.params['style'], job.params['theme'], job.params['variants'],
+                                              on_progress=job.report)
+            else:
+                result = run_generation_pipeline(job.params['style'], job.params['theme'], on_progress=job.report,
+                                                 stream=STREAMING_ENABLED, mode=mode)
+            _record_history(job.params['style'], job.params['theme'], result, job.params.get('owner'))
+            return result
+        except admission.AdmissionRejected as e:
+            return _rejected_result(mode, e)
+        finally:
+            admission.controller.release(ticket)
+
+
+async def generation_task_async(job: jobs.JobHandle) -> Dict[str, Any]:
+    """异步模式的后台任务入口，在 worker 进程的事件循环中执行。"""
+    ticket, mode = job.params['ticket'], job.params.get('mode', DEFAULT_PIPELINE_MODE)
+    with metrics.trace_context(job.params.get('request_id')):
+        metrics.log_event('job_start', job_id=job.job_id, runner='async')
+        try:
+            await admission.controller.wait_for_turn_async(ticket, job.params['client'], on_position=_queue_reporter(job),
+                                                           check=job.check)
+            if job.params.get('variants', 1) > 1:
+                result = await run_variant_pipeline_async(job.params['style'], job.params['theme'], job.params['variants'],
+                                                          on_progress=job.report)
+            else:
+                result = await run_generation_pipeline_async(job.params['style'], job.params['theme'],
+                                                             on_progress=job.report, stream=STREAMING_ENABLED, mode=mode)
+            # 历史写入持有跨进程文件锁、票据释放是 SQLite 写入，都不放在事件循环线程上执行
+            await asyncio.to_thread(_record_history, job.params['style'], job.params['theme'], result,
+                                    job.params.get('owner'))
+            return result
+        except admission.AdmissionRejected as e:
+            return _rejected_result(mode, e)
+        finally:
+            await asyncio.to_thread(admission.controller.release, ticket)
+
+
+# 回调与运维接口使用的任务执行器
+if ASYNC_MODE_ENABLED:
+    job_runner, job_task = jobs.async_job_runner, generation_task_async
+else:
+    job_runner, job_task = jobs.job_runner, generation_task
+
+
+# ==============================================================================
+# 3.6 多变体生成：并发创意生成 + 近似去重，只格式化保留下来的变体
+# ==============================================================================
+# K 个变体的创意生成同时发出 (温度依次升高并附带差异化要求，见 _creative_request)。
+# 每个原始描述返回后立即与已保留的变体比较字符 n-gram 的 MinHash 相似度，近似重复的直接丢弃，
+# 其余马上进入格式化；格式化完成后再用标签集合的 Jaccard 复核一次。
+# 每个变体完成都会推送进度，总耗时接近一次两阶段生成，而不是 K 倍。
+# (格式化之前还没有标签串，所以第一道去重只能基于原始描述文本；单次融合模式没有这个间隙，多变体固定走两阶段。)
+
+VARIANT_MAX = int(os.environ.get('VARIANT_MAX', '4'))
+VARIANT_TEXT_SIMILARITY = float(os.environ.get('VARIANT_TEXT_SIMILARITY', '0.6'))
+VARIANT_TAG_SIMILARITY = float(os.environ.get('VARIANT_TAG_SIMILARITY', '0.8'))
+# 仅用于指标与耗时统计的模式标签 (可与两阶段、融合模式并排比较)
+PIPELINE_MODE_VARIANTS = "variants"
+
+
+class VariantSet:
+    """K 个变体的进度与去重状态，同步与异步驱动共用 (只在驱动所在的线程/事件循环中修改)。"""
+
+    def __init__(self, style: str, count: int, result: Dict[str, Any],
+                 on_progress: Optional[Callable[[str, Dict[str, Any]], None]]):
+        self.style = style
+        self.result = result
+        self.on_progress = on_progress
+        self.started = time.perf_counter()
+        self._signatures: List[Tuple[int, Tuple[int, ...]]] = []
+        self._tag_sets: List[Tuple[int, FrozenSet[str]]] = []
+        result['variants'] = [
+            {'index': index, 'temperature': variant_temperature(index), 'status': 'creative', 'raw': "",
+             **{key: "" for key in FINAL_FIELDS}, 'error': None, 'duplicate_of': None, 'similarity': None, 'timings': {}}
+            for index in range(count)]
+        self._report('creative')
+
+    def _count(self, status: str) -> int:
+        return sum(1 for variant in self.result['variants'] if variant['status'] == status)
+
+    def _report(self, stage: str) -> None:
+        self.result['title'] = (f"⚙️ 正在并发生成 {len(self.result['variants'])} 个变体... "
+                                f"(已完成 {self._count('done')}，近似重复已丢弃 {self._count('duplicate')}，风格: {self.style})")
+        if self.on_progress is not None:
+            self.on_progress(stage, dict(self.result, variants=[dict(variant) for variant in self.result['variants']]))
+
+    def _duplicate(self, variant: Dict[str, Any], other: int, score: float) -> None:
+        variant.update(status='duplicate', duplicate_of=other, similarity=round(score, 2))
+
+    def creative_done(self, index: int, raw: Optional[str], error: Optional[str]) -> bool:
+        """记录一个创意生成结果，返回该变体是否需要继续格式化"""
+        variant = self.result['variants'][index]
+        variant['timings']['creative'] = round(time.perf_counter() - self.started, 3)
+        if error:
+            variant.update(status='error', error=error)
+            self._report('creative')
+            return False
+        variant['raw'] = raw
+        signature = similarity.text_signature(raw)
+        for other, other_signature in self._signatures:
+            score = similarity.estimate_jaccard(signature, other_signature)
+            if score >= VARIANT_TEXT_SIMILARITY:
+                self._duplicate(variant, other, score)
+                self._report('creative')
+                return False
+        self._signatures.append((index, signature))
+        variant['status'] = 'formatting'
+        if not self.result['raw']:
+            self.result['raw'] = raw
+        self._report('formatting')
+        return True
+
+    def formatting_done(self, index: int, data: Optional[Dict[str, Any]], error: Optional[str]) -> None:
+        variant = self.result['variants'][index]
+        variant['timings']['formatting'] = round(time.perf_counter() - self.started - variant['timings']['creative'], 3)
+        if error:
+            variant.update(status='error', error=error)
+            self._report('formatting')
+            return
+        fields = {key: data.get(key, 'N/A') for key in FINAL_FIELDS}
+        tags = similarity.tag_set(fields['final_tag'])
+        for other, other_tags in self._tag_sets:
+            score = similarity.jaccard(tags, other_tags)
+            if score >= VARIANT_TAG_SIMILARITY:
+                variant.update(fields)
+                self._duplicate(variant, other, score)
+                self._report('formatting')
+                return
+        self._tag_sets.append((index, tags))
+        variant.update(status='done', **fields)
+        if len(self._tag_sets) == 1:
+            # 最先完成的变体同时显示在主结果卡片中
+            self.result.update(raw=variant['raw'], **fields)
+        self._report('formatting')
+
+    def finish(self) -> None:
+        self.result['timings'] = {'variants': round(time.perf_counter() - self.started, 3)}
+        done, dropped = self._count('done'), self._count('duplicate')
+        if done:
+            self.result['title'] = f"✅ 最终提示词输出：{self.style} 风格 (主题已整合，{done} 个变体，近似重复已丢弃 {dropped} 个)"
+            return
+        error = next((variant['error'] for variant in self.result['variants'] if variant['error']), "没有生成任何变体")
+        self.result.update(title=f"❌ 多变体生成失败: {error}", final_tag="N/A", final_natural="N/A",
+                           final_chinese_natural="N/A", final_negative="N/A", error=error)
+
+
+def run_variant_pipeline(style: str, user_theme: str, count: int,
+                         on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """并发生成 count 个变体 (见本节说明)。返回值与 run_generation_pipeline 相同，另带 variants 列表。"""
+    started = time.perf_counter()
+    result = _new_result(PIPELINE_MODE_TWO_PASS)
+    metrics.start_flusher()
+    with metrics.GENERATIONS_INFLIGHT.track_inprogress(), usage.track(style) as call_usage, \
+            metrics.span('generation', style=style, mode=PIPELINE_MODE_VARIANTS, variants=count) as trace:
+        variants = VariantSet(style, count, result, on_progress)
+        pending = {}
+        executor = ThreadPoolExecutor(max_workers=count, thread_name_prefix='variant')
+
+        def submit(stage: str, index: int, call: Callable[..., Any], *args: Any) -> None:
+            # 复制当前上下文，线程池中的上游调用沿用本次生成的请求 ID 与用量统计
+            pending[executor.submit(contextvars.copy_context().run, call, *args)] = (stage, index)
+
+        try:
+            for index in range(count):
+                submit('creative', index, ai_generate_raw_prompt, style, user_theme, None, index)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    stage, index = pending.pop(future)
+                    value, error = future.result()
+                    if stage == 'formatting':
+                        variants.formatting_done(index, value, error)
+                    elif variants.creative_done(index, value, error):
+                        submit('formatting', index, deepseek_format_prompt, value, style)
+        finally:
+            # 正常结束时已没有未完成的调用。任务被取消 (进度回调抛出 JobCancelled) 或出错时不等待其余变体：
+            # 尚未开始的调用直接取消，已发出的上游调用 (可能还在重试退避) 在后台结束后丢弃结果，
+            # 任务随即返回并归还准入名额与任务线程
+            executor.shutdown(wait=not pending, cancel_futures=True)
+        variants.finish()
+        trace.update(error=result['error'], timings=result['timings'],
+                     statuses=[variant['status'] for variant in result['variants']])
+    _finish_generation(style, PIPELINE_MODE_VARIANTS, started, result, call_usage)
+    return result
+
+async def run_variant_pipeline_async(style: str, user_theme: str, count: int,
+                                     on_progress: Optional[Callable[[str, Dict[str, Any]], None]] = None) -> Dict[str, Any]:
+    """run_variant_pipeline 的协程版本"""
+    started = time.perf_counter()
+    result = _new_result(PIPELINE_MODE_TWO_PASS)
+    metrics.start_flusher()
+    with metrics.GENERATIONS_INFLIGHT.track_inprogress(), usage.track(style) as call_usage, \
+            metrics.span('generation', style=style, mode=PIPELINE_MODE_VARIANTS, variants=count, runner='async') as trace:
+        variants = VariantSet(style, count, result, on_progress)
+        pending = {asyncio.ensure_future(ai_generate_raw_prompt_async(style, user_theme, None, index)): ('creative', index)
+                   for index in range(count)}
+        try:
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    stage, index = pending.pop(task)
+                    value, error = task.result()
+                    if stage == 'formatting':
+                        variants.formatting_done(index, value, error)
+                    elif variants.creative_done(index, value, error):
+                        pending[asyncio.ensure_future(deepseek_format_prompt_async(value, style))] = ('formatting', index)
+        finally:
+            # 任务被取消时不再等待其余变体
+            for task in pending:
+                task.cancel()
+        variants.finish()
+        trace.update(error=result['error'], timings=result['timings'],
+                     statuses=[variant['status'] for variant in result['variants']])
+    _finish_generation(style, PIPELINE_MODE_VARIANTS, started, result, call_usage)
+    return result
 
 
 # ==============================================================================
@@ -187,6 +998,9 @@ def deepseek_format_prompt(raw_chinese_prompt: str) -> Tuple[Optional[Dict], Opt
 
 app = dash.Dash(__name__, external_stylesheets=[APP_THEME])
 server = app.server # 必须保留，供 Gunicorn/Waitress 等 WSGI 服务器调用
+if TRUSTED_PROXY_HOPS > 0:
+    # 只信任最后 TRUSTED_PROXY_HOPS 个代理写入的地址，request.remote_addr 随之改为真实客户端地址
+    server.wsgi_app = ProxyFix(server.wsgi_app, x_for=TRUSTED_PROXY_HOPS)
 
 def result_card(title, id_name, is_code=False):
     style = {"font-family": "monospace", "white-space": "pre-wrap"} if is_code else {}
@@ -199,151 +1013,197 @@ def result_card(title, id_name, is_code=False):
         className="mb-4",
     )
 
-app.layout = dbc.Container([
-    html.H1("🌟 AI 提示词多风格生成器 (30 种模式)", className="text-center my-4"),
-    html.P("【AI驱动】DeepSeek 模型将处理创意生成和专业格式化两个阶段。", className="text-center mb-4 text-muted"),
-
-    dbc.Row([
-        dbc.Col([
-            html.Label("输入您的核心主题（例如：手持旗帜的女神，站在战场废墟上）:", className="fw-bold mb-2"),
-            dcc.Textarea(
-                id='user-theme-input',
-                value='一位穿着紧身宇航服的女性，漂浮在太空中', # 默认示例
-                placeholder='在此输入您对人物、数量、服装、背景等的核心要求...',
-                style={'width': '100%', 'minHeight': 100, 'backgroundColor': '#f8f9fa'},
-            ),
-        ], md=12, className="mb-4"),
-    ]),
-    
-    # 按钮区域 - 调整为八行布局 (30个按钮)
-    html.H5("一、SFW / R16 风格 (日常、艺术、宏大、局部擦边)", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("1. SFW 正常", id="btn-normal", color="primary", className="w-100"), md=3),
-        dbc.Col(dbc.Button("2. SFW 艺术", id="btn-art", color="info", className="w-100"), md=3),
-        dbc.Col(dbc.Button("3. SFW 宏大场景", id="btn-grand-sfw", color="success", className="w-100"), md=3),
-        dbc.Col(dbc.Button("4. R16 擦边 (露胸)", id="btn-r16-breasts", color="warning", className="w-100"), md=3),
-    ], className="mb-4"),
-
-    html.H5("二、R16 / R18 宏大/艺术风格", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("5. R16 擦边 (露阴)", id="btn-r16-genitals", color="warning", className="w-100"), md=3),
-        dbc.Col(dbc.Button("6. NSFW 宏大正面", id="btn-grand-nsfw-positive", color="dark", className="w-100"), md=3),
-        dbc.Col(dbc.Button("7. NSFW 宏大 R-18", id="btn-grand-nsfw-explicit", color="danger", className="w-100"), md=3),
-        dbc.Col(dbc.Button("8. R-18 露骨", id="btn-nsfw-explicit", color="danger", className="w-100"), md=3), 
-    ], className="mb-4"),
-
-    html.H5("三、写真/ Cosplay 风格", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("9. R17 写真", id="btn-gravure-r17", color="info", className="w-100"), md=3),
-        dbc.Col(dbc.Button("10. NSFW 写真", id="btn-gravure-nsfw", color="danger", className="w-100"), md=3),
-        dbc.Col(dbc.Button("11. Cosplay SFW", id="btn-cosplay-sfw", color="primary", className="w-100"), md=3),
-        dbc.Col(dbc.Button("12. Cosplay 擦边", id="btn-cosplay-r16", color="warning", className="w-100"), md=3),
-    ], className="mb-4"),
-
-    html.H5("四、R-18 艺术美学风格 (形态、光影、环境)", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("13. 人体艺术 NSFW", id="btn-art-nude-nsfw", color="danger", className="w-100"), md=3),
-        dbc.Col(dbc.Button("14. 雾气弥漫/水景裸体", id="btn-misty-water-nude", color="dark", className="w-100"), md=3), 
-        dbc.Col(dbc.Button("15. 哥特式浪漫裸体", id="btn-gothic-romantic-nude", color="dark", className="w-100"), md=3), 
-        dbc.Col(dbc.Button("16. 极简主义形态", id="btn-minimalist-form-nude", color="dark", className="w-100"), md=3), 
-    ], className="mb-4"),
-
-    html.H5("五、R-18 细分题材 (制服、偷窥、社会)", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("17. 制服失控", id="btn-uniform-violation", color="danger", className="w-100"), md=3),
-        dbc.Col(dbc.Button("18. 湿身/油光特写", id="btn-wet-oily-focus", color="dark", className="w-100"), md=3),
-        dbc.Col(dbc.Button("19. 神话/古典 R-18", id="btn-myth-explicit", color="dark", className="w-100"), md=3),
-        dbc.Col(dbc.Button("20. 偷窥视角", id="btn-voyeur-unaware", color="secondary", className="w-100"), md=3),
-    ], className="mb-4"),
+def style_buttons(table: styles.StyleTable) -> List[Any]:
+    """按注册表分组生成风格按钮，每行 4 个；按钮 ID 为 {'type': 'style-btn', 'index': 风格键}"""
+    children = []
+    for position, (title, members) in enumerate(table.groups):
+        children.append(html.H5(title, className="mt-2 mb-2"))
+        children.append(dbc.Row([
+            dbc.Col(dbc.Button(style.label, id={'type': 'style-btn', 'index': style.key}, color=style.color,
+                               className="w-100 mb-2"), md=3)
+            for style in members
+        ], className="mb-5" if position == len(table.groups) - 1 else "mb-4"))
+    return children
+
+def serve_layout():
+    """每次打开页面时生成布局，风格注册表热加载后刷新页面即可看到新的按钮"""
+    if flask.has_request_context():
+        # 打开页面时即签发历史归属 Cookie，之后页面上并发的回调都带着同一个标识
+        _history_owner()
+    table = style_registry.table()
+    return dbc.Container([
+        html.H1(f"🌟 AI 提示词多风格生成器 ({len(table.styles)} 种模式)", className="text-center my-4"),
+        html.P("【AI驱动】DeepSeek 模型将处理创意生成和专业格式化两个阶段。", className="text-center mb-4 text-muted"),
+
+        dbc.Row([
+            dbc.Col([
+                html.Label("输入您的核心主题（例如：手持旗帜的女神，站在战场废墟上）:", className="fw-bold mb-2"),
+                dcc.Textarea(
+                    id='user-theme-input',
+                    value='一位穿着紧身宇航服的女性，漂浮在太空中', # 默认示例
+                    placeholder='在此输入您对人物、数量、服装、背景等的核心要求...',
+                    style={'width': '100%', 'minHeight': 100, 'backgroundColor': '#f8f9fa'},
+                ),
+                dbc.RadioItems(
+                    id='mode-select',
+                    options=[
+                        {'label': "两阶段 (创意生成 → 专业格式化)", 'value': PIPELINE_MODE_TWO_PASS},
+                        {'label': "单次融合 (一次调用，更快；失败自动回退)", 'value': PIPELINE_MODE_FUSED},
+                    ],
+                    value=DEFAULT_PIPELINE_MODE,
+                    inline=True,
+                    className="mt-2",
+                ),
+                html.Div([
+                    html.Span("变体数量 (并发生成并自动去除近似重复，固定使用两阶段)：", className="me-2"),
+                    dbc.RadioItems(
+                        id='variant-count',
+                        options=[{'label': str(count), 'value': count} for count in range(1, VARIANT_MAX + 1)],
+                        value=1,
+                        inline=True,
+                    ),
+                ], className="d-flex align-items-center mt-2"),
+            ], md=12, className="mb-4"),
+        ]),
     
-    html.H5("六、时尚模特/社会题材 (SFW 到 R-18)", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("21. 裸体社会", id="btn-nude-society-normal", color="secondary", className="w-100"), md=3), 
-        dbc.Col(dbc.Button("22. 时尚 正常", id="btn-fashion-normal", color="primary", className="w-100"), md=3), 
-        dbc.Col(dbc.Button("23. 时尚 艺术/高定", id="btn-fashion-sfw", color="info", className="w-100"), md=3), 
-        dbc.Col(dbc.Button("24. 时尚 擦边", id="btn-fashion-r16", color="warning", className="w-100"), md=3), 
-    ], className="mb-4"),
-
-    html.H5("七、R-18 Cosplay / 时尚 / 犯罪风格", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("25. Cosplay NSFW", id="btn-cosplay-nsfw", color="danger", className="w-100"), md=3),
-        dbc.Col(dbc.Button("26. 时尚 NSFW", id="btn-fashion-nsfw", color="danger", className="w-100"), md=3), 
-        dbc.Col(dbc.Button("27. 犯罪 (被捕罪徒)", id="btn-crime-capture", color="secondary", className="w-100"), md=3),
-        dbc.Col(dbc.Button("28. 犯罪 (夜色盗贼)", id="btn-crime-thief", color="secondary", className="w-100"), md=3),
-    ], className="mb-4"),
-
-    html.H5("八、R-18 犯罪叙事风格 (二)", className="mt-2 mb-2"),
-    dbc.Row([
-        dbc.Col(dbc.Button("29. 犯罪 (邪教仪式)", id="btn-crime-ritual", color="secondary", className="w-100"), md=3),
-        dbc.Col(dbc.Button("30. 犯罪 (极致羞辱)", id="btn-crime-humiliation", color="secondary", className="w-100"), md=3),
-    ], className="mb-5"),
-
-
-    html.Hr(),
-    html.H3(id="result-title", children="等待生成...", className="text-center my-4"),
-
-    # 结果展示区域
-    dbc.Row([
-        dbc.Col(result_card("原始 AI 创意描述 (First Pass)", "output-raw-prompt", is_code=False), md=12),
-    ]),
-    dbc.Row([
-        dbc.Col(result_card("标签串 (Final Danbooru Tags)", "output-tag", is_code=True), md=12),
-    ]),
-    dbc.Row([
-        dbc.Col(result_card("英文自然语言描述 (English Natural Prompt)", "output-natural"), md=6),
-        dbc.Col(result_card("中文润色描述 (Chinese Refined Prompt)", "output-chinese-natural"), md=6),
-    ]),
-    dbc.Row([
-        dbc.Col(result_card("负面提示词 (Negative Prompt)", "output-negative", is_code=True), md=12),
-    ]),
-
-    dcc.Store(id='style-store', data=None),
-    dcc.Loading(id="loading-output", children=html.Div(id="loading-indicator"), type="circle"),
-    html.Div(id="dummy-output", style={'display': 'none'})
-], fluid=True, className="p-4")
+        # 按钮区域 (由风格注册表生成)
+        *style_buttons(table),
+
+        html.Hr(),
+        html.H3(id="result-title", children="等待生成...", className="text-center my-4"),
+
+        # 结果展示区域
+        dbc.Row([
+            dbc.Col(result_card("原始 AI 创意描述 (First Pass)", "output-raw-prompt", is_code=False), md=12),
+        ]),
+        dbc.Row([
+            dbc.Col(result_card("标签串 (Final Danbooru Tags)", "output-tag", is_code=True), md=12),
+        ]),
+        dbc.Row([
+            dbc.Col(result_card("英文自然语言描述 (English Natural Prompt)", "output-natural"), md=6),
+            dbc.Col(result_card("中文润色描述 (Chinese Refined Prompt)", "output-chinese-natural"), md=6),
+        ]),
+        dbc.Row([
+            dbc.Col(result_card("负面提示词 (Negative Prompt)", "output-negative", is_code=True), md=12),
+        ]),
+        # 多变体生成时每个变体一张卡片 (主结果卡片显示最先完成的变体)
+        dbc.Row(id="variant-cards"),
+
+        # 生成历史：分页浏览已完成的生成，可直接载入到上方结果区 (无需再次调用模型)
+        html.Hr(),
+        html.H3("📜 生成历史", className="text-center my-4"),
+        dbc.Row([
+            dbc.Col(dcc.Dropdown(id='history-style', options=[{'label': style.label, 'value': style.key} for style in table.styles],
+                                 placeholder="全部风格"), md=3),
+            dbc.Col(dcc.Dropdown(id='history-range', options=[{'label': label, 'value': key}
+                                                              for key, (label, _) in HISTORY_RANGES.items()],
+                                 placeholder="全部时间"), md=3),
+            dbc.Col(dcc.Input(id='history-search', type='text', debounce=True, placeholder="搜索主题或提示词 (回车确认)...",
+                              className="form-control"), md=4),
+            dbc.Col(dbc.ButtonGroup([
+                dbc.Button("上一页", id='history-prev', color="secondary", outline=True, disabled=True),
+                dbc.Button("下一页", id='history-next', color="secondary", outline=True, disabled=True),
+            ], className="w-100"), md=2),
+        ], className="mb-3"),
+        html.Div(id='history-list', children="暂无历史记录。", className="mb-4"),
+
+        dcc.Store(id='history-page', data=0),
+        dcc.Store(id='style-store', data=None),
+        dcc.Store(id='job-id', data=None),
+        dcc.Interval(id='job-poll', interval=JOB_POLL_INTERVAL_MS, disabled=True),
+        dcc.Loading(id="loading-output", children=html.Div(id="loading-indicator"), type="circle"),
+    ], fluid=True, className="p-4")
+
+app.layout = serve_layout
 
 # ==============================================================================
 # 5. Dash 回调函数 (保持不变)
 # ==============================================================================
 
-# (回调函数逻辑与前文一致，省略以避免重复，但实际部署需包含全部回调函数)
-@callback(
-    [Output('style-store', 'data'),
-     Output('dummy-output', 'children')],
-    [Input('btn-normal', 'n_clicks'), Input('btn-art', 'n_clicks'), Input('btn-grand-sfw', 'n_clicks'), Input('btn-r16-breasts', 'n_clicks'),
-     Input('btn-r16-genitals', 'n_clicks'), Input('btn-grand-nsfw-positive', 'n_clicks'), Input('btn-grand-nsfw-explicit', 'n_clicks'), Input('btn-nsfw-explicit', 'n_clicks'),
-     Input('btn-crime-capture', 'n_clicks'), Input('btn-crime-thief', 'n_clicks'), Input('btn-crime-ritual', 'n_clicks'), Input('btn-crime-humiliation', 'n_clicks'),
-     Input('btn-art-nude-nsfw', 'n_clicks'), Input('btn-gravure-r17', 'n_clicks'), Input('btn-gravure-nsfw', 'n_clicks'), Input('btn-cosplay-sfw', 'n_clicks'), 
-     Input('btn-cosplay-r16', 'n_clicks'), Input('btn-cosplay-nsfw', 'n_clicks'), Input('btn-uniform-violation', 'n_clicks'), Input('btn-wet-oily-focus', 'n_clicks'),
-     Input('btn-myth-explicit', 'n_clicks'), Input('btn-voyeur-unaware', 'n_clicks'),
-     Input('btn-misty-water-nude', 'n_clicks'), Input('btn-gothic-romantic-nude', 'n_clicks'), Input('btn-minimalist-form-nude', 'n_clicks'),
-     Input('btn-nude-society-normal', 'n_clicks'), Input('btn-fashion-normal', 'n_clicks'), Input('btn-fashion-sfw', 'n_clicks'),
-     Input('btn-fashion-r16', 'n_clicks'), Input('btn-fashion-nsfw', 'n_clicks')]
-)
-def store_style_selection(n1, n2, n3, n4, n5, n6, n7, n8, n9, n10, n11, n12, n13, n14, n15, n16, n17, n18, n19, n20, n21, n22, n23, n24, n25, n26, n27, n28, n29, n30):
-    ctx = dash.callback_context
-    if not ctx.triggered:
-        return dash.no_update, ""
-    
-    button_id = ctx.triggered[0]['prop_id'].split('.')[0]
-    
-    style_map = {
-        'btn-normal': "NORMAL", 'btn-art': "ARTISTIC", 'btn-grand-sfw': "GRAND_SFW", 'btn-r16-breasts': "R16_BREASTS_ONLY",
-        'btn-r16-genitals': "R16_GENITALS_ONLY", 'btn-grand-nsfw-positive': "GRAND_NSFW_POSITIVE", 'btn-grand-nsfw-explicit': "GRAND_NSFW_EXPLICIT", 'btn-nsfw-explicit': "NSFW_EXPLICIT",
-        'btn-crime-capture': "CRIME_CAPTURE", 'btn-crime-thief': "CRIME_THIEF_ACTION", 'btn-crime-ritual': "CRIME_RITUAL", 'btn-crime-humiliation': "CRIME_HUMILIATION",
-        'btn-art-nude-nsfw': "ART_NUDE_NSFW", 'btn-gravure-r17': "GRAVURE_R17", 'btn-gravure-nsfw': "GRAVURE_NSFW", 'btn-cosplay-sfw': "COSPLAY_SFW",
-        'btn-cosplay-r16': "COSPLAY_R16", 'btn-cosplay-nsfw': "COSPLAY_NSFW",
-        'btn-uniform-violation': "UNIFORM_VIOLATION", 'btn-wet-oily-focus': "WET_OILY_FOCUS", 'btn-myth-explicit': "MYTH_EXPLICIT", 'btn-voyeur-unaware': "VOYEUR_UNAWARE",
-        'btn-misty-water-nude': "MISTY_WATER_NUDE", 'btn-gothic-romantic-nude': "GOTHIC_ROMANTIC_NUDE", 'btn-minimalist-form-nude': "MINIMALIST_FORM_NUDE",
-        'btn-nude-society-normal': "NUDE_SOCIETY_NORMAL", 'btn-fashion-normal': "FASHION_NORMAL", 'btn-fashion-sfw': "FASHION_SFW",
-        'btn-fashion-r16': "FASHION_R16", 'btn-fashion-nsfw': "FASHION_NSFW"
+# 风格按钮：单个模式匹配的客户端回调，只在浏览器中把被点击按钮的风格键写入 style-store，
+# 不向服务端发送全部按钮的 n_clicks，也不需要一次往返 (点击计数与追踪日志在生成回调中记录)
+dash.clientside_callback(
+    """
+    function(clicks) {
+        const triggered = dash_clientside.callback_context.triggered;
+        if (!triggered.length || !triggered[0].value) {
+            return dash_clientside.no_update;
+        }
+        const propId = triggered[0].prop_id;
+        const button = JSON.parse(propId.slice(0, propId.lastIndexOf('.')));
+        return {style: button.index, clicked_at: Date.now()};
     }
-    selected_style = style_map.get(button_id)
-    
-    if selected_style:
-        return selected_style, ""
-    return dash.no_update, ""
+    """,
+    Output('style-store', 'data'),
+    Input({'type': 'style-btn', 'index': ALL}, 'n_clicks'),
+    prevent_initial_call=True,
+)
+
+
+def _client_id() -> str:
+    """公平排队使用的客户端标识：客户端 IP (经过可信代理时由 ProxyFix 还原，见 TRUSTED_PROXY_HOPS)"""
+    return flask.request.remote_addr or '-'
+
+def _as_outputs(result: Dict[str, Any]) -> Tuple[str, ...]:
+    return (result['title'], result['raw'], result['final_tag'], result['final_natural'],
+            result['final_chinese_natural'], result['final_negative'])
+
+VARIANT_STATUS_TEXT = {'creative': ("创意生成中...", "secondary"), 'formatting': ("格式化中...", "info"),
+                       'done': ("已完成", "success"), 'duplicate': ("近似重复，已丢弃", "warning"), 'error': ("失败", "danger")}
+
+def variant_card(variant: Dict[str, Any]):
+    status_text, color = VARIANT_STATUS_TEXT[variant['status']]
+    if variant['status'] == 'duplicate':
+        status_text = f"与变体 {variant['duplicate_of'] + 1} 近似重复 (相似度 {variant['similarity']:.2f})，已丢弃"
+    code_style = {"font-family": "monospace", "white-space": "pre-wrap"}
+    body = [html.P(variant['error'] or variant['raw'] or "...", className="small text-muted")]
+    if variant['status'] == 'done':
+        body += [html.Div(variant['final_tag'], className="small mb-2", style=code_style),
+                 html.Div(variant['final_natural'], className="small mb-2"),
+                 html.Div(variant['final_chinese_natural'], className="small mb-2"),
+                 html.Div(variant['final_negative'], className="small text-muted", style=code_style)]
+    return dbc.Col(dbc.Card([
+        dbc.CardHeader([html.Strong(f"变体 {variant['index'] + 1}"),
+                        html.Small(f"  温度 {variant['temperature']}", className="text-muted"),
+                        dbc.Badge(status_text, color=color, className="float-end")]),
+        dbc.CardBody(body),
+    ], className="mb-4"), md=6)
+
+def _variant_cards(result: Optional[Dict[str, Any]]) -> Any:
+    if not result or 'variants' not in result:
+        return dash.no_update
+    return [variant_card(variant) for variant in result['variants']]
+
+def _job_outputs(job: Dict[str, Any]) -> Tuple[Any, ...]:
+    """把任务表中的一条记录转换为回调输出 (6 个结果框 + job-id + 轮询开关)"""
+    status = job['status']
+    result = job['result']
+    finished = status not in ('queued', 'running')
+    # 任务未结束时 job-id 保持不变，不重复写入 (否则每次轮询都会触发监听 job-id 的历史面板回调)
+    pending = (dash.no_update, False)
+
+    if status == 'running' and job['started_at'] and time.time() - job['started_at'] > jobs.JOB_TIMEOUT_SECONDS + 30:
+        # 执行任务的 worker 进程可能已经退出，不再继续等待
+        return "❌ 任务超时，请重试。", "N/A", "N/A", "N/A", "N/A", "N/A", None, True
+    if status == 'queued':
+        position = admission.controller.position(job['params'].get('ticket'))
+        if position:
+            return f"⏳ 已排队，当前第 {position} 位... (风格: {job['params']['style']})", "", "", "", "", "", *pending
+        depth = jobs.job_store.counts().get('queued', 1)
+        return f"⏳ 排队中... (当前排队任务数: {depth})", "", "", "", "", "", *pending
+    if status == 'cancelled':
+        return f"⛔ 任务已取消: {job['error']}", "N/A", "N/A", "N/A", "N/A", "N/A", None, True
+    if result is None:
+        title = f"❌ 生成过程异常: {job['error']}" if status == 'failed' else "⚙️ 正在启动..."
+        return (title, "N/A", "N/A", "N/A", "N/A", "N/A") + ((None, True) if finished else pending)
 
+    outputs = _as_outputs(result)
+    if status == 'done':
+        timings = job['timings'] or {}
+        total = job['finished_at'] - job['created_at']
+        stage_text = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in timings.items())
+        outputs = (f"{result['title']} [总耗时 {total:.1f}s: {stage_text}]",) + outputs[1:]
+    return outputs + ((None, True) if finished else pending)
 
 @callback(
     [Output('result-title', 'children'),
@@ -351,50 +1211,327 @@ def store_style_selection(n1, n2, n3, n4, n5, n6, n7, n8, n9, n10, n11, n12, n13
      Output('output-tag', 'children'),
      Output('output-natural', 'children'),
      Output('output-chinese-natural', 'children'),
-     Output('output-negative', 'children')],
-    [Input('style-store', 'data')],
-    [State('user-theme-input', 'value')]
+     Output('output-negative', 'children'),
+     Output('job-id', 'data'),
+     Output('job-poll', 'disabled'),
+     Output('variant-cards', 'children')],
+    [Input('style-store', 'data'),
+     Input('job-poll', 'n_intervals')],
+    [State('user-theme-input', 'value'),
+     State('mode-select', 'value'),
+     State('variant-count', 'value'),
+     State('job-id', 'data')]
 )
-def generate_and_display_prompt(selected_style, user_theme):
+def generate_and_display_prompt(selection, n_intervals, user_theme, mode, variant_count, job_id):
+    ctx = dash.callback_context
+    trigger_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+
+    # 轮询触发：从任务表读取当前阶段与中间结果
+    if trigger_id == 'job-poll':
+        job = jobs.job_store.get(job_id) if job_id else None
+        if job is None:
+            return (dash.no_update,) * 6 + (None, True, dash.no_update)
+        return _job_outputs(job) + (_variant_cards(job['result']),)
     
-    if not selected_style:
-        return "等待生成...", "", "", "", "", ""
+    if not selection:
+        return "等待生成...", "", "", "", "", "", None, True, []
+    selected_style = selection.get('style')
+    if selected_style not in style_registry.table().by_key:
+        # 页面打开后该风格已从注册表中移除
+        return "❌ 未知风格，请刷新页面后重试。", "N/A", "N/A", "N/A", "N/A", "N/A", None, True, []
+    # 为这次点击分配请求 ID，贯穿后台任务与两次上游调用的追踪日志
+    request_id = metrics.new_request_id()
+    metrics.STYLE_CLICKS.inc(style=selected_style)
+    with metrics.trace_context(request_id):
+        metrics.log_event('click', style=selected_style)
     
     if not user_theme or not user_theme.strip():
         error_msg = "❌ 请在上方文本框中输入您的核心主题描述！"
-        return error_msg, "N/A", "N/A", "N/A", "N/A", "N/A"
-    
-    title_text = f"⚙️ 正在执行【DeepSeek 创意生成】... (风格: {selected_style})"
-    
-    raw_chinese_prompt, gen_error = ai_generate_raw_prompt(selected_style, user_theme)
-    
-    if gen_error:
-        error_msg = f"❌ AI 创意生成失败: {gen_error}"
-        return error_msg, "N/A", "N/A", "N/A", "N/A", "N/A"
-    
-    title_text = f"⚙️ 正在执行【DeepSeek 专业格式化】..."
-    
-    structured_data, format_error = deepseek_format_prompt(raw_chinese_prompt)
-    
-    if format_error:
-        error_msg = f"❌ DeepSeek 格式化失败: {format_error}"
-        return error_msg, raw_chinese_prompt, "N/A", "N/A", "N/A", "N/A"
+        return error_msg, "N/A", "N/A", "N/A", "N/A", "N/A", None, True, []
 
-    final_tag = structured_data.get('final_tag', 'N/A')
-    final_natural = structured_data.get('final_natural', 'N/A')
-    final_chinese_natural = structured_data.get('final_chinese_natural', 'N/A')
-    final_negative = structured_data.get('final_negative', 'N/A')
-    
-    final_title = f"✅ 最终提示词输出：{selected_style} 风格 (主题已整合)"
-    
-    return (
-        final_title,
-        raw_chinese_prompt,
-        final_tag,
-        final_natural,
-        final_chinese_natural,
-        final_negative
-    )
+    variant_count = min(max(int(variant_count or 1), 1), VARIANT_MAX)
+
+    # 用户点击了新的风格按钮：取消本页面上一个尚未完成的任务，并归还它的排队票据
+    if job_id:
+        _cancel_job(job_id)
+
+    # 准入控制：等待队列已满或该客户端请求过多时立即拒绝，而不是让请求堆积到上游
+    client, ticket = _client_id(), metrics.new_request_id()
+    rejected = admission.controller.enqueue(ticket, client)
+    if rejected:
+        return f"❌ 服务繁忙：{rejected}", "N/A", "N/A", "N/A", "N/A", "N/A", None, True, []
+
+    if not BACKGROUND_JOBS_ENABLED:
+        # 同步回退：在回调中直接执行两个阶段
+        with metrics.trace_context(request_id):
+            try:
+                admission.controller.wait_for_turn(ticket, client)
+                if variant_count > 1:
+                    result = run_variant_pipeline(selected_style, user_theme, variant_count)
+                else:
+                    result = run_generation_pipeline(selected_style, user_theme, mode=mode)
+                _record_history(selected_style, user_theme, result, _history_owner())
+            except admission.AdmissionRejected as e:
+                result = _rejected_result(mode, e)
+            finally:
+                admission.controller.release(ticket)
+        return _as_outputs(result) + (None, True, _variant_cards(result) if 'variants' in result else [])
+
+    new_job_id = job_runner.submit('generate', {'style': selected_style, 'theme': user_theme, 'mode': mode,
+                                                'variants': variant_count, 'request_id': request_id, 'ticket': ticket,
+                                                'client': client, 'owner': _history_owner()}, job_task)
+    if new_job_id is None:
+        admission.controller.release(ticket)
+        return "❌ 服务繁忙：生成队列已满，请稍后再试。", "N/A", "N/A", "N/A", "N/A", "N/A", None, True, []
+
+    title_text = f"⏳ 已提交任务，等待执行... (风格: {selected_style})"
+    return title_text, "", "", "", "", "", new_job_id, False, []
+
+_HISTORY_OWNER_RE = re.compile(r'[A-Za-z0-9_-]{32}')
+
+def _history_owner() -> str:
+    """当前浏览器的历史归属标识：Cookie 中没有或格式不对时签发一个新的随机值，由 after_request 写回"""
+    owner = flask.g.get('history_owner')
+    if owner is None:
+        owner = flask.request.cookies.get(HISTORY_COOKIE, '')
+        if not _HISTORY_OWNER_RE.fullmatch(owner):
+            owner = secrets.token_urlsafe(24)
+            flask.g.history_owner_issued = True
+        flask.g.history_owner = owner
+    return owner
+
+@server.after_request
+def _issue_history_cookie(response):
+    if flask.g.get('history_owner_issued'):
+        response.set_cookie(HISTORY_COOKIE, flask.g.history_owner, max_age=HISTORY_COOKIE_MAX_AGE, httponly=True,
+                            samesite='Lax', secure=flask.request.is_secure)
+    return response
+
+def _history_client() -> Optional[str]:
+    """历史面板只显示当前浏览器的记录 (HISTORY_SHARED=1 时显示全部)"""
+    return None if HISTORY_SHARED else _history_owner()
+
+def history_item(record: Dict[str, Any]):
+    created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['ts']))
+    return dbc.ListGroupItem([
+        html.Div([
+            html.Strong(f"#{record['id']} · {record['style']}"),
+            html.Small(f"  {created} · {record['mode']}", className="text-muted"),
+            dbc.Button("载入", id={'type': 'history-load', 'index': record['id']}, size="sm", color="primary",
+                       outline=True, className="float-end"),
+        ]),
+        html.Div(record['theme'], className="small mt-1"),
+        html.Div(record['final_tag'], className="small text-muted", style={"font-family": "monospace", "white-space": "pre-wrap"}),
+    ])
+
+@callback(
+    [Output('history-list', 'children'),
+     Output('history-page', 'data'),
+     Output('history-prev', 'disabled'),
+     Output('history-next', 'disabled')],
+    [Input('history-prev', 'n_clicks'),
+     Input('history-next', 'n_clicks'),
+     Input('history-style', 'value'),
+     Input('history-range', 'value'),
+     Input('history-search', 'value'),
+     Input('job-id', 'data')],
+    [State('history-page', 'data')]
+)
+def browse_history(prev_clicks, next_clicks, style, time_range, search, job_id, page):
+    if not history.HISTORY_ENABLED:
+        return "生成历史未启用 (HISTORY=0)。", 0, True, True
+    ctx = dash.callback_context
+    trigger_id = ctx.triggered[0]['prop_id'].split('.')[0] if ctx.triggered else None
+    if trigger_id == 'history-next':
+        page = (page or 0) + 1
+    elif trigger_id == 'history-prev':
+        page = max((page or 0) - 1, 0)
+    else:
+        # 筛选条件变化或有新的生成完成：回到第一页
+        page = 0
+
+    since = time.time() - HISTORY_RANGES[time_range][1] if time_range in HISTORY_RANGES else None
+    records, has_more = history.history_store.query(
+        style=style or None, client=_history_client(), since=since, text=(search or '').strip() or None,
+        offset=page * history.HISTORY_PAGE_SIZE, limit=history.HISTORY_PAGE_SIZE)
+    if not records:
+        return "暂无历史记录。", page, page == 0, True
+    return dbc.ListGroup([history_item(record) for record in records]), page, page == 0, not has_more
+
+@callback(
+    [Output('result-title', 'children', allow_duplicate=True),
+     Output('output-raw-prompt', 'children', allow_duplicate=True),
+     Output('output-tag', 'children', allow_duplicate=True),
+     Output('output-natural', 'children', allow_duplicate=True),
+     Output('output-chinese-natural', 'children', allow_duplicate=True),
+     Output('output-negative', 'children', allow_duplicate=True),
+     Output('variant-cards', 'children', allow_duplicate=True)],
+    [Input({'type': 'history-load', 'index': ALL}, 'n_clicks')],
+    prevent_initial_call=True
+)
+def load_history_entry(n_clicks):
+    # 历史列表重新渲染时新按钮的 n_clicks 为 None，也会触发本回调
+    if not dash.callback_context.triggered_id or not any(n_clicks):
+        return (dash.no_update,) * 7
+    record = history.history_store.get(dash.callback_context.triggered_id['index'], client=_history_client())
+    if record is None:
+        return "❌ 该历史记录不存在或已过期。", "N/A", "N/A", "N/A", "N/A", "N/A", []
+    created = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(record['ts']))
+    return (f"📜 历史记录 #{record['id']}：{record['style']} 风格 ({created})", record['raw'], record['final_tag'],
+            record['final_natural'], record['final_chinese_natural'], record['final_negative'], [])
+
+# ==============================================================================
+# 5.5 运维接口
+# ==============================================================================
+
+@server.route('/metrics')
+def metrics_endpoint():
+    """Prometheus 抓取接口：各阶段延迟直方图、上游状态码、超时、进行中的请求以及按风格的统计"""
+    job_counts = jobs.job_store.counts()
+    extra_gauges = {
+        'prompt_jobs': ("任务表中各状态的任务数 (所有 worker 共享)",
+                        {(('status', status),): count for status, count in job_counts.items()}),
+        'prompt_job_queue_depth': ("本 worker 进程内已提交但尚未结束的任务数",
+                                   {(('pid', str(os.getpid())),): job_runner.queue_depth}),
+        'prompt_circuit_breaker_open': ("本 worker 进程的上游熔断器是否打开 (1 为打开)",
+                                        {(('pid', str(os.getpid())),): int(llm_client.breaker.state == 'open')}),
+    }
+    if admission.ADMISSION_ENABLED:
+        snapshot = admission.controller.snapshot()
+        extra_gauges['prompt_admission_tickets'] = ("准入控制中各状态的票据数 (所有 worker 共享)",
+                                                    {(('status', 'active'),): snapshot['active'],
+                                                     (('status', 'waiting'),): snapshot['waiting']})
+        extra_gauges['prompt_admission_bucket_available'] = ("上游令牌桶当前可用量",
+                                                             {(('bucket', name),): bucket['available']
+                                                              for name, bucket in snapshot['buckets'].items()})
+    return flask.Response(metrics.render(extra_gauges), mimetype='text/plain; version=0.0.4')
+
+@server.route('/api/cache-stats')
+def cache_stats_endpoint():
+    """两级缓存的命中/未命中计数 (当前 worker 进程)"""
+    return flask.jsonify(cache.cache_stats())
+
+@server.route('/api/pipeline-stats')
+def pipeline_stats_endpoint():
+    """两阶段与单次融合模式的端到端耗时并排对比 (当前 worker 进程)"""
+    return flask.jsonify(pipeline_stats())
+
+@server.route('/api/tag-index-stats')
+def tag_index_stats_endpoint():
+    """本地标签索引的覆盖率、格式化路径占比与估算节省的延迟 (当前 worker 进程)"""
+    return flask.jsonify(tag_index.stats())
+
+@server.route('/api/styles')
+def styles_endpoint():
+    """当前 worker 加载的风格注册表 (版本为文件修改时间，reloads 为热加载次数)"""
+    table = style_registry.table()
+    return flask.jsonify({'version': table.version, 'reloads': style_registry.reloads,
+                          'styles': [{'key': style.key, 'label': style.label, 'group': style.group,
+                                      'negative_profile': style.negative_profile} for style in table.styles]})
+
+@server.route('/api/structured-output-stats')
+def structured_output_stats_endpoint():
+    """JSON 直接解析 / 本地修复 / 追问补键的次数与比例"""
+    return flask.jsonify(structured_output.stats())
+
+@server.route('/api/usage')
+def usage_endpoint():
+    """按风格 × 阶段汇总的 token 用量、上下文缓存命中率与估算费用 (当前 worker 进程)"""
+    return flask.jsonify(usage.snapshot())
+
+@server.route('/api/admission-stats')
+def admission_stats_endpoint():
+    """准入控制：执行中/排队中的票据数、排队客户端数与上游令牌桶余量 (所有 worker 共享)"""
+    return flask.jsonify(admission.controller.snapshot())
+
+@server.route('/api/jobs/stats')
+def job_stats_endpoint():
+    """任务队列深度、各状态数量以及最近任务的平均分阶段耗时"""
+    return flask.jsonify({
+        'runner': 'async' if ASYNC_MODE_ENABLED else 'thread',
+        'queue_depth': job_runner.queue_depth,
+        'workers': job_runner.workers,
+        'queue_limit': job_runner.queue_limit,
+        'counts': jobs.job_store.counts(),
+        'recent': jobs.job_store.recent_timings(),
+    })
+
+# 任务参数中不随 GET /api/jobs/<id> 返回的字段
+JOB_PRIVATE_PARAMS = frozenset({'owner', 'client', 'ticket'})
+
+@server.route('/api/jobs/<job_id>', methods=['GET', 'DELETE'])
+def job_endpoint(job_id):
+    """查询单个任务的状态、结果与耗时；DELETE 取消任务 (只能取消当前浏览器提交的任务)"""
+    job = jobs.job_store.get(job_id)
+    if job is None:
+        return flask.jsonify({'error': 'job not found'}), 404
+    if flask.request.method == 'DELETE':
+        owner = job['params'].get('owner')
+        if not owner or not secrets.compare_digest(owner, _history_owner()):
+            return flask.jsonify({'error': 'forbidden'}), 403
+        return flask.jsonify({'cancelled': _cancel_job(job_id, job)})
+    # 历史归属标识是浏览器 Cookie 的值，客户端地址与票据同样不对外公开
+    job['params'] = {k: v for k, v in job['params'].items() if k not in JOB_PRIVATE_PARAMS}
+    return flask.jsonify(job)
+
+@server.route('/api/history')
+def history_endpoint():
+    """分页查询生成历史 (时间倒序)：?style=&since=&until=&q=&offset=&limit=，since/until 为 Unix 时间戳"""
+    args = flask.request.args
+    records, has_more = history.history_store.query(
+        style=args.get('style') or None, client=_history_client(), since=args.get('since', type=float),
+        until=args.get('until', type=float), text=args.get('q') or None,
+        offset=max(0, args.get('offset', default=0, type=int)),
+        limit=max(1, min(args.get('limit', default=history.HISTORY_PAGE_SIZE, type=int), 100)))
+    return flask.jsonify({'items': records, 'has_more': has_more})
+
+@server.route('/api/history/<int:entry_id>')
+def history_entry_endpoint(entry_id):
+    record = history.history_store.get(entry_id, client=_history_client())
+    if record is None:
+        return flask.jsonify({'error': 'history entry not found'}), 404
+    return flask.jsonify(record)
+
+@server.route('/api/history/stats')
+def history_stats_endpoint():
+    """历史分段数、记录数、占用字节与时间跨度 (所有 worker 共享)"""
+    return flask.jsonify(history.history_store.stats())
+
+@server.route('/api/batch', methods=['POST'])
+def batch_endpoint():
+    """批量生成：请求体为 JSONL (每行格式同 batch.py 的输入) 或 {"items": [...]}，
+    以 chunked NDJSON 按完成顺序流式返回每个条目，最后一行为 {"summary": ...}"""
+    body = flask.request.get_json(silent=True)
+    if isinstance(body, dict) and isinstance(body.get('items'), list):
+        rows = body['items']
+    else:
+        # 无法解析的行、未知风格等各自返回一条失败记录，其余条目照常执行
+        rows = list(batch.parse_lines(flask.request.get_data(as_text=True).splitlines()))
+    concurrency = flask.request.args.get('concurrency', default=batch.BATCH_DEFAULT_CONCURRENCY, type=int)
+    if admission.ADMISSION_ENABLED:
+        # 每个并发条目占用一个该客户端的排队名额，超出单客户端上限的部分只会被拒绝
+        concurrency = min(concurrency, admission.PER_CLIENT_LIMIT)
+    pipeline = admitted_batch_pipeline(_client_id())
+
+    def generate():
+        summary = batch.BatchSummary()
+        for record in batch.iter_batch(batch.expand_items(rows, style_registry.table().by_key), pipeline, concurrency):
+            summary.add(record)
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+        yield json.dumps({'summary': summary.as_dict()}, ensure_ascii=False) + '\n'
+
+    return flask.Response(flask.stream_with_context(generate()), mimetype='application/x-ndjson')
+
+# Dash 冷启动竞争的临时绕过 (在 Dash 4.4.1 上复现，requirements.txt 未锁定版本)：
+# Dash.\_setup_server 在每个 worker 收到第一个请求时才执行，它先置位 _got_first_request["setup_server"]，
+# 再校验布局、生成脚本，最后才把 @callback 注册的回调复制进 callback_map。worker 刚启动时并发到达的回调请求
+# 看到标记已置位就跳过初始化，在尚为空的 callback_map 中查找回调，抛出 KeyError 并返回 500
+# (benchmark.py dash 在冷启动的 gthread worker 上稳定复现)。这里在所有回调注册完成后、导入时就完成初始化，
+# 之后的请求不再进入这段逻辑。调用的是私有方法：升级 Dash 后若该方法不存在则跳过，
+# Dash 改为在初始化完成后才置位标记时即可删除这段代码。
+if hasattr(app, '_setup_server'):
+    with server.test_request_context():
+        app._setup_server()
 
 # ==============================================================================
 # 6. 运行应用
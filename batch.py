@@ -0,0 +1,235 @@
+"""批量生成：从 JSONL 读取 主题 × 风格，按有界并发运行两阶段流水线，结果逐条写入 JSONL。
+
+输入每行一个 JSON 对象，例如：
+    {"id": "goddess", "theme": "手持旗帜的女神，站在战场废墟上", "styles": ["NORMAL", "ARTISTIC"]}
+    {"theme": "一位穿着紧身宇航服的女性，漂浮在太空中", "style": "GRAND_SFW", "mode": "fused"}
+
+styles 可以是字符串数组或逗号分隔的字符串；mode 可选 "two_pass" (默认) 或 "fused" (单次融合调用)。
+无法解析的行、缺少字段的行和未知风格各自产出一条失败记录，不会中断整批任务。
+
+用法：
+    python batch.py themes.jsonl -o results.jsonl -c 4
+
+输出文件同时作为断点：重新运行同一命令时，已成功的条目会被跳过，失败的条目会重试。
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Container, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set
+
+BATCH_DEFAULT_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '16'))
+
+# pipeline(style, theme, mode) -> 结果字典 (含 'error' 字段，失败时非空)；mode 为 None 时使用默认模式
+Pipeline = Callable[[str, str, Optional[str]], Dict[str, Any]]
+
+
+class InvalidLine(NamedTuple):
+    """无法解析为 JSON 的输入行，由 expand_items 转为一条失败记录。"""
+    error: str
+
+
+def _invalid(row_id: str, reason: str, theme: str = '') -> Dict[str, Any]:
+    return {'id': f"{row_id}:?", 'style': None, 'theme': theme, 'invalid': reason}
+
+
+def _row_styles(row: Dict[str, Any]) -> Optional[List[str]]:
+    """行中的风格列表 (去重、保持顺序)；格式不对时返回 None。"""
+    styles = row.get('styles') if row.get('styles') is not None else row.get('style')
+    if isinstance(styles, str):
+        styles = [style.strip() for style in styles.split(',') if style.strip()]
+    if not isinstance(styles, list) or not styles or not all(isinstance(style, str) and style for style in styles):
+        return None
+    return list(dict.fromkeys(styles))
+
+
+def expand_items(rows: Iterable[Any], known_styles: Optional[Container[str]] = None) -> Iterator[Dict[str, Any]]:
+    """把每行的 主题 × 风格 展开为独立条目，条目 ID 为 "<行ID>:<风格>"。
+
+    格式错误的行产出一个带 invalid 字段的条目；给出 known_styles 时，不在其中的风格同样作为失败条目，
+    而不是按未知风格的默认说明静默生成。
+    """
+    for line_no, row in enumerate(rows, start=1):
+        if isinstance(row, InvalidLine):
+            yield _invalid(str(line_no), row.error)
+            continue
+        if not isinstance(row, dict):
+            yield _invalid(str(line_no), "每行必须是一个 JSON 对象")
+            continue
+        row_id = str(row.get('id', line_no))
+        theme = row.get('theme').strip() if isinstance(row.get('theme'), str) else ''
+        styles = _row_styles(row)
+        if not theme or not styles:
+            yield _invalid(row_id, "每行必须包含 theme 以及 style 或 styles (字符串或字符串数组)", theme)
+            continue
+        for style in styles:
+            item = {'id': f"{row_id}:{style}", 'style': style, 'theme': theme, 'mode': row.get('mode')}
+            if known_styles is not None and style not in known_styles:
+                item['invalid'] = f"未知风格: {style}"
+            yield item
+
+
+def parse_lines(lines: Iterable[str]) -> Iterator[Any]:
+    """逐行解析 JSONL (跳过空行)；无法解析的行产出 InvalidLine 而不是抛出异常。"""
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            yield InvalidLine(f"无效的 JSON: {e}")
+
+
+def read_jsonl(path: str) -> Iterator[Any]:
+    with open(path, encoding='utf-8') as f:
+        yield from parse_lines(f)
+
+
+def load_checkpoint(path: str) -> Set[str]:
+    """读取已有输出文件中成功完成的条目 ID。"""
+    done: Set[str] = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # 上次运行被中断时最后一行可能不完整
+                continue
+            if record.get('ok'):
+                done.add(record['id'])
+    return done
+
+
+def _run_item(pipeline: Pipeline, item: Dict[str, Any]) -> Dict[str, Any]:
+    record: Dict[str, Any] = {'id': item['id'], 'style': item['style'], 'theme': item['theme'], 'mode': item.get('mode')}
+    if item.get('invalid'):
+        return dict(record, ok=False, error=item['invalid'], latency=0.0)
+    started = time.perf_counter()
+    try:
+        result = pipeline(item['style'], item['theme'], item.get('mode'))
+    except Exception as e:
+        return dict(record, ok=False, error=f"{type(e).__name__}: {e}", latency=round(time.perf_counter() - started, 3))
+    record.update(
+        mode=result.get('mode', item.get('mode')),
+        ok=not result.get('error'),
+        error=result.get('error'),
+        fallback=result.get('fallback'),
+        latency=round(time.perf_counter() - started, 3),
+        timings=result.get('timings'),
+        raw=result.get('raw'),
+        final_tag=result.get('final_tag'),
+        final_natural=result.get('final_natural'),
+        final_chinese_natural=result.get('final_chinese_natural'),
+        final_negative=result.get('final_negative'),
+    )
+    return record
+
+
+def iter_batch(items: Iterable[Dict[str, Any]], pipeline: Pipeline, concurrency: int,
+               stop: Optional[threading.Event] = None) -> Iterator[Dict[str, Any]]:
+    """以最多 concurrency 个并发执行条目，按完成顺序逐条产出结果记录。
+
+    条目按需从 items 中拉取，因此输入可以是任意长的惰性迭代器。设置 stop 后不再提交新条目。
+    """
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    source = iter(items)
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='batch') as executor:
+        pending = set()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < concurrency and not (stop and stop.is_set()):
+                item = next(source, None)
+                if item is None:
+                    exhausted = True
+                    break
+                pending.add(executor.submit(_run_item, pipeline, item))
+            if not pending:
+                return
+            finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+
+
+class BatchSummary:
+    """累计吞吐与延迟统计。"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.latencies: List[float] = []
+        self.ok = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def add(self, record: Dict[str, Any]) -> None:
+        self.latencies.append(record.get('latency') or 0.0)
+        if record.get('ok'):
+            self.ok += 1
+        else:
+            self.failed += 1
+
+    def as_dict(self) -> Dict[str, Any]:
+        elapsed = time.perf_counter() - self.started
+        ordered = sorted(self.latencies)
+
+        def percentile(p: float) -> float:
+            if not ordered:
+                return 0.0
+            return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))], 3)
+
+        completed = self.ok + self.failed
+        return {
+            'ok': self.ok, 'failed': self.failed, 'skipped': self.skipped,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_per_minute': round(completed / elapsed * 60, 2) if elapsed > 0 else 0.0,
+            'latency_p50': percentile(0.50), 'latency_p95': percentile(0.95),
+            'latency_max': round(ordered[-1], 3) if ordered else 0.0,
+        }
+
+
+def run_batch_file(input_path: str, output_path: str, pipeline: Pipeline, concurrency: int,
+                   known_styles: Optional[Container[str]] = None) -> Dict[str, Any]:
+    """CLI 主流程：跳过断点中已完成的条目，结果每完成一条就追加写入并落盘。"""
+    done = load_checkpoint(output_path)
+    summary = BatchSummary()
+
+    def remaining():
+        for item in expand_items(read_jsonl(input_path), known_styles):
+            if item['id'] in done:
+                summary.skipped += 1
+                continue
+            yield item
+
+    with open(output_path, 'a', encoding='utf-8') as out:
+        for record in iter_batch(remaining(), pipeline, concurrency):
+            out.write(json.dumps(record, ensure_ascii=False) + '\n')
+            out.flush()
+            summary.add(record)
+            status = '✅' if record['ok'] else f"❌ {record['error']}"
+            print(f"[{summary.ok + summary.failed}] {record['id']} {record['latency']:.1f}s {status}", file=sys.stderr)
+    return summary.as_dict()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="批量生成提示词 (主题 × 风格)，结果以 JSONL 流式写出")
+    parser.add_argument('input', help="输入 JSONL 文件")
+    parser.add_argument('-o', '--output', required=True, help="输出 JSONL 文件 (同时作为断点续跑的检查点)")
+    parser.add_argument('-c', '--concurrency', type=int, default=BATCH_DEFAULT_CONCURRENCY, help="并发条目数")
+    args = parser.parse_args(argv)
+
+    # 延迟导入：app 模块在导入时会初始化 Dash 应用
+    from app import batch_pipeline, style_registry
+
+    summary = run_batch_file(args.input, args.output, batch_pipeline, args.concurrency, style_registry.table().by_key)
+    print(json.dumps({'summary': summary}, ensure_ascii=False), file=sys.stderr)
+    return 0 if summary['failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
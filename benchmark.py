@@ -0,0 +1,569 @@
+"""压测工具：以受控并发驱动 Dash 回调 (_dash-update-component) 与 /api/batch，报告 p50/p95/p99 延迟与吞吐。
+
+场景：
+    dash   模拟浏览器：提交生成回调 → 按 JOB_POLL_INTERVAL_MS 轮询任务直到完成，
+           分别统计 提交回调、轮询回调 的 HTTP 延迟以及点击到结果的端到端延迟
+    batch  POST /api/batch，统计每个条目的流水线延迟、首行到达时间与条目吞吐
+
+用法：
+    # 对已经运行的实例压测 (上游应指向 mock_deepseek.py，避免消耗真实额度)
+    python benchmark.py dash --url http://127.0.0.1:9989 -c 16 -n 200
+    python benchmark.py batch --url http://127.0.0.1:9989 -n 64 --batch-concurrency 8
+
+    # 矩阵模式：自动启动替身服务，再依次以不同 gunicorn worker 类型 × 数量启动应用并压测
+    python benchmark.py matrix --worker-classes sync,gthread --workers 1,2,4 -c 16 -n 200 \\
+        --mock-args="--latency lognormal:1.0,0.4 --rate-limit-rate 0.02" --json results.json
+
+    # 风格按钮回调：旧版逐个 Input 与模式匹配回调在风格数增长时的请求大小与分发耗时 (进程内，不启动应用)
+    python benchmark.py styles --style-counts 30,100,300,1000 --clicks 200
+
+    # 线程池任务模式 vs 异步模式 (ASYNC_MODE=1)：同样的并发用户数下比较延迟与内存
+    python benchmark.py matrix --async-modes 0,1 --worker-classes gthread --workers 1 -c 200 -n 400 \\
+        --poll-interval 1 --env JOB_WORKERS=200 --env JOB_QUEUE_LIMIT=1000 --env ADMISSION=0
+
+准入控制 (admission.py) 默认按 DEEPSEEK_RPM/DEEPSEEK_TPM 限速并限制同时执行的生成数；测应用自身容量时可用
+--env ADMISSION=0 关闭，测限流与排队行为时用 --env DEEPSEEK_RPM=60 --env ADMISSION_MAX_ACTIVE=4 之类的小值。
+本地标签索引 (tag_index.py) 默认关闭，开启后覆盖率高时格式化调用只需输出自然语言描述；与原始两次调用对比时分别以
+默认配置和 --env TAG_INDEX=1 各跑一次，各路径占比与节省的延迟见应用的 /api/tag-index-stats。
+
+矩阵模式会在压测期间采样 gunicorn 全部进程的常驻内存 (RSS) 峰值，并给出每 GB 内存可承载的并发用户数。
+
+矩阵模式默认以 --keep-alive 10 启动 gunicorn。gunicorn 默认只保持空闲连接 2 秒，而虚拟用户每次轮询之间
+要空闲 --poll-interval 秒，再加上 CPU 饱和时客户端线程的调度延迟，空闲时间经常接近 2 秒。此时服务端关闭连接与
+客户端在同一连接上发出下一次 POST 会撞在一起，requests 不会重试 POST，于是记为 ConnectionError
+(RemoteDisconnected / Connection reset)。浏览器遇到复用连接被关闭时会自动重发，而且前端轮询间隔只有 250ms，
+所以这类错误是压测客户端的假象，不是应用的错误。
+"""
+import argparse
+import itertools
+import json
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+
+# 与 app.py 中生成回调的输出顺序保持一致
+DASH_OUTPUTS = (
+    ('result-title', 'children'), ('output-raw-prompt', 'children'), ('output-tag', 'children'),
+    ('output-natural', 'children'), ('output-chinese-natural', 'children'), ('output-negative', 'children'),
+    ('job-id', 'data'), ('job-poll', 'disabled'), ('variant-cards', 'children'),
+)
+DEFAULT_THEME = "一位穿着紧身宇航服的女性，漂浮在太空中"
+DEFAULT_POLL_INTERVAL = 0.25
+FAILED_TITLE_PREFIXES = ('❌', '⛔')
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(ordered: List[float], p: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+
+class LatencyRecorder:
+    """线程安全地收集多组延迟样本。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples: Dict[str, List[float]] = {}
+        self.errors: Dict[str, int] = {}
+
+    def add(self, name: str, seconds: float) -> None:
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def error(self, reason: str) -> None:
+        with self._lock:
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+
+    def summary(self, elapsed: float) -> Dict[str, Any]:
+        with self._lock:
+            groups = {name: sorted(values) for name, values in self.samples.items()}
+            errors = dict(self.errors)
+        report: Dict[str, Any] = {'elapsed_seconds': round(elapsed, 3), 'errors': errors, 'latency': {}}
+        for name, ordered in groups.items():
+            report['latency'][name] = {
+                'count': len(ordered),
+                'rps': round(len(ordered) / elapsed, 2) if elapsed > 0 else 0.0,
+                'mean': round(sum(ordered) / len(ordered), 4),
+                'p50': round(percentile(ordered, 0.50), 4),
+                'p95': round(percentile(ordered, 0.95), 4),
+                'p99': round(percentile(ordered, 0.99), 4),
+                'max': round(ordered[-1], 4),
+            }
+        return report
+
+
+def run_closed_loop(total: int, concurrency: int, one: Callable[[int], None]) -> float:
+    """concurrency 个虚拟用户循环执行 one(i)，直到总共完成 total 次；返回总耗时。"""
+    counter = iter(range(total))
+    counter_lock = threading.Lock()
+
+    def user():
+        while True:
+            with counter_lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            one(i)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='vu') as executor:
+        for future in [executor.submit(user) for _ in range(concurrency)]:
+            future.result()
+    return time.perf_counter() - started
+
+
+# ------------------------------------------------------------------------------
+# 场景：Dash 回调
+# ------------------------------------------------------------------------------
+
+def dash_payload(trigger: str, selection: Optional[Dict[str, Any]], n_intervals: int,
+                 theme: str, mode: str, job_id: Optional[str]) -> Dict[str, Any]:
+    return {
+        'output': '..' + '...'.join(f"{cid}.{prop}" for cid, prop in DASH_OUTPUTS) + '..',
+        'outputs': [{'id': cid, 'property': prop} for cid, prop in DASH_OUTPUTS],
+        'inputs': [{'id': 'style-store', 'property': 'data', 'value': selection},
+                   {'id': 'job-poll', 'property': 'n_intervals', 'value': n_intervals}],
+        'changedPropIds': [trigger],
+        'state': [{'id': 'user-theme-input', 'property': 'value', 'value': theme},
+                  {'id': 'mode-select', 'property': 'value', 'value': mode},
+                  {'id': 'variant-count', 'property': 'value', 'value': 1},
+                  {'id': 'job-id', 'property': 'data', 'value': job_id}],
+    }
+
+
+def _post_callback(session: requests.Session, url: str, payload: Dict[str, Any],
+                   recorder: LatencyRecorder, name: str, timeout: float) -> Optional[Dict[str, Any]]:
+    started = time.perf_counter()
+    try:
+        response = session.post(f"{url}/_dash-update-component", json=payload, timeout=timeout)
+    except requests.RequestException as e:
+        recorder.error(f"{name}:{type(e).__name__}")
+        return None
+    recorder.add(name, time.perf_counter() - started)
+    if response.status_code == 204:
+        return {}
+    if response.status_code != 200:
+        recorder.error(f"{name}:http_{response.status_code}")
+        return None
+    return response.json().get('response', {})
+
+
+def run_dash_scenario(url: str, total: int, concurrency: int, styles: List[str], theme: str, mode: str,
+                      poll_interval: float, timeout: float) -> Dict[str, Any]:
+    """每个虚拟用户：点击 (提交回调) → 轮询直到 job-poll 被禁用，与浏览器的行为一致。"""
+    recorder = LatencyRecorder()
+    local = threading.local()
+    client_ids = itertools.count(1)
+
+    def one(i: int) -> None:
+        session = getattr(local, 'session', None)
+        if session is None:
+            # 每个并发槽位模拟一个独立客户端，否则所有请求都来自 127.0.0.1，会被准入控制的单客户端上限拒绝。
+            # 应用只在 TRUSTED_PROXY_HOPS>=1 时采信该头 (矩阵模式自动设置)；直接压测已运行的实例时需同样设置，
+            # 或用 ADMISSION_PER_CLIENT 放宽单客户端上限
+            session = local.session = requests.Session()
+            client = next(client_ids)
+            session.headers['X-Forwarded-For'] = f"10.{client >> 16 & 255}.{client >> 8 & 255}.{client & 255}"
+        # 与前端 clientside 回调写入 style-store 的内容一致
+        selection = {'style': styles[i % len(styles)], 'clicked_at': int(time.time() * 1000)}
+        started = time.perf_counter()
+        response = _post_callback(session, url, dash_payload('style-store.data', selection, 0, theme, mode, None),
+                                  recorder, 'submit_callback', timeout)
+        polls = 0
+        # 任务运行期间轮询回调不再回写 job-id (避免前端重复触发)，沿用提交时返回的任务 ID
+        job_id = response.get('job-id', {}).get('data') if response else None
+        while response is not None and not response.get('job-poll', {}).get('disabled', True):
+            if time.perf_counter() - started > timeout:
+                recorder.error('e2e:timeout')
+                return
+            time.sleep(poll_interval)
+            polls += 1
+            polled = _post_callback(session, url, dash_payload('job-poll.n_intervals', selection, polls, theme, mode, job_id),
+                                    recorder, 'poll_callback', timeout)
+            # 单次轮询失败不放弃，沿用上一次的状态继续轮询
+            response = polled if polled else response
+        if response is None:
+            return
+        title = str(response.get('result-title', {}).get('children', ''))
+        if title.startswith(FAILED_TITLE_PREFIXES):
+            recorder.error(f"generation:{title[:40]}")
+            return
+        recorder.add('end_to_end', time.perf_counter() - started)
+
+    elapsed = run_closed_loop(total, concurrency, one)
+    return recorder.summary(elapsed)
+
+
+# ------------------------------------------------------------------------------
+# 场景：批量接口
+# ------------------------------------------------------------------------------
+
+def run_batch_scenario(url: str, total: int, batch_concurrency: int, styles: List[str], theme: str, mode: str,
+                       timeout: float) -> Dict[str, Any]:
+    recorder = LatencyRecorder()
+    items = [{'id': f"bench-{i}", 'theme': theme, 'style': styles[i % len(styles)], 'mode': mode} for i in range(total)]
+    started = time.perf_counter()
+    summary = None
+    try:
+        with requests.post(f"{url}/api/batch", params={'concurrency': batch_concurrency}, json={'items': items},
+                           stream=True, timeout=timeout) as response:
+            if response.status_code != 200:
+                recorder.error(f"http_{response.status_code}")
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                record = json.loads(line)
+                if 'summary' in record:
+                    summary = record['summary']
+                    continue
+                if 'first_record' not in recorder.samples:
+                    recorder.add('first_record', time.perf_counter() - started)
+                if record.get('ok'):
+                    recorder.add('item', record.get('latency') or 0.0)
+                else:
+                    recorder.error(f"item:{str(record.get('error'))[:40]}")
+    except requests.RequestException as e:
+        recorder.error(type(e).__name__)
+    report = recorder.summary(time.perf_counter() - started)
+    report['server_summary'] = summary
+    return report
+
+
+# ------------------------------------------------------------------------------
+# 矩阵模式：启动替身服务与 gunicorn
+# ------------------------------------------------------------------------------
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _wait_ready(url: str, timeout: float = 30.0) -> bool:
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code < 500:
+                return True
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    return False
+
+
+def _process_tree_rss_mb(root_pid: int) -> float:
+    """root_pid 及其全部子进程的 RSS 总和 (MB)，读取 /proc，仅支持 Linux。"""
+    children: Dict[int, List[int]] = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # 第 4 个字段是父进程 PID；进程名可能含空格，从最后一个 ')' 之后开始切分
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    total_kb = 0
+    stack = [root_pid]
+    while stack:
+        pid = stack.pop()
+        stack.extend(children.get(pid, []))
+        try:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total_kb += int(line.split()[1])
+        except OSError:
+            continue
+    return round(total_kb / 1024, 1)
+
+
+class RssSampler:
+    """压测期间每隔 interval 秒采样一次进程树 RSS，记录峰值。"""
+
+    def __init__(self, root_pid: int, interval: float = 0.5):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+
+    def _loop(self) -> None:
+        while not self._stop.is_set():
+            self.peak_mb = max(self.peak_mb, _process_tree_rss_mb(self.root_pid))
+            self._stop.wait(self.interval)
+
+    def __enter__(self) -> "RssSampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._stop.set()
+        self._thread.join()
+
+
+def _stop(process: subprocess.Popen) -> None:
+    if process.poll() is None:
+        process.send_signal(signal.SIGTERM)
+        try:
+            process.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def run_matrix(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    workdir = tempfile.mkdtemp(prefix='prompt-bench-')
+    mock_port = _free_port()
+    mock = subprocess.Popen([sys.executable, 'mock_deepseek.py', '--port', str(mock_port)] + shlex.split(args.mock_args),
+                            cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        if not _wait_ready(f"http://127.0.0.1:{mock_port}/mock/stats"):
+            raise RuntimeError("替身服务启动失败")
+        configs = [(async_mode, worker_class, int(workers))
+                   for async_mode in args.async_modes.split(',')
+                   for worker_class in args.worker_classes.split(',')
+                   for workers in args.workers.split(',')]
+        extra_env = dict(item.split('=', 1) for item in args.env)
+        for async_mode, worker_class, workers in configs:
+            port = _free_port()
+            tag = f"{worker_class}-w{workers}" + ('-async' if async_mode == '1' else '')
+            env = dict(os.environ,
+                       ASYNC_MODE=async_mode,
+                       DEEPSEEK_API_BASE=f"http://127.0.0.1:{mock_port}/v1/chat/completions",
+                       DEEPSEEK_API_KEY=os.environ.get('DEEPSEEK_API_KEY', 'bench'),
+                       JOB_DB=os.path.join(workdir, f"jobs-{tag}.sqlite3"),
+                       PROMPT_CACHE_DB=os.path.join(workdir, f"cache-{tag}.sqlite3"),
+                       ADMISSION_DB=os.path.join(workdir, f"admission-{tag}.sqlite3"),
+                       HISTORY_DIR=os.path.join(workdir, f"history-{tag}"),
+                       METRICS_DIR=os.path.join(workdir, f"metrics-{tag}"),
+                       PROMPT_CACHE='1' if args.cache else '0',
+                       # 压测客户端充当一层反向代理，为每个虚拟用户写入不同的 X-Forwarded-For
+                       TRUSTED_PROXY_HOPS='1',
+                       TRACE_LOG='0')
+            env.update(extra_env)
+            command = ['gunicorn', '--bind', f"127.0.0.1:{port}", '--workers', str(workers),
+                       '--worker-class', worker_class, '--threads', str(args.threads),
+                       '--timeout', '300', '--keep-alive', str(args.keep_alive)] + shlex.split(args.gunicorn_args) + ['app:server']
+            server = subprocess.Popen(command, env=env, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                url = f"http://127.0.0.1:{port}"
+                if not _wait_ready(f"{url}/_dash-layout", timeout=60):
+                    results.append({'config': tag, 'error': "gunicorn 启动失败"})
+                    print(f"== {tag}: gunicorn 启动失败")
+                    continue
+                idle_rss = _process_tree_rss_mb(server.pid)
+                requests.post(f"http://127.0.0.1:{mock_port}/mock/stats/reset", timeout=5)
+                with RssSampler(server.pid) as sampler:
+                    report = run_scenario(args, url)
+                report.update(config=tag, async_mode=async_mode == '1', worker_class=worker_class, workers=workers,
+                              threads=args.threads, rss_mb_idle=idle_rss, rss_mb_peak=sampler.peak_mb,
+                              upstream=requests.get(f"http://127.0.0.1:{mock_port}/mock/stats", timeout=5).json())
+                # 每 GB 内存可承载的并发用户数 (以压测期间的峰值 RSS 计)，需结合 errors 与延迟一起看
+                report['users_per_gb'] = round(report['concurrency'] / (sampler.peak_mb / 1024), 1) if sampler.peak_mb else None
+                results.append(report)
+                print_report(report)
+            finally:
+                _stop(server)
+    finally:
+        _stop(mock)
+    return results
+
+
+# ------------------------------------------------------------------------------
+# 场景：风格按钮回调的负载与分发耗时 (进程内，不需要启动应用)
+# ------------------------------------------------------------------------------
+
+def _style_callback_payload(inputs: Any, changed: str) -> Dict[str, Any]:
+    return {'output': 'style-store.data', 'outputs': {'id': 'style-store', 'property': 'data'},
+            'inputs': inputs, 'changedPropIds': [changed], 'state': []}
+
+
+def _style_apps(count: int) -> Dict[str, Tuple[Any, Callable[[int], Dict[str, Any]]]]:
+    """为 count 种合成风格构造两种服务端风格回调，返回 {名称: (Flask 应用, 点击第 k 个按钮时浏览器发送的请求体)}：
+    legacy   旧实现：每个按钮一个 Input，回调内按按钮 ID 查映射表
+    pattern  单个模式匹配 (ALL) 的服务端回调：仍会发送全部按钮的 n_clicks
+    app.py 实际使用模式匹配的客户端回调，点击时不产生任何服务端请求。"""
+    import dash
+    from dash import dcc, html
+    from dash.dependencies import ALL, Input, Output
+
+    keys = [f"STYLE_{i:04d}" for i in range(count)]
+    legacy = dash.Dash(__name__)
+    legacy.layout = html.Div([html.Button(key, id=f"btn-{i}") for i, key in enumerate(keys)] + [dcc.Store(id='style-store')])
+
+    @legacy.callback(Output('style-store', 'data'), [Input(f"btn-{i}", 'n_clicks') for i in range(count)])
+    def legacy_store(*clicks):
+        ctx = dash.callback_context
+        if not ctx.triggered:
+            return dash.no_update
+        button_id = ctx.triggered[0]['prop_id'].split('.')[0]
+        style_map = {f"btn-{i}": key for i, key in enumerate(keys)}
+        return {'style': style_map.get(button_id)}
+
+    pattern = dash.Dash(__name__)
+    pattern.layout = html.Div([html.Button(key, id={'type': 'style-btn', 'index': key}) for key in keys]
+                              + [dcc.Store(id='style-store')])
+
+    @pattern.callback(Output('style-store', 'data'), Input({'type': 'style-btn', 'index': ALL}, 'n_clicks'),
+                      prevent_initial_call=True)
+    def pattern_store(clicks):
+        return {'style': dash.ctx.triggered_id['index']}
+
+    def legacy_payload(k: int) -> Dict[str, Any]:
+        inputs = [{'id': f"btn-{i}", 'property': 'n_clicks', 'value': 1 if i == k else None} for i in range(count)]
+        return _style_callback_payload(inputs, f"btn-{k}.n_clicks")
+
+    def pattern_payload(k: int) -> Dict[str, Any]:
+        ids = [{'index': key, 'type': 'style-btn'} for key in keys]
+        inputs = [[{'id': button, 'property': 'n_clicks', 'value': 1 if i == k else None} for i, button in enumerate(ids)]]
+        return _style_callback_payload(inputs, json.dumps(ids[k], separators=(',', ':')) + '.n_clicks')
+
+    return {'legacy': (legacy.server, legacy_payload), 'pattern': (pattern.server, pattern_payload)}
+
+
+def run_style_dispatch(counts: List[int], clicks: int) -> List[Dict[str, Any]]:
+    """风格数增长时每次点击的请求/响应大小与服务端分发耗时，并给出注册表加载 (预拼接系统提示词) 的耗时"""
+    import styles
+
+    rows = []
+    for count in counts:
+        data = {'groups': [{'title': "bench", 'styles': [
+            {'key': f"STYLE_{i:04d}", 'label': f"{i + 1}. bench", 'color': 'primary', 'negative_profile': 'sfw',
+             'instructions': f"**【风格要求：{i + 1}】** " + "描述要求。" * 40} for i in range(count)]}]}
+        started = time.perf_counter()
+        table = styles.build_table(data, {'creative': lambda text: "共享前缀" * 200 + text})
+        load_ms = (time.perf_counter() - started) * 1000
+        started = time.perf_counter()
+        for i in range(clicks):
+            table.get(f"STYLE_{i % count:04d}")
+        lookup_us = (time.perf_counter() - started) / clicks * 1e6
+
+        for name, (server, payload_for) in _style_apps(count).items():
+            client = server.test_client()
+            recorder = LatencyRecorder()
+            request_bytes = response_bytes = 0
+            for i in range(clicks + 5):
+                body = json.dumps(payload_for(i % count))
+                started = time.perf_counter()
+                response = client.post('/_dash-update-component', data=body, content_type='application/json')
+                elapsed = time.perf_counter() - started
+                if response.status_code != 200:
+                    recorder.error(f"http_{response.status_code}")
+                elif i >= 5:  # 前几次包含 Dash 的首次初始化
+                    recorder.add('dispatch', elapsed)
+                    request_bytes, response_bytes = len(body.encode('utf-8')), len(response.data)
+            stats = recorder.summary(1.0)
+            dispatch = stats['latency'].get('dispatch', {})
+            rows.append({'styles': count, 'callback': name, 'request_bytes': request_bytes,
+                         'response_bytes': response_bytes, 'dispatch_ms_p50': round(dispatch.get('p50', 0) * 1000, 3),
+                         'dispatch_ms_p95': round(dispatch.get('p95', 0) * 1000, 3), 'errors': stats['errors']})
+        rows.append({'styles': count, 'callback': 'clientside', 'request_bytes': 0, 'response_bytes': 0,
+                     'dispatch_ms_p50': 0.0, 'dispatch_ms_p95': 0.0, 'errors': {},
+                     'registry_load_ms': round(load_ms, 3), 'registry_lookup_us': round(lookup_us, 3)})
+    return rows
+
+
+def print_style_dispatch(rows: List[Dict[str, Any]]) -> None:
+    print(f"{'styles':>7}  {'callback':<11}{'request B':>11}{'response B':>12}{'p50 ms':>9}{'p95 ms':>9}")
+    for row in rows:
+        line = (f"{row['styles']:>7}  {row['callback']:<11}{row['request_bytes']:>11}{row['response_bytes']:>12}"
+                f"{row['dispatch_ms_p50']:>9.3f}{row['dispatch_ms_p95']:>9.3f}")
+        if 'registry_load_ms' in row:
+            line += f"   (注册表加载 {row['registry_load_ms']} ms，查找 {row['registry_lookup_us']} µs)"
+        print(line)
+        if row['errors']:
+            print(f"errors: {json.dumps(row['errors'], ensure_ascii=False)}")
+
+
+# ------------------------------------------------------------------------------
+# 输出
+# ------------------------------------------------------------------------------
+
+def run_scenario(args: argparse.Namespace, url: str) -> Dict[str, Any]:
+    styles = args.styles.split(',')
+    scenario = args.matrix_scenario if args.scenario == 'matrix' else args.scenario
+    if scenario == 'batch':
+        report = run_batch_scenario(url, args.requests, args.batch_concurrency, styles, args.theme, args.mode, args.timeout)
+        report['scenario'] = 'batch'
+    else:
+        report = run_dash_scenario(url, args.requests, args.concurrency, styles, args.theme, args.mode,
+                                   args.poll_interval, args.timeout)
+        report['scenario'] = 'dash'
+    report['concurrency'] = args.concurrency if report['scenario'] == 'dash' else args.batch_concurrency
+    return report
+
+
+def print_report(report: Dict[str, Any]) -> None:
+    header = f"== {report.get('config', report['scenario'])} (concurrency={report['concurrency']}, " \
+             f"{report['elapsed_seconds']}s)"
+    if 'rss_mb_peak' in report:
+        header += f" RSS {report['rss_mb_idle']} → {report['rss_mb_peak']} MB, {report['users_per_gb']} users/GB"
+    print(header)
+    print(f"{'metric':<18}{'count':>7}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+    for name, stats in report['latency'].items():
+        print(f"{name:<18}{stats['count']:>7}{stats['rps']:>9.2f}{stats['p50']:>9.3f}{stats['p95']:>9.3f}"
+              f"{stats['p99']:>9.3f}{stats['max']:>9.3f}")
+    if report['errors']:
+        print(f"errors: {json.dumps(report['errors'], ensure_ascii=False)}")
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="提示词生成器压测工具")
+    parser.add_argument('scenario', choices=('dash', 'batch', 'matrix', 'styles'))
+    parser.add_argument('--url', default='http://127.0.0.1:9989', help="被测实例地址 (matrix 模式忽略)")
+    parser.add_argument('-n', '--requests', type=int, default=100, help="总生成次数 (batch 场景为条目数)")
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help="dash 场景的并发虚拟用户数")
+    parser.add_argument('--batch-concurrency', type=int, default=4, help="batch 场景传给服务端的 concurrency 参数")
+    parser.add_argument('--styles', default='NORMAL,ARTISTIC,GRAND_SFW', help="轮流使用的风格 (逗号分隔)")
+    parser.add_argument('--theme', default=DEFAULT_THEME)
+    parser.add_argument('--mode', default='two_pass', choices=('two_pass', 'fused'))
+    parser.add_argument('--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL, help="轮询间隔 (秒)")
+    parser.add_argument('--timeout', type=float, default=300.0, help="单次生成的超时 (秒)")
+    parser.add_argument('--json', help="把完整报告写入该 JSON 文件")
+    matrix = parser.add_argument_group('matrix 模式')
+    matrix.add_argument('--matrix-scenario', default='dash', choices=('dash', 'batch'))
+    matrix.add_argument('--worker-classes', default='sync,gthread', help="gunicorn worker 类型 (逗号分隔)")
+    matrix.add_argument('--workers', default='1,2,4', help="gunicorn worker 数量 (逗号分隔)")
+    matrix.add_argument('--async-modes', default='0', help="ASYNC_MODE 取值 (逗号分隔)，如 0,1 对比线程池与异步模式")
+    matrix.add_argument('--env', action='append', default=[], metavar='KEY=VALUE', help="额外传给应用的环境变量 (可重复)")
+    matrix.add_argument('--threads', type=int, default=8, help="gthread 每个 worker 的线程数")
+    matrix.add_argument('--keep-alive', type=int, default=10,
+                        help="gunicorn 空闲长连接的保持时间 (秒)，应明显大于 轮询间隔 + 轮询延迟的尾部")
+    matrix.add_argument('--gunicorn-args', default='', help="额外传给 gunicorn 的参数")
+    matrix.add_argument('--mock-args', default='', help="传给 mock_deepseek.py 的参数")
+    matrix.add_argument('--cache', action='store_true', help="启用提示词缓存 (默认关闭，避免缓存命中掩盖回归)")
+    style_group = parser.add_argument_group('styles 模式')
+    style_group.add_argument('--style-counts', default='30,100,300,1000', help="合成风格数量 (逗号分隔)")
+    style_group.add_argument('--clicks', type=int, default=200, help="每种配置模拟的点击次数")
+    args = parser.parse_args(argv)
+
+    if args.scenario == 'styles':
+        reports = run_style_dispatch([int(count) for count in args.style_counts.split(',')], args.clicks)
+        print_style_dispatch(reports)
+    elif args.scenario == 'matrix':
+        reports = run_matrix(args)
+    else:
+        reports = [run_scenario(args, args.url.rstrip('/'))]
+        print_report(reports[0])
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    return 0 if all(not r.get('errors') and not r.get('error') for r in reports) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,352 @@
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+# ==============================================================================
+# 两级结果缓存：进程内 LRU (L1) + 所有 gunicorn worker 共享的 SQLite (L2)
+# ==============================================================================
+
+CACHE_ENABLED = os.environ.get('PROMPT_CACHE', '1') != '0'
+CACHE_DB_PATH = os.environ.get('PROMPT_CACHE_DB', 'prompt_cache.sqlite3')
+CACHE_TTL_SECONDS = float(os.environ.get('PROMPT_CACHE_TTL', str(24 * 3600)))
+CACHE_MEMORY_ENTRIES = int(os.environ.get('PROMPT_CACHE_MEMORY_ENTRIES', '512'))
+# 跨进程 single-flight 租约时长：应覆盖一次上游调用的最长耗时
+LEASE_SECONDS = float(os.environ.get('PROMPT_CACHE_LEASE', '120'))
+LEASE_POLL_SECONDS = 0.2
+
+_MISSING = object()
+
+
+def make_key(*parts: Any) -> str:
+    """把任意可 JSON 序列化的组成部分哈希为定长缓存键。"""
+    raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def text_digest(text: str) -> str:
+    """长文本 (如系统提示词) 的短摘要，用作缓存键的一部分。"""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]
+
+
+class LRUCache:
+    """线程安全、带条目上限和 TTL 的进程内 LRU 缓存。"""
+
+    def __init__(self, max_entries: int, ttl_seconds: float):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return _MISSING
+            expires, value = item
+            if expires < time.time():
+                del self._data[key]
+                return _MISSING
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        with self._lock:
+            self._data[key] = (time.time() + self.ttl_seconds, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class SQLiteCache:
+    """基于 SQLite (WAL 模式) 的磁盘缓存，同时提供跨进程的 single-flight 租约。"""
+
+    def __init__(self, path: str, ttl_seconds: float):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        # sqlite3 连接不能跨线程/跨 fork 使用，因此按 (线程, PID) 各建一个
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL)")
+            conn.execute("CREATE TABLE IF NOT EXISTS leases (key TEXT PRIMARY KEY, expires REAL NOT NULL)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key: str) -> Any:
+        row = self._conn().execute("SELECT value, expires FROM cache WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] < time.time():
+            return _MISSING
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any) -> None:
+        conn = self._conn()
+        now = time.time()
+        conn.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)",
+                     (key, json.dumps(value, ensure_ascii=False), now + self.ttl_seconds))
+        if random.random() < 0.01:
+            # 偶尔顺带清理过期条目，避免数据库无限增长
+            conn.execute("DELETE FROM cache WHERE expires < ?", (now,))
+            conn.execute("DELETE FROM leases WHERE expires < ?", (now,))
+
+    def try_lease(self, key: str, seconds: float) -> bool:
+        """尝试获取某个键的计算租约；已被其他进程持有且未过期时返回 False。"""
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT expires FROM leases WHERE key = ?", (key,)).fetchone()
+            if row is not None and row[0] > now:
+                return False
+            conn.execute("INSERT OR REPLACE INTO leases (key, expires) VALUES (?, ?)", (key, now + seconds))
+            return True
+        finally:
+            conn.execute("COMMIT")
+
+    def release_lease(self, key: str) -> None:
+        self._conn().execute("DELETE FROM leases WHERE key = ?", (key,))
+
+    def lease_active(self, key: str) -> bool:
+        row = self._conn().execute("SELECT expires FROM leases WHERE key = ?", (key,)).fetchone()
+        return row is not None and row[0] > time.time()
+
+    def wait_for(self, key: str, timeout: float) -> Any:
+        """轮询等待其他进程写入结果，租约被释放 (对方失败) 或超时则返回 _MISSING。"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            value = self.get(key)
+            if value is not _MISSING:
+                return value
+            if not self.lease_active(key):
+                return self.get(key)
+            time.sleep(LEASE_POLL_SECONDS)
+        return _MISSING
+
+    async def wait_for_async(self, key: str, timeout: float) -> Any:
+        """wait_for 的异步版本：每次轮询在线程池中执行，轮询间隔让出事件循环。"""
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            value = await asyncio.to_thread(self.get, key)
+            if value is not _MISSING:
+                return value
+            if not await asyncio.to_thread(self.lease_active, key):
+                return await asyncio.to_thread(self.get, key)
+            await asyncio.sleep(LEASE_POLL_SECONDS)
+        return _MISSING
+
+
+class TwoTierCache:
+    """L1 内存 + L2 磁盘的两级缓存，并发的相同未命中请求只会触发一次上游调用。"""
+
+    def __init__(self, name: str, memory: LRUCache, disk: Optional[SQLiteCache]):
+        self.name = name
+        self.memory = memory
+        self.disk = disk
+        self._lock = threading.Lock()
+        self._inflight: Dict[str, threading.Event] = {}
+        # 异步模式：同一进程内只有一个事件循环，用 Future 合并相同键的并发未命中
+        self._async_inflight: Dict[str, asyncio.Future] = {}
+        self.stats = {'memory_hits': 0, 'disk_hits': 0, 'coalesced': 0, 'misses': 0}
+
+    def _count(self, field: str) -> None:
+        with self._lock:
+            self.stats[field] += 1
+
+    def _lookup(self, key: str) -> Tuple[Any, Optional[str]]:
+        value = self.memory.get(key)
+        if value is not _MISSING:
+            return value, 'memory_hits'
+        return self._lookup_disk(key)
+
+    def _lookup_disk(self, key: str) -> Tuple[Any, Optional[str]]:
+        if self.disk is not None:
+            try:
+                value = self.disk.get(key)
+            except sqlite3.Error as e:
+                print(f"警告：磁盘缓存读取失败 ({self.name}): {e}")
+                return _MISSING, None
+            if value is not _MISSING:
+                self.memory.set(key, value)
+                return value, 'disk_hits'
+        return _MISSING, None
+
+    def _store(self, key: str, value: Any) -> None:
+        self.memory.set(key, value)
+        self._store_disk(key, value)
+
+    def _store_disk(self, key: str, value: Any) -> None:
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                print(f"警告：磁盘缓存写入失败 ({self.name}): {e}")
+
+    def get_or_compute(self, key: str, compute: Callable[[], Tuple[Any, Optional[str]]]) -> Tuple[Any, Optional[str]]:
+        """命中则直接返回；否则执行 compute() -> (value, error)，只缓存成功的结果。"""
+        value, source = self._lookup(key)
+        if value is not _MISSING:
+            self._count(source)
+            return value, None
+
+        # 进程内 single-flight：同一个键只有一个 leader 线程真正去计算
+        with self._lock:
+            event = self._inflight.get(key)
+            is_leader = event is None
+            if is_leader:
+                event = self._inflight[key] = threading.Event()
+
+        if not is_leader:
+            event.wait(LEASE_SECONDS)
+            value, _ = self._lookup(key)
+            if value is not _MISSING:
+                self._count('coalesced')
+                return value, None
+            # leader 失败了：自己再算一次，错误信息对当前请求更有意义
+            self._count('misses')
+            return compute()
+
+        try:
+            return self._compute_with_lease(key, compute)
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            event.set()
+
+    def _compute_with_lease(self, key: str, compute: Callable[[], Tuple[Any, Optional[str]]]) -> Tuple[Any, Optional[str]]:
+        # 跨进程 single-flight：其他 worker 正在计算同一个键时等待其结果
+        leased = False
+        if self.disk is not None:
+            try:
+                leased = self.disk.try_lease(key, LEASE_SECONDS)
+                if not leased:
+                    value = self.disk.wait_for(key, LEASE_SECONDS)
+                    if value is not _MISSING:
+                        self.memory.set(key, value)
+                        self._count('coalesced')
+                        return value, None
+            except sqlite3.Error as e:
+                print(f"警告：磁盘缓存租约失败 ({self.name}): {e}")
+
+        self._count('misses')
+        try:
+            value, error = compute()
+        finally:
+            if leased:
+                try:
+                    self.disk.release_lease(key)
+                except sqlite3.Error:
+                    pass
+        if error is None and value is not None:
+            self._store(key, value)
+        return value, error
+
+    async def get_or_compute_async(self, key: str,
+                                   compute: Callable[[], Awaitable[Tuple[Any, Optional[str]]]]) -> Tuple[Any, Optional[str]]:
+        """get_or_compute 的异步版本，compute 为返回 (value, error) 的协程函数。
+
+        内存层在事件循环线程上直接读写，磁盘层 (SQLite) 的读写与租约都放到线程池中执行。
+        """
+        value, source = self.memory.get(key), 'memory_hits'
+        if value is _MISSING:
+            value, source = await asyncio.to_thread(self._lookup_disk, key)
+        if value is not _MISSING:
+            self._count(source)
+            return value, None
+
+        future = self._async_inflight.get(key)
+        if future is not None:
+            value, error = await asyncio.shield(future)
+            if error is None:
+                self._count('coalesced')
+                return value, None
+            self._count('misses')
+            return await compute()
+
+        future = self._async_inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            outcome = await self._compute_with_lease_async(key, compute)
+        except BaseException as e:
+            outcome = (None, f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            self._async_inflight.pop(key, None)
+            future.set_result(outcome)
+        return outcome
+
+    async def _compute_with_lease_async(self, key: str,
+                                        compute: Callable[[], Awaitable[Tuple[Any, Optional[str]]]]) -> Tuple[Any, Optional[str]]:
+        leased = False
+        if self.disk is not None:
+            try:
+                leased = await asyncio.to_thread(self.disk.try_lease, key, LEASE_SECONDS)
+                if not leased:
+                    value = await self.disk.wait_for_async(key, LEASE_SECONDS)
+                    if value is not _MISSING:
+                        self.memory.set(key, value)
+                        self._count('coalesced')
+                        return value, None
+            except sqlite3.Error as e:
+                print(f"警告：磁盘缓存租约失败 ({self.name}): {e}")
+
+        self._count('misses')
+        try:
+            value, error = await compute()
+        finally:
+            if leased:
+                try:
+                    await asyncio.to_thread(self.disk.release_lease, key)
+                except sqlite3.Error:
+                    pass
+        if error is None and value is not None:
+            self.memory.set(key, value)
+            await asyncio.to_thread(self._store_disk, key, value)
+        return value, error
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = sum(stats.values())
+        hits = stats['memory_hits'] + stats['disk_hits'] + stats['coalesced']
+        stats['hit_ratio'] = round(hits / lookups, 4) if lookups else 0.0
+        stats['memory_entries'] = len(self.memory)
+        return stats
+
+
+_disk_cache = SQLiteCache(CACHE_DB_PATH, CACHE_TTL_SECONDS)
+
+creative_cache = TwoTierCache('creative', LRUCache(CACHE_MEMORY_ENTRIES, CACHE_TTL_SECONDS), _disk_cache)
+format_cache = TwoTierCache('format', LRUCache(CACHE_MEMORY_ENTRIES, CACHE_TTL_SECONDS), _disk_cache)
+
+
+def cached_call(cache: TwoTierCache, key: str, compute: Callable[[], Tuple[Any, Optional[str]]]) -> Tuple[Any, Optional[str]]:
+    """缓存开关关闭时直接调用 compute，否则走两级缓存。"""
+    if not CACHE_ENABLED:
+        return compute()
+    return cache.get_or_compute(key, compute)
+
+
+async def cached_call_async(cache: TwoTierCache, key: str,
+                            compute: Callable[[], Awaitable[Tuple[Any, Optional[str]]]]) -> Tuple[Any, Optional[str]]:
+    """cached_call 的异步版本。"""
+    if not CACHE_ENABLED:
+        return await compute()
+    return await cache.get_or_compute_async(key, compute)
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    return {cache.name: cache.snapshot() for cache in (creative_cache, format_cache)}
@@ -0,0 +1,523 @@
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+import zlib
+from bisect import bisect_left, bisect_right
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+try:
+    import fcntl
+except ImportError:  # Windows 本地调试：只有进程内锁，多 worker 部署需要 Linux
+    fcntl = None
+
+import metrics
+
+# ==============================================================================
+# 生成历史：只追加的分段日志 + 定宽偏移索引 (所有 gunicorn worker 共享同一目录)
+# ==============================================================================
+# 每个分段由两个文件组成：
+#   {base:012d}.{gen}.jsonl  每行一条 JSON 记录 (紧凑编码)
+#   {base:012d}.{gen}.idx    每条记录一个 32 字节定宽索引项
+#                            <时间戳 f64, 数据偏移 u64, 长度 u32, 风格哈希 u32, 客户端哈希 u32, 保留 u32>
+#   {base:012d}.{gen}.keys   (仅压缩后的分段) 按 (字段, 哈希, 序号) 排序的倒排表，每项 12 字节 <字段 u32, 哈希 u32, 序号 u32>
+# 记录 ID 是全局递增序号：所在分段 = 起始序号 (base) 不大于 ID 的最后一个分段，索引项位于 (ID - base) × 32，
+# 因此按 ID 查找只需一次定位读。分段内时间戳单调递增，时间范围用二分查找；风格/客户端过滤在已压缩的分段上
+# 二分查找倒排表，在活动分段 (以及尚未压缩的分段) 上直接在索引映射中查找哈希的字节串 (C 实现的字节比较)，
+# 都不在 Python 中逐条解包索引项；全文搜索直接在内存映射的数据文件上查找字节串，不把文件读入内存。
+#
+# 写入时持有目录下的文件锁：先写数据行、再写索引项，读者无需加锁，只会看到完整的记录。
+# 活动分段超过 HISTORY_SEGMENT_BYTES 后轮转。后台线程定期压缩已关闭的分段：
+# 过期记录 (超过 HISTORY_RETENTION_DAYS) 变为墓碑 (长度为 0 的索引项，ID 不变)，
+# 内容相同的记录 (如缓存命中) 只保留一份正文，其余改为引用 (same_as)，同时生成倒排表，全部过期的分段直接删除。
+# 压缩结果先写到 gen+1 的新文件再切换，正在读旧文件的请求不受影响。
+
+HISTORY_ENABLED = os.environ.get('HISTORY', '1') != '0'
+HISTORY_DIR = os.environ.get('HISTORY_DIR', 'history')
+HISTORY_SEGMENT_BYTES = int(os.environ.get('HISTORY_SEGMENT_BYTES', str(64 * 1024 * 1024)))
+HISTORY_RETENTION_DAYS = float(os.environ.get('HISTORY_RETENTION_DAYS', '90'))  # 0 表示永久保留
+HISTORY_COMPACT_INTERVAL = float(os.environ.get('HISTORY_COMPACT_INTERVAL', '3600'))
+HISTORY_PAGE_SIZE = 10
+
+_ENTRY = struct.Struct('<dQIII4x')
+_POSTING = struct.Struct('<III')
+# 倒排表中的字段编号，以及对应哈希在索引项中的字节偏移
+KEY_STYLE, KEY_CLIENT = 0, 1
+_KEY_COLUMNS = {KEY_STYLE: 20, KEY_CLIENT: 24}
+_SEGMENT_NAME = re.compile(r'^(\d{12})\.(\d+)\.idx$')
+# 参与去重的字段：压缩时这些字段完全相同的记录只保存一份
+CONTENT_FIELDS = ('style', 'theme', 'mode', 'raw', 'final_tag', 'final_natural', 'final_chinese_natural', 'final_negative')
+
+HISTORY_APPENDS = metrics.Counter('prompt_history_appends_total', "写入生成历史的记录数")
+HISTORY_QUERY_DURATION = metrics.Histogram(
+    'prompt_history_query_seconds', "生成历史查询耗时 (kind: get / browse / search)", ('kind',))
+
+
+def key_hash(value: Optional[str]) -> int:
+    """索引中保存的风格/客户端 32 位哈希"""
+    return zlib.crc32((value or '').encode('utf-8'))
+
+
+def _encode(record: Dict[str, Any]) -> bytes:
+    return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n'
+
+
+class Segment(NamedTuple):
+    base: int
+    gen: int
+    directory: str
+
+    @property
+    def prefix(self) -> str:
+        return os.path.join(self.directory, f"{self.base:012d}.{self.gen}")
+
+    @property
+    def data_path(self) -> str:
+        return self.prefix + '.jsonl'
+
+    @property
+    def idx_path(self) -> str:
+        return self.prefix + '.idx'
+
+    @property
+    def keys_path(self) -> str:
+        return self.prefix + '.keys'
+
+
+class SegmentView:
+    """一个分段的只读视图：同时打开索引与数据文件并做内存映射。
+
+    先映射索引、后映射数据 (写入顺序相反)，所以索引中出现的记录在数据映射中一定完整。
+    文件在压缩切换后被删除时，已打开的映射仍然可读。没有倒排表的分段 keys 为 None。
+    """
+
+    def __init__(self, segment: Segment):
+        self.segment = segment
+        self._files = []
+        self._maps = []
+        try:
+            self.index = self._map(segment.idx_path)
+            try:
+                self.keys = self._map(segment.keys_path)
+            except FileNotFoundError:
+                self.keys = None
+            self.data = self._map(segment.data_path)
+        except OSError:
+            self.close()
+            raise
+        self.count = len(self.index) // _ENTRY.size
+
+    def _map(self, path: str):
+        f = open(path, 'rb')
+        self._files.append(f)
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._maps.append(mapped)
+        return mapped
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + len(self.index) + len(self.keys or b'')
+
+    def close(self) -> None:
+        for mapped in self._maps:
+            mapped.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self) -> "SegmentView":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def entry(self, ordinal: int) -> Tuple[float, int, int, int, int]:
+        """(时间戳, 数据偏移, 长度, 风格哈希, 客户端哈希)"""
+        return _ENTRY.unpack_from(self.index, ordinal * _ENTRY.size)
+
+    def timestamp(self, ordinal: int) -> float:
+        return struct.unpack_from('<d', self.index, ordinal * _ENTRY.size)[0]
+
+    def offset(self, ordinal: int) -> int:
+        return struct.unpack_from('<Q', self.index, ordinal * _ENTRY.size + 8)[0]
+
+    def bisect_time(self, ts: float, right: bool = False) -> int:
+        """第一个时间戳 >= ts (right=True 时 > ts) 的序号"""
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            value = self.timestamp(mid)
+            if value < ts or (right and value == ts):
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def stored(self, ordinal: int) -> Optional[Dict[str, Any]]:
+        """分段中保存的原始记录 (可能是 same_as 引用)；墓碑返回 None"""
+        _, offset, length, _, _ = self.entry(ordinal)
+        if not length:
+            return None
+        return json.loads(self.data[offset:offset + length])
+
+    def record(self, ordinal: int) -> Optional[Dict[str, Any]]:
+        record = self.stored(ordinal)
+        if record is not None and 'same_as' in record:
+            original = self.stored(record['same_as'] - self.segment.base) or {}
+            record = dict(original, **{k: v for k, v in record.items() if k != 'same_as'})
+        return record
+
+    def ordinal_at(self, position: int) -> int:
+        """数据偏移 position 所在记录的序号，不在任何已索引的记录内时返回 -1。
+
+        数据偏移随序号单调不减 (墓碑只出现在分段开头，偏移与第一条有效记录相同)，因此可以在索引上二分查找。
+        """
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.offset(mid) <= position:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return -1
+        _, offset, length, _, _ = self.entry(lo - 1)
+        return lo - 1 if offset <= position < offset + length else -1
+
+    def ordinals_with(self, field: int, key: int) -> List[int]:
+        """风格 (KEY_STYLE) 或客户端 (KEY_CLIENT) 哈希等于 key 的记录序号 (升序)"""
+        if self.keys is not None:
+            target = (field, key)
+            lo, hi = 0, len(self.keys) // _POSTING.size
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if _POSTING.unpack_from(self.keys, mid * _POSTING.size)[:2] < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            ordinals = []
+            for posting_field, posting_key, ordinal in _POSTING.iter_unpack(self.keys[lo * _POSTING.size:]):
+                if (posting_field, posting_key) != target:
+                    break
+                ordinals.append(ordinal)
+            return ordinals
+        # 没有倒排表：在索引映射上查找哈希的字节串，只保留落在对应列上的命中
+        needle, column = struct.pack('<I', key), _KEY_COLUMNS[field]
+        ordinals = []
+        position = self.index.find(needle) if self.count else -1
+        while position != -1:
+            ordinal, remainder = divmod(position, _ENTRY.size)
+            if remainder == column and ordinal < self.count:
+                ordinals.append(ordinal)
+            position = self.index.find(needle, position + 1)
+        return ordinals
+
+    def search(self, needle: bytes) -> List[int]:
+        """在数据映射上查找字节串，返回命中记录的序号 (按写入顺序，同一行只计一次)。
+
+        命中位置通过索引映射到序号，不解析 JSON；只有最终返回的一页记录才会被解码。
+        """
+        ordinals = []
+        position = self.data.find(needle) if self.count else -1
+        while position != -1:
+            ordinal = self.ordinal_at(position)
+            if ordinal == -1:
+                # 尚未写入索引项的尾部记录
+                break
+            ordinals.append(ordinal)
+            _, offset, length, _, _ = self.entry(ordinal)
+            position = self.data.find(needle, offset + length)
+        return ordinals
+
+
+class HistoryStore:
+    """只追加的生成历史。append / get / query 可在任意线程与 worker 进程中调用。"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._lock_files: Dict[str, Any] = {}
+        self._lock_pid: Optional[int] = None
+        self._maintenance_pid: Optional[int] = None
+
+    # --- 文件锁 (跨 worker) ---
+
+    def _lock_file(self, name: str):
+        if self._lock_pid != os.getpid():
+            self._lock_files = {}
+            self._lock_pid = os.getpid()
+        if name not in self._lock_files:
+            os.makedirs(self.directory, exist_ok=True)
+            self._lock_files[name] = open(os.path.join(self.directory, name), 'a+b')
+        return self._lock_files[name]
+
+    @contextmanager
+    def _write_lock(self) -> Iterator[None]:
+        with self._lock:
+            f = self._lock_file('.lock') if fcntl else None
+            if f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if f:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    # --- 分段 ---
+
+    def segments(self) -> List[Segment]:
+        """按起始序号排列的分段 (同一 base 存在多个 gen 时取最新的)"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        latest: Dict[int, Segment] = {}
+        for name in names:
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                segment = Segment(int(match[1]), int(match[2]), self.directory)
+                if segment.base not in latest or segment.gen > latest[segment.base].gen:
+                    latest[segment.base] = segment
+        return [latest[base] for base in sorted(latest)]
+
+    def _views(self, newest_first: bool = True) -> Iterator[SegmentView]:
+        segments = self.segments()
+        for segment in (reversed(segments) if newest_first else segments):
+            try:
+                view = SegmentView(segment)
+            except FileNotFoundError:
+                # 压缩刚刚切换到了新文件
+                refreshed = [s for s in self.segments() if s.base == segment.base]
+                if not refreshed:
+                    continue
+                view = SegmentView(refreshed[0])
+            with view:
+                yield view
+
+    # --- 写入 ---
+
+    def _tail(self, segment: Segment) -> Tuple[int, float]:
+        """活动分段的 (记录数, 最后一条的时间戳)；顺带截掉上次写入中断留下的半条索引项"""
+        try:
+            with open(segment.idx_path, 'r+b') as index:
+                size = index.seek(0, os.SEEK_END)
+                if size % _ENTRY.size:
+                    size -= size % _ENTRY.size
+                    index.truncate(size)
+                if not size:
+                    return 0, 0.0
+                index.seek(size - _ENTRY.size)
+                return size // _ENTRY.size, _ENTRY.unpack(index.read(_ENTRY.size))[0]
+        except FileNotFoundError:
+            return 0, 0.0
+
+    def append(self, record: Dict[str, Any], client: Optional[str] = None) -> int:
+        """追加一条记录，返回它的 ID。记录中的 id / ts 字段由存储层填写。"""
+        with self._write_lock():
+            os.makedirs(self.directory, exist_ok=True)
+            segments = self.segments()
+            segment = segments[-1] if segments else Segment(0, 0, self.directory)
+            count, last_ts = self._tail(segment)
+            if count and os.path.getsize(segment.data_path) >= HISTORY_SEGMENT_BYTES:
+                segment, count = Segment(segment.base + count, 0, self.directory), 0
+
+            entry_id = segment.base + count
+            # 时间戳保持单调 (时钟回拨时沿用上一条)，按时间范围二分查找依赖这一点
+            ts = max(time.time(), last_ts)
+            line = _encode(dict(record, id=entry_id, ts=round(ts, 3)))
+            with open(segment.data_path, 'ab') as data:
+                offset = data.seek(0, os.SEEK_END)
+                data.write(line)
+            with open(segment.idx_path, 'ab') as index:
+                index.write(_ENTRY.pack(ts, offset, len(line), key_hash(record.get('style')), key_hash(client)))
+        HISTORY_APPENDS.inc()
+        return entry_id
+
+    # --- 读取 ---
+
+    def get(self, entry_id: int, client: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """按 ID 读取一条记录；指定 client 时只返回该客户端写入的记录"""
+        started = time.perf_counter()
+        try:
+            segments = self.segments()
+            position = bisect_right([segment.base for segment in segments], entry_id) - 1
+            if position < 0:
+                return None
+            try:
+                view = SegmentView(segments[position])
+            except FileNotFoundError:
+                return self.get(entry_id, client) if self.segments() != segments else None
+            with view:
+                ordinal = entry_id - view.segment.base
+                if ordinal >= view.count or (client is not None and view.entry(ordinal)[4] != key_hash(client)):
+                    return None
+                return view.record(ordinal)
+        finally:
+            HISTORY_QUERY_DURATION.observe(time.perf_counter() - started, kind='get')
+
+    def query(self, style: Optional[str] = None, client: Optional[str] = None, since: Optional[float] = None,
+              until: Optional[float] = None, text: Optional[str] = None, offset: int = 0,
+              limit: int = HISTORY_PAGE_SIZE) -> Tuple[List[Dict[str, Any]], bool]:
+        """按时间倒序分页查询，返回 (本页记录, 是否还有下一页)。
+
+        style / client 为 None 时不过滤；text 为子串搜索 (区分大小写)，内容相同且已被压缩合并的记录只返回一条。
+        """
+        started = time.perf_counter()
+        style_key = key_hash(style) if style else None
+        client_key = key_hash(client) if client else None
+        needle = json.dumps(text, ensure_ascii=False)[1:-1].encode('utf-8') if text else None
+        skip, page, has_more = offset, [], False
+        for view in self._views():
+            if not view.count:
+                continue
+            if since is not None and view.timestamp(view.count - 1) < since:
+                break
+            lo = view.bisect_time(since) if since is not None else 0
+            hi = view.bisect_time(until, right=True) if until is not None else view.count
+            if needle:
+                candidates = reversed([o for o in view.search(needle) if lo <= o < hi])
+            elif client_key is not None or style_key is not None:
+                # 有客户端过滤时优先用它取候选 (通常比风格更有区分度)，另一个条件在下面逐条检查
+                field, key = (KEY_CLIENT, client_key) if client_key is not None else (KEY_STYLE, style_key)
+                ordinals = view.ordinals_with(field, key)
+                candidates = reversed(ordinals[bisect_left(ordinals, lo):bisect_left(ordinals, hi)])
+            else:
+                candidates = reversed(range(lo, hi))
+            for ordinal in candidates:
+                _, _, length, entry_style, entry_client = view.entry(ordinal)
+                if not length or (style_key is not None and entry_style != style_key) \
+                        or (client_key is not None and entry_client != client_key):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                if len(page) == limit:
+                    has_more = True
+                    break
+                page.append(view.record(ordinal))
+            if has_more:
+                break
+        HISTORY_QUERY_DURATION.observe(time.perf_counter() - started, kind='search' if needle else 'browse')
+        return page, has_more
+
+    def stats(self) -> Dict[str, Any]:
+        entries, size, oldest, newest = 0, 0, None, None
+        for view in self._views(newest_first=False):
+            entries += view.count
+            size += view.size
+            if view.count:
+                oldest = view.timestamp(0) if oldest is None else oldest
+                newest = view.timestamp(view.count - 1)
+        return {'segments': len(self.segments()), 'entries': entries, 'bytes': size, 'oldest': oldest, 'newest': newest,
+                'segment_bytes': HISTORY_SEGMENT_BYTES, 'retention_days': HISTORY_RETENTION_DAYS}
+
+    # --- 轮转与压缩 ---
+
+    def compact(self) -> Dict[str, int]:
+        """压缩所有已关闭的分段 (活动分段不动)。多个 worker 同时调用时只有一个会执行。"""
+        stats = {'compacted': 0, 'removed': 0, 'expired': 0, 'deduplicated': 0, 'bytes_saved': 0}
+        lock = self._lock_file('.compact.lock') if fcntl else None
+        if lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return stats
+        try:
+            cutoff = time.time() - HISTORY_RETENTION_DAYS * 86400 if HISTORY_RETENTION_DAYS > 0 else None
+            for segment in self.segments()[:-1]:
+                self._compact_segment(segment, cutoff, stats)
+        finally:
+            if lock:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return stats
+
+    def _compact_segment(self, segment: Segment, cutoff: Optional[float], stats: Dict[str, int]) -> None:
+        with SegmentView(segment) as view:
+            expired = view.bisect_time(cutoff) if cutoff is not None else 0
+            if view.count and expired == view.count:
+                _remove(segment)
+                stats['removed'] += 1
+                stats['expired'] += view.count
+                stats['bytes_saved'] += view.size
+                return
+            live_expired = any(view.entry(ordinal)[2] for ordinal in range(expired))
+            if segment.gen > 0 and not live_expired and view.keys is not None:
+                return
+
+            target = Segment(segment.base, segment.gen + 1, segment.directory)
+            seen: Dict[str, int] = {}
+            postings: List[Tuple[int, int, int]] = []
+            try:
+                with open(target.data_path + '.tmp', 'wb') as data, open(target.idx_path + '.tmp', 'wb') as index, \
+                        open(target.keys_path + '.tmp', 'wb') as keys:
+                    for ordinal in range(view.count):
+                        ts, _, length, style_key, client_key = view.entry(ordinal)
+                        if not length or ordinal < expired:
+                            stats['expired'] += 1 if length else 0
+                            index.write(_ENTRY.pack(ts, 0, 0, style_key, client_key))
+                            continue
+                        # 先还原完整记录，再在新分段内重新去重 (被引用的原文可能刚刚过期)
+                        record = view.record(ordinal)
+                        digest = hashlib.sha1(_encode([record.get(field) for field in CONTENT_FIELDS])).hexdigest()
+                        if digest in seen:
+                            record = {k: v for k, v in record.items() if k not in CONTENT_FIELDS}
+                            record['same_as'] = seen[digest]
+                            stats['deduplicated'] += 1
+                        else:
+                            seen[digest] = record['id']
+                        line = _encode(record)
+                        index.write(_ENTRY.pack(ts, data.tell(), len(line), style_key, client_key))
+                        data.write(line)
+                        postings += [(KEY_STYLE, style_key, ordinal), (KEY_CLIENT, client_key, ordinal)]
+                    postings.sort()
+                    keys.write(b''.join(_POSTING.pack(*posting) for posting in postings))
+                    new_size = data.tell() + index.tell() + keys.tell()
+                # 先切换数据文件与倒排表再切换索引：segments() 以索引文件为准，看到新索引时其余文件一定已就位
+                os.replace(target.data_path + '.tmp', target.data_path)
+                os.replace(target.keys_path + '.tmp', target.keys_path)
+                os.replace(target.idx_path + '.tmp', target.idx_path)
+            except OSError as e:
+                print(f"警告：压缩历史分段 {segment.prefix} 失败: {e}")
+                for path in (target.data_path + '.tmp', target.keys_path + '.tmp', target.idx_path + '.tmp'):
+                    if os.path.exists(path):
+                        os.remove(path)
+                return
+            _remove(segment)
+            stats['compacted'] += 1
+            stats['bytes_saved'] += view.size - new_size
+
+    def start_maintenance(self) -> None:
+        """启动后台压缩线程 (每个进程只启动一次；gunicorn fork 出的 worker 会各自重新启动)。"""
+        if self._maintenance_pid == os.getpid() or HISTORY_COMPACT_INTERVAL <= 0:
+            return
+        self._maintenance_pid = os.getpid()
+
+        def loop():
+            while True:
+                time.sleep(HISTORY_COMPACT_INTERVAL)
+                try:
+                    stats = self.compact()
+                    if stats['compacted'] or stats['removed']:
+                        metrics.log_event('history_compact', **stats)
+                except OSError as e:
+                    print(f"警告：压缩生成历史失败: {e}")
+
+        threading.Thread(target=loop, name='history-compactor', daemon=True).start()
+
+
+def _remove(segment: Segment) -> None:
+    # 先删索引：segments() 不再列出该分段后再删数据与倒排表
+    for path in (segment.idx_path, segment.data_path, segment.keys_path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+history_store = HistoryStore(HISTORY_DIR)
@@ -0,0 +1,345 @@
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# ==============================================================================
+# 后台任务：有界本地线程池 + 所有 gunicorn worker 共享的 SQLite 任务表
+# ==============================================================================
+# 任务在提交它的 worker 进程内执行；进度、结果和耗时写入 SQLite，
+# 因此前端的轮询请求可以落在任意 worker 上。
+
+JOB_DB_PATH = os.environ.get('JOB_DB', 'jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '4'))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', '32'))
+JOB_TIMEOUT_SECONDS = float(os.environ.get('JOB_TIMEOUT', '240'))
+JOB_RETENTION_SECONDS = float(os.environ.get('JOB_RETENTION', str(24 * 3600)))
+PROGRESS_MIN_INTERVAL = 0.2
+# 异步模式：每个 worker 进程内同时执行的协程任务数与排队上限 (任务大部分时间在等待上游，可以开得很大)
+ASYNC_JOB_CONCURRENCY = int(os.environ.get('ASYNC_JOB_CONCURRENCY', '256'))
+ASYNC_JOB_QUEUE_LIMIT = int(os.environ.get('ASYNC_JOB_QUEUE_LIMIT', '1024'))
+
+# 任务状态：queued → running → done / failed / cancelled
+# 任务阶段 (stage)：queued → creative → formatting → done
+
+
+class JobCancelled(Exception):
+    """任务已被取消 (被用户新的点击取代) 或超时，由 JobHandle.check() 抛出。"""
+
+
+class JobStore:
+    """SQLite 任务表，每个 (线程, PID) 使用独立连接。"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id TEXT PRIMARY KEY, kind TEXT NOT NULL, params TEXT NOT NULL,"
+                " status TEXT NOT NULL, stage TEXT NOT NULL, result TEXT, error TEXT,"
+                " created_at REAL NOT NULL, started_at REAL, finished_at REAL, timings TEXT)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def create(self, kind: str, params: Dict[str, Any]) -> str:
+        job_id = uuid.uuid4().hex
+        self._conn().execute(
+            "INSERT INTO jobs (id, kind, params, status, stage, created_at) VALUES (?, ?, ?, 'queued', 'queued', ?)",
+            (job_id, kind, json.dumps(params, ensure_ascii=False), time.time()))
+        return job_id
+
+    @staticmethod
+    def _assignments(fields: Dict[str, Any]) -> str:
+        for key in ('result', 'timings'):
+            if key in fields and not isinstance(fields[key], (str, type(None))):
+                fields[key] = json.dumps(fields[key], ensure_ascii=False)
+        return ', '.join(f"{key} = ?" for key in fields)
+
+    def update(self, job_id: str, **fields: Any) -> None:
+        columns = self._assignments(fields)
+        self._conn().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def finish(self, job_id: str, **fields: Any) -> bool:
+        """写入运行中任务的最终状态；任务已被取消时返回 False 并保持取消状态 (单条条件更新，不会覆盖并发的取消)。"""
+        columns = self._assignments(fields)
+        cursor = self._conn().execute(f"UPDATE jobs SET {columns} WHERE id = ? AND status = 'running'",
+                                      (*fields.values(), job_id))
+        return cursor.rowcount > 0
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        for key in ('params', 'result', 'timings'):
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    def start(self, job_id: str) -> bool:
+        """把排队中的任务标记为运行中；任务已被取消时返回 False (单条条件更新，不会覆盖并发的取消)。"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'running', started_at = ? WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        return cursor.rowcount > 0
+
+    def cancel(self, job_id: str, reason: str = "任务已被新的请求取代") -> bool:
+        """把仍在排队或运行中的任务标记为已取消，运行中的任务会在下一个检查点退出。"""
+        cursor = self._conn().execute(
+            "UPDATE jobs SET status = 'cancelled', error = ?, finished_at = ?"
+            " WHERE id = ? AND status IN ('queued', 'running')",
+            (reason, time.time(), job_id))
+        return cursor.rowcount > 0
+
+    def status(self, job_id: str) -> Optional[str]:
+        row = self._conn().execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return row[0] if row else None
+
+    def counts(self) -> Dict[str, int]:
+        rows = self._conn().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def recent_timings(self, limit: int = 200) -> Dict[str, Any]:
+        """最近完成任务的平均耗时 (秒)，用于观察排队与各阶段的耗时分布。"""
+        rows = self._conn().execute(
+            "SELECT created_at, started_at, finished_at, timings FROM jobs"
+            " WHERE status = 'done' ORDER BY finished_at DESC LIMIT ?", (limit,)).fetchall()
+        totals: Dict[str, float] = {}
+        for created_at, started_at, finished_at, timings in rows:
+            stages = json.loads(timings) if timings else {}
+            stages['queue_wait'] = (started_at or created_at) - created_at
+            stages['total'] = finished_at - created_at
+            for key, value in stages.items():
+                totals[key] = totals.get(key, 0.0) + value
+        averages = {key: round(value / len(rows), 3) for key, value in totals.items()} if rows else {}
+        return {'samples': len(rows), 'avg_seconds': averages}
+
+    def purge(self, older_than: float) -> None:
+        self._conn().execute(
+            "DELETE FROM jobs WHERE status NOT IN ('queued', 'running') AND created_at < ?", (older_than,))
+
+
+class JobHandle:
+    """传给任务函数的句柄：写进度、检查取消与超时。"""
+
+    def __init__(self, store: JobStore, job_id: str, params: Dict[str, Any]):
+        self.store = store
+        self.job_id = job_id
+        self.params = params
+        self.deadline = time.time() + JOB_TIMEOUT_SECONDS
+        self._last_write = 0.0
+        self._last_stage: Optional[str] = None
+
+    def check(self) -> None:
+        if self.store.status(self.job_id) == 'cancelled':
+            raise JobCancelled("任务已被新的请求取代")
+        if time.time() > self.deadline:
+            raise JobCancelled(f"任务超时 (>{JOB_TIMEOUT_SECONDS:.0f}s)")
+
+    def report(self, stage: str, result: Dict[str, Any]) -> None:
+        """写入中间结果；同一阶段内的高频更新 (流式 token) 会被节流。"""
+        now = time.time()
+        if stage == self._last_stage and now - self._last_write < PROGRESS_MIN_INTERVAL:
+            return
+        self.check()
+        self._last_stage = stage
+        self._last_write = now
+        self.store.update(self.job_id, stage=stage, result=result)
+
+
+class JobRunner:
+    """有界线程池执行器；超出 JOB_QUEUE_LIMIT 的提交会被直接拒绝。"""
+
+    def __init__(self, store: JobStore, workers: int, queue_limit: int):
+        self.store = store
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_pid: Optional[int] = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        # 线程池不能跨 fork 继承，按 PID 懒加载
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+            self._executor_pid = os.getpid()
+            self._pending = 0
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        """本进程内已提交但尚未结束的任务数。"""
+        return self._pending
+
+    def _reserve(self) -> bool:
+        with self._lock:
+            self._get_executor()
+            if self._pending >= self.queue_limit:
+                return False
+            self._pending += 1
+            return True
+
+    def _release(self) -> None:
+        with self._lock:
+            self._pending -= 1
+
+    def _create(self, kind: str, params: Dict[str, Any]) -> str:
+        job_id = self.store.create(kind, params)
+        if random.random() < 0.01:
+            self.store.purge(time.time() - JOB_RETENTION_SECONDS)
+        return job_id
+
+    def submit(self, kind: str, params: Dict[str, Any],
+               task: Callable[[JobHandle], Dict[str, Any]]) -> Optional[str]:
+        """提交任务并立即返回 job_id；队列已满时返回 None。"""
+        if not self._reserve():
+            return None
+        job_id = self._create(kind, params)
+        self._executor.submit(self._run, JobHandle(self.store, job_id, params), task)
+        return job_id
+
+    def _start(self, handle: JobHandle) -> bool:
+        return self.store.start(handle.job_id)
+
+    def _finish(self, handle: JobHandle, result: Optional[Dict[str, Any]], exc: Optional[Exception]) -> bool:
+        """写入最终状态；最后一个阶段运行期间任务被取消时保持取消，返回 False (结果丢弃)。"""
+        if isinstance(exc, JobCancelled):
+            return self.store.finish(handle.job_id, status='cancelled', error=str(exc), finished_at=time.time())
+        if exc is not None:
+            return self.store.finish(handle.job_id, status='failed', error=f"{type(exc).__name__}: {exc}",
+                                     finished_at=time.time())
+        return self.store.finish(handle.job_id, status='failed' if result.get('error') else 'done', stage='done',
+                                 result=result, error=result.get('error'), timings=result.get('timings'),
+                                 finished_at=time.time())
+
+    def _run(self, handle: JobHandle, task: Callable[[JobHandle], Dict[str, Any]]) -> None:
+        try:
+            if not self._start(handle):
+                return
+            try:
+                result = task(handle)
+                handle.check()
+            except Exception as e:
+                self._finish(handle, None, e)
+                return
+            self._finish(handle, result, None)
+        finally:
+            self._release()
+
+
+class AsyncJobHandle(JobHandle):
+    """异步模式的句柄：任务表读写交给单线程执行器 (按提交顺序写入)，事件循环线程上不做阻塞的 SQLite 调用。
+
+    check() 只检查截止时间和上一次读到的取消标记，同时提交一次状态刷新，因此取消会在下一个检查点生效。
+    """
+
+    def __init__(self, store: JobStore, job_id: str, params: Dict[str, Any], executor: ThreadPoolExecutor):
+        super().__init__(store, job_id, params)
+        self._executor = executor
+        self._cancelled = False
+
+    def _refresh(self) -> None:
+        self._cancelled = self.store.status(self.job_id) == 'cancelled'
+
+    def check(self) -> None:
+        if self._cancelled:
+            raise JobCancelled("任务已被新的请求取代")
+        if time.time() > self.deadline:
+            raise JobCancelled(f"任务超时 (>{JOB_TIMEOUT_SECONDS:.0f}s)")
+        self._executor.submit(self._refresh)
+
+    def report(self, stage: str, result: Dict[str, Any]) -> None:
+        now = time.time()
+        if stage == self._last_stage and now - self._last_write < PROGRESS_MIN_INTERVAL:
+            return
+        self.check()
+        self._last_stage = stage
+        self._last_write = now
+        # 结果字典会被流水线继续修改，先在当前线程序列化
+        self._executor.submit(self.store.update, self.job_id, stage=stage, result=json.dumps(result, ensure_ascii=False))
+
+
+class AsyncJobRunner(JobRunner):
+    """异步任务执行器：每个进程一个后台事件循环线程，任务是协程函数 task(handle) -> 结果。
+
+    workers 为同时执行的协程数上限 (asyncio.Semaphore)，等待上游时不占用线程，
+    因此单个 worker 进程可以同时挂起数百个生成任务。任务表的读写在单独的 job-store 线程中执行，不阻塞事件循环。
+    """
+
+    def __init__(self, store: JobStore, workers: int, queue_limit: int):
+        super().__init__(store, workers, queue_limit)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._store_executor: Optional[ThreadPoolExecutor] = None
+        self._running = 0
+
+    def _get_executor(self) -> asyncio.AbstractEventLoop:
+        # 事件循环线程同样不能跨 fork 继承，按 PID 懒加载
+        if self._loop is None or self._executor_pid != os.getpid():
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='job-loop', daemon=True).start()
+            self._semaphore = asyncio.Semaphore(self.workers)
+            self._store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='job-store')
+            self._loop = loop
+            self._executor_pid = os.getpid()
+            self._pending = 0
+            self._running = 0
+        return self._loop
+
+    @property
+    def running(self) -> int:
+        """本进程内正在执行 (已拿到并发名额) 的任务数。"""
+        return self._running if self._executor_pid == os.getpid() else 0
+
+    def submit(self, kind: str, params: Dict[str, Any],
+               task: Callable[[JobHandle], Awaitable[Dict[str, Any]]]) -> Optional[str]:
+        if not self._reserve():
+            return None
+        job_id = self._create(kind, params)
+        handle = AsyncJobHandle(self.store, job_id, params, self._store_executor)
+        asyncio.run_coroutine_threadsafe(self._run_async(handle, task), self._loop)
+        return job_id
+
+    async def _in_store_thread(self, func: Callable[..., Any], *args: Any) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._store_executor, func, *args)
+
+    async def _run_async(self, handle: AsyncJobHandle, task: Callable[[JobHandle], Awaitable[Dict[str, Any]]]) -> None:
+        try:
+            async with self._semaphore:
+                if not await self._in_store_thread(self._start, handle):
+                    return
+                self._running += 1
+                try:
+                    result = await task(handle)
+                    # 最终状态以任务表为准：等待此前排队的进度写入与状态刷新完成后再检查取消
+                    await self._in_store_thread(handle._refresh)
+                    handle.check()
+                except Exception as e:
+                    await self._in_store_thread(self._finish, handle, None, e)
+                    return
+                finally:
+                    self._running -= 1
+                await self._in_store_thread(self._finish, handle, result, None)
+        finally:
+            self._release()
+
+
+job_store = JobStore(JOB_DB_PATH)
+job_runner = JobRunner(job_store, JOB_WORKERS, JOB_QUEUE_LIMIT)
+async_job_runner = AsyncJobRunner(job_store, ASYNC_JOB_CONCURRENCY, ASYNC_JOB_QUEUE_LIMIT)
@@ -0,0 +1,341 @@
+import asyncio
+import json
+import os
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Dict, Iterator, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import admission
+import metrics
+
+try:
+    import httpx
+except ImportError:  # 仅异步模式需要
+    httpx = None
+
+# ==============================================================================
+# 共享 HTTP 客户端：连接池 + 重试 + 熔断
+# ==============================================================================
+# 每个 gunicorn worker 进程持有一个独立的 Session (fork 之后按 PID 重新创建)，
+# 连接池大小按单个 worker 的并发线程数设置，复用 TCP+TLS 连接。
+
+POOL_SIZE = int(os.environ.get('LLM_POOL_SIZE', '8'))
+CONNECT_TIMEOUT = float(os.environ.get('LLM_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.environ.get('LLM_READ_TIMEOUT', '90'))
+
+MAX_RETRIES = int(os.environ.get('LLM_MAX_RETRIES', '3'))
+BACKOFF_BASE = float(os.environ.get('LLM_BACKOFF_BASE', '0.5'))
+BACKOFF_MAX = float(os.environ.get('LLM_BACKOFF_MAX', '8'))
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# 异步模式下每个 worker 进程的上游连接上限，同时也是该进程可并发挂起的上游调用数
+ASYNC_POOL_SIZE = int(os.environ.get('LLM_ASYNC_POOL_SIZE', '256'))
+
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get('LLM_BREAKER_THRESHOLD', '5'))
+BREAKER_RESET_SECONDS = float(os.environ.get('LLM_BREAKER_RESET', '30'))
+
+
+class CircuitBreaker:
+    """简单的三态熔断器 (closed / open / half-open)，上游连续失败时快速失败。"""
+
+    def __init__(self, failure_threshold: int, reset_seconds: float):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        self._half_open_probe = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at >= self.reset_seconds:
+                return "half-open"
+            return "open"
+
+    def allow_request(self) -> bool:
+        return self.acquire() is not None
+
+    def acquire(self) -> Optional[str]:
+        """放行时返回 'closed' 或 'probe' (半开状态下唯一的探测请求)，拒绝时返回 None。"""
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if time.monotonic() - self._opened_at < self.reset_seconds:
+                return None
+            # 冷却期结束：只放行一个探测请求
+            if self._half_open_probe:
+                return None
+            self._half_open_probe = True
+            return "probe"
+
+    def release_probe(self) -> None:
+        """探测请求未得出结果 (被准入控制拒绝、取消或意外异常) 时归还探测名额，不改变熔断状态。"""
+        with self._lock:
+            self._half_open_probe = False
+
+    def record_success(self) -> None:
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._half_open_probe = False
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._half_open_probe or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+            self._half_open_probe = False
+
+
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+
+_session: Optional[requests.Session] = None
+_session_pid: Optional[int] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """返回当前进程的共享 Session；gunicorn fork 之后会自动重建，避免跨进程共享套接字。"""
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _session_lock:
+            if _session is None or _session_pid != pid:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE, max_retries=0)
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+                _session_pid = pid
+    return _session
+
+
+def _retry_after_seconds(response: requests.Response) -> Optional[float]:
+    """解析 Retry-After 头 (秒数或 HTTP 日期)。"""
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _backoff_delay(attempt: int) -> float:
+    """带 full jitter 的指数退避。"""
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt)))
+
+
+def _next_delay(attempt: int, retry_after: Optional[float]) -> Optional[float]:
+    """下一次重试前的等待秒数；返回 None 表示不再重试。"""
+    if attempt == MAX_RETRIES:
+        return None
+    if retry_after is None:
+        return _backoff_delay(attempt)
+    if retry_after > BACKOFF_MAX:
+        # 上游要求的等待时间过长，直接失败而不是占住 worker
+        return None
+    return retry_after
+
+
+def post_json(url: str, headers: Dict[str, str], payload: Dict[str, Any],
+              stream: bool = False) -> Tuple[Optional[requests.Response], Optional[str]]:
+    """POST 到上游，自动重试 429/5xx 与连接错误。返回 (response, error)，response 的状态码恒为 200。"""
+    tokens = admission.estimate_tokens(payload)
+    try:
+        # 先取得全局令牌桶配额再检查熔断器，避免半开探测名额被排队或拒绝的请求占住
+        admission.controller.acquire_upstream(tokens)
+    except admission.AdmissionRejected as e:
+        return None, str(e)
+    permit = breaker.acquire()
+    if permit is None:
+        metrics.UPSTREAM_RESPONSES.inc(status='circuit_open')
+        return None, "上游服务暂时不可用 (熔断器已打开)，请稍后重试。"
+
+    session = get_session()
+    last_error = None
+    resolved = False
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            delay = None
+            if attempt:
+                try:
+                    # 每次重试同样要先从令牌桶取得配额，避免突发流量触发上游 429
+                    admission.controller.acquire_upstream(tokens)
+                except admission.AdmissionRejected as e:
+                    return None, str(e)
+            try:
+                response = session.post(url, headers=headers, json=payload, stream=stream,
+                                        timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
+            except requests.Timeout as e:
+                metrics.UPSTREAM_RESPONSES.inc(status='timeout')
+                metrics.UPSTREAM_TIMEOUTS.inc()
+                last_error = f"API 请求超时: {e}"
+            except requests.ConnectionError as e:
+                metrics.UPSTREAM_RESPONSES.inc(status='connect_error')
+                last_error = f"API 连接异常: {e}"
+            except requests.RequestException as e:
+                # ChunkedEncodingError 等其余传输层异常同样计为失败并重试
+                metrics.UPSTREAM_RESPONSES.inc(status='error')
+                last_error = f"API 请求异常: {e}"
+            else:
+                metrics.UPSTREAM_RESPONSES.inc(status=str(response.status_code))
+                if response.status_code == 200:
+                    breaker.record_success()
+                    resolved = True
+                    return response, None
+                last_error = f"API Error: Status {response.status_code}, {response.text}"
+                if response.status_code not in RETRY_STATUS_CODES:
+                    # 4xx (除 429) 属于请求本身的问题，不计入熔断
+                    breaker.record_success()
+                    resolved = True
+                    return None, last_error
+                delay = _retry_after_seconds(response)
+                response.close()
+
+            delay = _next_delay(attempt, delay)
+            if delay is None:
+                break
+            time.sleep(delay)
+
+        breaker.record_failure()
+        resolved = True
+        return None, last_error
+    finally:
+        if permit == "probe" and not resolved:
+            breaker.release_probe()
+
+
+def is_timeout(exc: BaseException) -> bool:
+    """流式读取中的超时会被 requests 包装成 ConnectionError，这里一并识别。"""
+    if httpx is not None and isinstance(exc, httpx.TimeoutException):
+        return True
+    return isinstance(exc, requests.Timeout) or 'timed out' in str(exc).lower()
+
+
+def iter_sse_events(response: requests.Response) -> Iterator[Dict[str, Any]]:
+    """逐条解析 SSE 流中的 data 事件 (OpenAI 兼容格式)，遇到 [DONE] 结束。"""
+    try:
+        for line in response.iter_lines():
+            if not line or not line.startswith(b'data:'):
+                # 空行是事件分隔符，": keep-alive" 等注释行直接忽略
+                continue
+            data = line[len(b'data:'):].strip()
+            if data == b'[DONE]':
+                return
+            yield json.loads(data.decode('utf-8'))
+    finally:
+        response.close()
+
+
+# ------------------------------------------------------------------------------
+# 异步客户端 (可选依赖 httpx)：一个事件循环即可同时挂起数百个上游调用，不占用线程
+# ------------------------------------------------------------------------------
+
+_async_client: Optional["httpx.AsyncClient"] = None
+_async_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_async_client() -> "httpx.AsyncClient":
+    """返回当前事件循环的共享 AsyncClient (连接池绑定在创建它的事件循环上)。"""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=ASYNC_POOL_SIZE, max_keepalive_connections=ASYNC_POOL_SIZE),
+            # pool=None：连接数达到上限时排队等待，而不是报错
+            timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT, pool=None),
+        )
+        _async_client_loop = loop
+    return _async_client
+
+
+async def post_json_async(url: str, headers: Dict[str, str], payload: Dict[str, Any],
+                          stream: bool = False) -> Tuple[Optional["httpx.Response"], Optional[str]]:
+    """post_json 的异步版本，重试、熔断与指标行为一致。stream=True 时调用方负责读完或关闭响应。"""
+    tokens = admission.estimate_tokens(payload)
+    try:
+        await admission.controller.acquire_upstream_async(tokens)
+    except admission.AdmissionRejected as e:
+        return None, str(e)
+    permit = breaker.acquire()
+    if permit is None:
+        metrics.UPSTREAM_RESPONSES.inc(status='circuit_open')
+        return None, "上游服务暂时不可用 (熔断器已打开)，请稍后重试。"
+
+    client = get_async_client()
+    last_error = None
+    resolved = False
+    try:
+        for attempt in range(MAX_RETRIES + 1):
+            delay = None
+            if attempt:
+                try:
+                    await admission.controller.acquire_upstream_async(tokens)
+                except admission.AdmissionRejected as e:
+                    return None, str(e)
+            try:
+                response = await client.send(client.build_request('POST', url, headers=headers, json=payload), stream=stream)
+            except httpx.TimeoutException as e:
+                metrics.UPSTREAM_RESPONSES.inc(status='timeout')
+                metrics.UPSTREAM_TIMEOUTS.inc()
+                last_error = f"API 请求超时: {e!r}"
+            except httpx.TransportError as e:
+                metrics.UPSTREAM_RESPONSES.inc(status='connect_error')
+                last_error = f"API 连接异常: {e!r}"
+            except httpx.HTTPError as e:
+                metrics.UPSTREAM_RESPONSES.inc(status='error')
+                last_error = f"API 请求异常: {e!r}"
+            else:
+                metrics.UPSTREAM_RESPONSES.inc(status=str(response.status_code))
+                if response.status_code == 200:
+                    breaker.record_success()
+                    resolved = True
+                    return response, None
+                body = (await response.aread()).decode('utf-8', errors='replace')
+                last_error = f"API Error: Status {response.status_code}, {body}"
+                await response.aclose()
+                if response.status_code not in RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    resolved = True
+                    return None, last_error
+                delay = _retry_after_seconds(response)
+
+            delay = _next_delay(attempt, delay)
+            if delay is None:
+                break
+            await asyncio.sleep(delay)
+
+        breaker.record_failure()
+        resolved = True
+        return None, last_error
+    finally:
+        # 被取消 (CancelledError) 或意外异常时同样归还探测名额
+        if permit == "probe" and not resolved:
+            breaker.release_probe()
+
+
+async def aiter_sse_events(response: "httpx.Response") -> AsyncIterator[Dict[str, Any]]:
+    """iter_sse_events 的异步版本。"""
+    try:
+        async for line in response.aiter_lines():
+            if not line.startswith('data:'):
+                continue
+            data = line[len('data:'):].strip()
+            if data == '[DONE]':
+                return
+            yield json.loads(data)
+    finally:
+        await response.aclose()
@@ -0,0 +1,304 @@
+import contextvars
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# ==============================================================================
+# Prometheus 文本格式指标 + 轻量级 span 追踪日志
+# ==============================================================================
+# 不依赖 prometheus_client。gunicorn 多 worker 部署时设置 METRICS_DIR，
+# 每个进程定期把自己的指标快照写到该目录，/metrics 在抓取时合并所有进程的数据。
+
+METRICS_DIR = os.environ.get('METRICS_DIR')
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', '5'))
+METRICS_STALE_SECONDS = float(os.environ.get('METRICS_STALE_SECONDS', '300'))
+TRACE_LOG_ENABLED = os.environ.get('TRACE_LOG', '1') != '0'
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 90, 120)
+
+_lock = threading.Lock()
+_registry: Dict[str, "_Metric"] = {}
+
+
+class _Metric:
+    def __init__(self, kind: str, name: str, documentation: str, labelnames: Sequence[str]):
+        self.kind = kind
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.samples: Dict[Tuple[str, ...], Any] = {}
+        _registry[name] = self
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__('counter', name, documentation, labelnames)
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with _lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__('gauge', name, documentation, labelnames)
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = self._key(labels)
+        with _lock:
+            self.samples[key] = self.samples.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: Any) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: Any) -> None:
+        with _lock:
+            self.samples[self._key(labels)] = value
+
+    @contextmanager
+    def track_inprogress(self, **labels: Any) -> Iterator[None]:
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+
+class Histogram(_Metric):
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__('histogram', name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = self._key(labels)
+        with _lock:
+            state = self.samples.get(key)
+            if state is None:
+                state = self.samples[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['buckets'][i] += 1
+            state['sum'] += value
+            state['count'] += 1
+
+
+# ------------------------------------------------------------------------------
+# 指标定义
+# ------------------------------------------------------------------------------
+
+STAGE_DURATION = Histogram(
+    'prompt_stage_duration_seconds', "生成流水线各阶段耗时 (creative / formatting / fused / reask / json_parse)",
+    ('stage', 'style'))
+GENERATION_DURATION = Histogram(
+    'prompt_generation_duration_seconds', "一次完整生成的端到端耗时", ('style', 'mode'))
+GENERATIONS = Counter(
+    'prompt_generations_total', "完成的生成次数 (outcome: ok / error / fallback)", ('style', 'mode', 'outcome'))
+STYLE_CLICKS = Counter(
+    'prompt_style_clicks_total', "风格按钮点击次数", ('style',))
+UPSTREAM_RESPONSES = Counter(
+    'prompt_upstream_responses_total', "上游 HTTP 响应 (status 为状态码、timeout、connect_error 或 circuit_open)",
+    ('status',))
+UPSTREAM_TIMEOUTS = Counter(
+    'prompt_upstream_timeouts_total', "上游请求超时次数")
+INFLIGHT = Gauge(
+    'prompt_inflight_requests', "正在进行中的上游调用数", ('stage',))
+GENERATIONS_INFLIGHT = Gauge(
+    'prompt_generations_inflight', "正在执行中的生成流水线数")
+
+# 无标签的指标预先初始化为 0，保证抓取结果中始终存在该序列
+UPSTREAM_TIMEOUTS.inc(0)
+GENERATIONS_INFLIGHT.inc(0)
+
+
+# ------------------------------------------------------------------------------
+# 追踪：一个请求 ID 贯穿 点击 → 任务 → 两次上游调用
+# ------------------------------------------------------------------------------
+
+_trace_id: contextvars.ContextVar[str] = contextvars.ContextVar('trace_id', default='-')
+trace_logger = logging.getLogger('prompt_generator.trace')
+if TRACE_LOG_ENABLED and not trace_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter('%(message)s'))
+    trace_logger.addHandler(_handler)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = False
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id() -> str:
+    return _trace_id.get()
+
+
+@contextmanager
+def trace_context(request_id: Optional[str]) -> Iterator[str]:
+    """在当前线程/协程中设置请求 ID，之后的 span 日志都会带上它。"""
+    request_id = request_id or new_request_id()
+    token = _trace_id.set(request_id)
+    try:
+        yield request_id
+    finally:
+        _trace_id.reset(token)
+
+
+def log_event(name: str, **attrs: Any) -> None:
+    if TRACE_LOG_ENABLED:
+        trace_logger.info(json.dumps({'ts': round(time.time(), 3), 'trace': _trace_id.get(), 'event': name, **attrs},
+                                     ensure_ascii=False, default=str))
+
+
+@contextmanager
+def span(name: str, **attrs: Any) -> Iterator[Dict[str, Any]]:
+    """记录一个 span：结束时输出一行 JSON 日志 (含耗时与状态)。可向 yield 出的字典追加属性。"""
+    started = time.perf_counter()
+    extra: Dict[str, Any] = {}
+    status = 'ok'
+    try:
+        yield extra
+    except BaseException as e:
+        status = f"exception:{type(e).__name__}"
+        raise
+    finally:
+        if extra.get('error'):
+            status = 'error'
+        log_event(name, span_ms=round((time.perf_counter() - started) * 1000, 1), status=status, **attrs, **extra)
+
+
+# ------------------------------------------------------------------------------
+# 导出 (含多进程合并)
+# ------------------------------------------------------------------------------
+
+def _snapshot() -> Dict[str, Any]:
+    with _lock:
+        return {
+            name: {
+                'kind': metric.kind, 'doc': metric.documentation, 'labels': list(metric.labelnames),
+                'buckets': list(getattr(metric, 'buckets', ())),
+                'samples': [[list(key), json.loads(json.dumps(value))] for key, value in metric.samples.items()],
+            }
+            for name, metric in _registry.items()
+        }
+
+
+_flusher_pid: Optional[int] = None
+
+
+def _snapshot_path() -> str:
+    return os.path.join(METRICS_DIR, f"metrics-{os.getpid()}.json")
+
+
+def flush() -> None:
+    """把本进程的指标快照原子地写入 METRICS_DIR。"""
+    if not METRICS_DIR:
+        return
+    os.makedirs(METRICS_DIR, exist_ok=True)
+    path = _snapshot_path()
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(_snapshot(), f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def start_flusher() -> None:
+    """启动后台线程定期写快照 (每个进程只启动一次；gunicorn fork 出的 worker 会各自重新启动)。"""
+    global _flusher_pid
+    if not METRICS_DIR or _flusher_pid == os.getpid():
+        return
+    _flusher_pid = os.getpid()
+
+    def loop():
+        while True:
+            time.sleep(METRICS_FLUSH_SECONDS)
+            try:
+                flush()
+            except OSError as e:
+                print(f"警告：写入指标快照失败: {e}")
+
+    threading.Thread(target=loop, name='metrics-flusher', daemon=True).start()
+
+
+def _collect_all() -> List[Dict[str, Any]]:
+    if not METRICS_DIR:
+        return [_snapshot()]
+    flush()
+    snapshots = []
+    now = time.time()
+    for path in glob.glob(os.path.join(METRICS_DIR, 'metrics-*.json')):
+        try:
+            if now - os.path.getmtime(path) > METRICS_STALE_SECONDS:
+                # 已退出的 worker 留下的快照
+                os.remove(path)
+                continue
+            with open(path, encoding='utf-8') as f:
+                snapshots.append(json.load(f))
+        except (OSError, json.JSONDecodeError):
+            continue
+    return snapshots
+
+
+def _merge(snapshots: List[Dict[str, Any]]) -> Dict[str, Any]:
+    merged: Dict[str, Any] = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot.items():
+            target = merged.setdefault(name, dict(metric, samples={}))
+            for key, value in metric['samples']:
+                key = tuple(key)
+                if metric['kind'] == 'histogram':
+                    state = target['samples'].setdefault(key, {'buckets': [0] * len(metric['buckets']), 'sum': 0.0, 'count': 0})
+                    state['buckets'] = [a + b for a, b in zip(state['buckets'], value['buckets'])]
+                    state['sum'] += value['sum']
+                    state['count'] += value['count']
+                else:
+                    target['samples'][key] = target['samples'].get(key, 0) + value
+    return merged
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(f'{extra[0]}="{extra[1]}"')
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+def render(extra_gauges: Optional[Dict[str, Tuple[str, Dict[Tuple[Tuple[str, str], ...], float]]]] = None) -> str:
+    """生成 Prometheus 文本格式。extra_gauges 用于在抓取时附加即时读取的指标 (如任务队列深度)。"""
+    lines: List[str] = []
+    for name, metric in sorted(_merge(_collect_all()).items()):
+        lines.append(f"# HELP {name} {metric['doc']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric['samples'].items()):
+            if metric['kind'] == 'histogram':
+                for bound, cumulative in zip(metric['buckets'], value['buckets']):
+                    lines.append(f"{name}_bucket{_labels(metric['labels'], key, ('le', _format_bound(bound)))} {cumulative}")
+                lines.append(f"{name}_bucket{_labels(metric['labels'], key, ('le', '+Inf'))} {value['count']}")
+                lines.append(f"{name}_sum{_labels(metric['labels'], key)} {value['sum']}")
+                lines.append(f"{name}_count{_labels(metric['labels'], key)} {value['count']}")
+            else:
+                lines.append(f"{name}{_labels(metric['labels'], key)} {value}")
+    for name, (doc, samples) in (extra_gauges or {}).items():
+        lines.append(f"# HELP {name} {doc}")
+        lines.append(f"# TYPE {name} gauge")
+        for label_pairs, value in samples.items():
+            lines.append(f"{name}{_labels([k for k, _ in label_pairs], [v for _, v in label_pairs])} {value}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,372 @@
+"""本地 DeepSeek chat-completions 替身服务，用于压测与回归测试 (不消耗真实 API 额度)。
+
+支持：可配置的延迟分布、SSE 流式输出 (含 include_usage)、500/503 与 429 (Retry-After) 注入、
+格式错误的 JSON 回复注入 (可修复与不可修复两类)，以及模拟上下文缓存命中的 usage 字段。
+
+用法：
+    python mock_deepseek.py --port 18000 --latency lognormal:1.2,0.4 --error-rate 0.02 --rate-limit-rate 0.05
+    DEEPSEEK_API_BASE=http://127.0.0.1:18000/v1/chat/completions python app.py
+
+也可以用 gunicorn 运行 (参数改用环境变量 MOCK_*，见 MockConfig.from_env)：
+    MOCK_LATENCY=uniform:0.5,2 gunicorn -k gthread --threads 64 -b 127.0.0.1:18000 mock_deepseek:server
+
+延迟分布写法 ("类型:参数")：
+    fixed:1.0            固定 1 秒
+    uniform:0.5,2        0.5 ~ 2 秒均匀分布
+    normal:1.5,0.3       均值 1.5、标准差 0.3 (截断到 >= 0)
+    lognormal:1.2,0.4    中位数 1.2、对数标准差 0.4 (长尾，更接近真实上游)
+
+GET /mock/stats 返回各类注入与响应的计数，POST /mock/stats/reset 清零。
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import flask
+
+FORMAT_KEY_RE = re.compile(r"'(raw_chinese_prompt|final_\w+)'")
+REASK_RE = re.compile(r"缺少以下键或其值无效：(.*?)。")
+THEME_RE = re.compile(r"【(.*?)】")
+# DeepSeek 的上下文缓存以 64 token 为单位命中
+CACHE_UNIT_TOKENS = 64
+# 格式错误回复的类型：前 4 种可以被 structured_output 在本地修复，最后一种无法修复
+MALFORMED_KINDS = ('prose', 'trailing_comma', 'truncated', 'missing_key', 'garbage')
+
+FILLER_SENTENCES = (
+    "她站在画面中央，身姿挺拔，目光坚定地望向远方。",
+    "柔和的侧逆光勾勒出人物的轮廓，发丝在微风中轻轻扬起。",
+    "背景是层次丰富的场景，远处的细节在薄雾中若隐若现。",
+    "服装的材质纹理清晰可见，褶皱与配饰都经过精心刻画。",
+    "整体色调统一而富有对比，氛围庄重又带着一丝神秘。",
+    "前景点缀着散落的细小元素，引导视线回到主体人物身上。",
+)
+
+
+def parse_latency(spec: str) -> Tuple[str, List[float]]:
+    """解析 "类型:参数1,参数2" 形式的延迟分布。"""
+    kind, _, args = spec.partition(':')
+    params = [float(x) for x in args.split(',') if x.strip()]
+    expected = {'fixed': 1, 'uniform': 2, 'normal': 2, 'lognormal': 2}
+    if kind not in expected or len(params) != expected[kind]:
+        raise ValueError(f"无效的延迟分布: {spec!r} (示例: fixed:1, uniform:0.5,2, normal:1.5,0.3, lognormal:1.2,0.4)")
+    return kind, params
+
+
+class MockConfig:
+    def __init__(self, latency: str = 'lognormal:1.0,0.4', ttft_ratio: float = 0.15, stream_chunks: int = 40,
+                 reply_chars: int = 300, error_rate: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: float = 1.0, malformed_rate: float = 0.0, seed: Optional[int] = None):
+        self.latency = parse_latency(latency)
+        self.latency_spec = latency
+        self.ttft_ratio = ttft_ratio
+        self.stream_chunks = max(1, stream_chunks)
+        self.reply_chars = reply_chars
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.malformed_rate = malformed_rate
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls) -> "MockConfig":
+        seed = os.environ.get('MOCK_SEED')
+        return cls(
+            latency=os.environ.get('MOCK_LATENCY', 'lognormal:1.0,0.4'),
+            ttft_ratio=float(os.environ.get('MOCK_TTFT_RATIO', '0.15')),
+            stream_chunks=int(os.environ.get('MOCK_STREAM_CHUNKS', '40')),
+            reply_chars=int(os.environ.get('MOCK_REPLY_CHARS', '300')),
+            error_rate=float(os.environ.get('MOCK_ERROR_RATE', '0')),
+            rate_limit_rate=float(os.environ.get('MOCK_RATE_LIMIT_RATE', '0')),
+            retry_after=float(os.environ.get('MOCK_RETRY_AFTER', '1')),
+            malformed_rate=float(os.environ.get('MOCK_MALFORMED_RATE', '0')),
+            seed=int(seed) if seed else None,
+        )
+
+    def random(self) -> float:
+        with self.rng_lock:
+            return self.rng.random()
+
+    def choice(self, seq):
+        with self.rng_lock:
+            return self.rng.choice(seq)
+
+    def sample_latency(self) -> float:
+        kind, params = self.latency
+        with self.rng_lock:
+            if kind == 'fixed':
+                value = params[0]
+            elif kind == 'uniform':
+                value = self.rng.uniform(*params)
+            elif kind == 'normal':
+                value = self.rng.gauss(*params)
+            else:
+                median, sigma = params
+                value = median * self.rng.lognormvariate(0, sigma)
+        return max(0.0, value)
+
+
+# ------------------------------------------------------------------------------
+# 回复内容
+# ------------------------------------------------------------------------------
+
+def _estimate_tokens(text: str) -> int:
+    # 中文约 1 字 1 token，ASCII 约 4 字符 1 token，足够用于压测中的用量统计
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return max(1, (len(text) - ascii_chars) + ascii_chars // 4)
+
+
+def _chinese_text(theme: str, chars: int, rng_choice) -> str:
+    parts = [f"{theme}。"]
+    while sum(len(p) for p in parts) < chars:
+        parts.append(rng_choice(FILLER_SENTENCES))
+    return ''.join(parts)
+
+
+def _json_reply(keys: List[str], theme: str, config: MockConfig) -> Dict[str, str]:
+    raw = _chinese_text(theme, config.reply_chars, config.choice)
+    values = {
+        'raw_chinese_prompt': raw,
+        'final_tag': "masterpiece, best quality, ultra detailed, 1girl, solo, standing, looking afar, "
+                     "backlighting, wind, detailed background, mist, intricate clothes",
+        'final_natural': "A highly detailed illustration of a woman standing in the center of the frame, "
+                         "rim lit by soft backlight, with a richly layered misty background.",
+        'final_negative': "no males, no boys, lowres, bad anatomy, bad hands, text, error, missing fingers, "
+                          "extra digit, cropped, worst quality, low quality, jpeg artifacts, watermark",
+        'final_chinese_natural': raw + "画面细节精致，光影层次分明。",
+        'final_chinese_negative': "无男性，低分辨率，糟糕的解剖结构，多余的手指，水印，低质量",
+        # 带本地标签提示的精简格式化请求只要求补充缺失的标签
+        'final_extra_tags': "wind, mist, intricate clothes, detailed background",
+    }
+    return {key: values.get(key, f"mock value for {key}") for key in keys}
+
+
+def _malform(data: Dict[str, str], kind: str) -> str:
+    text = json.dumps(data, ensure_ascii=False)
+    if kind == 'prose':
+        return f"好的，以下是格式化结果：\n```json\n{text}\n```\n希望对您有帮助。"
+    if kind == 'trailing_comma':
+        return text[:-1] + ',}'
+    if kind == 'truncated':
+        return text[:int(len(text) * 0.8)]
+    if kind == 'missing_key' and len(data) > 1:
+        return json.dumps(dict(list(data.items())[:-1]), ensure_ascii=False)
+    return "抱歉，我无法完成这个请求。"
+
+
+def build_reply(payload: Dict[str, Any], config: MockConfig) -> Tuple[str, Optional[str]]:
+    """根据请求内容构造回复文本，返回 (回复, 注入的格式错误类型)。"""
+    messages = payload.get('messages') or []
+    system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+    user = next((m.get('content', '') for m in messages if m.get('role') == 'user'), '')
+    theme_match = THEME_RE.search(user)
+    theme = theme_match.group(1) if theme_match else user[:40]
+
+    json_mode = (payload.get('response_format') or {}).get('type') == 'json_object'
+    if not json_mode:
+        return _chinese_text(theme, config.reply_chars, config.choice), None
+
+    reask = REASK_RE.search(user)
+    if reask:
+        # 补键追问：只返回被要求的键
+        keys = [key.strip() for key in reask.group(1).split(',') if key.strip()]
+    else:
+        keys = list(dict.fromkeys(FORMAT_KEY_RE.findall(system))) or ['final_tag']
+    data = _json_reply(keys, theme, config)
+    if not reask and config.random() < config.malformed_rate:
+        kind = config.choice(MALFORMED_KINDS)
+        return _malform(data, kind), kind
+    return json.dumps(data, ensure_ascii=False), None
+
+
+# ------------------------------------------------------------------------------
+# 服务
+# ------------------------------------------------------------------------------
+
+class MockStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        with self._lock:
+            self.counts: Dict[str, int] = {}
+            self.started = time.time()
+
+    def inc(self, key: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counts[key] = self.counts.get(key, 0) + amount
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'uptime_seconds': round(time.time() - self.started, 1), 'counts': dict(sorted(self.counts.items()))}
+
+
+class PrefixCache:
+    """模拟上游的前缀缓存：同一个系统提示词第二次出现时，其 token 按 64 的整数倍计为命中。"""
+
+    def __init__(self, limit: int = 4096):
+        self._seen: Dict[str, None] = {}
+        self._lock = threading.Lock()
+        self.limit = limit
+
+    def hit_tokens(self, system_prompt: str) -> int:
+        digest = hashlib.sha256(system_prompt.encode('utf-8')).hexdigest()
+        with self._lock:
+            seen = digest in self._seen
+            self._seen[digest] = None
+            if len(self._seen) > self.limit:
+                self._seen.pop(next(iter(self._seen)))
+        if not seen:
+            return 0
+        return _estimate_tokens(system_prompt) // CACHE_UNIT_TOKENS * CACHE_UNIT_TOKENS
+
+
+def create_app(config: MockConfig) -> flask.Flask:
+    mock = flask.Flask(__name__)
+    stats = MockStats()
+    prefix_cache = PrefixCache()
+
+    def usage_for(payload: Dict[str, Any], reply: str) -> Dict[str, int]:
+        messages = payload.get('messages') or []
+        system = next((m.get('content', '') for m in messages if m.get('role') == 'system'), '')
+        prompt_tokens = sum(_estimate_tokens(m.get('content', '')) for m in messages)
+        hit = min(prefix_cache.hit_tokens(system), prompt_tokens)
+        return {
+            'prompt_tokens': prompt_tokens, 'completion_tokens': _estimate_tokens(reply),
+            'total_tokens': prompt_tokens + _estimate_tokens(reply),
+            'prompt_cache_hit_tokens': hit, 'prompt_cache_miss_tokens': prompt_tokens - hit,
+        }
+
+    def injected_error() -> Optional[flask.Response]:
+        roll = config.random()
+        if roll < config.rate_limit_rate:
+            stats.inc('injected_429')
+            response = flask.jsonify({'error': {'message': 'Rate limit reached (mock)', 'type': 'rate_limit_error'}})
+            response.status_code = 429
+            response.headers['Retry-After'] = f"{config.retry_after:g}"
+            return response
+        if roll < config.rate_limit_rate + config.error_rate:
+            status = config.choice((500, 503))
+            stats.inc(f"injected_{status}")
+            response = flask.jsonify({'error': {'message': 'Server error (mock)', 'type': 'server_error'}})
+            response.status_code = status
+            return response
+        return None
+
+    def completion_id() -> str:
+        return f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+
+    @mock.route('/v1/chat/completions', methods=['POST'])
+    @mock.route('/chat/completions', methods=['POST'])
+    def chat_completions():
+        stats.inc('requests')
+        payload = flask.request.get_json(silent=True)
+        if not isinstance(payload, dict) or not payload.get('messages'):
+            stats.inc('bad_request')
+            return flask.jsonify({'error': {'message': 'messages is required', 'type': 'invalid_request_error'}}), 400
+
+        latency = config.sample_latency()
+        error_response = injected_error()
+        if error_response is not None:
+            # 错误响应通常比正常回复快，这里只等待一小部分延迟
+            time.sleep(latency * 0.1)
+            return error_response
+
+        reply, malformed = build_reply(payload, config)
+        if malformed:
+            stats.inc(f"malformed_{malformed}")
+        model = payload.get('model', 'deepseek-chat')
+        created = int(time.time())
+
+        if not payload.get('stream'):
+            time.sleep(latency)
+            stats.inc('completed')
+            return flask.jsonify({
+                'id': completion_id(), 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': reply}, 'finish_reason': 'stop'}],
+                'usage': usage_for(payload, reply),
+            })
+
+        include_usage = (payload.get('stream_options') or {}).get('include_usage')
+        usage_data = usage_for(payload, reply)
+
+        def events() -> Iterator[str]:
+            chunk_id = completion_id()
+            size = max(1, -(-len(reply) // config.stream_chunks))
+            chunks = [reply[i:i + size] for i in range(0, len(reply), size)]
+            ttft = latency * config.ttft_ratio
+            per_chunk = (latency - ttft) / max(1, len(chunks))
+            time.sleep(ttft)
+            for i, chunk in enumerate(chunks):
+                if i:
+                    time.sleep(per_chunk)
+                event = {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                         'choices': [{'index': 0, 'delta': {'content': chunk}, 'finish_reason': None}]}
+                yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+            final = {'id': chunk_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                     'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]}
+            yield f"data: {json.dumps(final)}\n\n"
+            if include_usage:
+                yield f"data: {json.dumps({'id': chunk_id, 'choices': [], 'usage': usage_data})}\n\n"
+            yield "data: [DONE]\n\n"
+            stats.inc('completed_stream')
+
+        return flask.Response(events(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    @mock.route('/mock/stats')
+    def mock_stats():
+        return flask.jsonify(dict(stats.snapshot(), config={
+            'latency': config.latency_spec, 'error_rate': config.error_rate,
+            'rate_limit_rate': config.rate_limit_rate, 'malformed_rate': config.malformed_rate}))
+
+    @mock.route('/mock/stats/reset', methods=['POST'])
+    def mock_stats_reset():
+        stats.reset()
+        return flask.jsonify({'reset': True})
+
+    return mock
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    defaults = MockConfig.from_env()
+    parser = argparse.ArgumentParser(description="本地 DeepSeek chat-completions 替身服务")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18000)
+    parser.add_argument('--latency', default=defaults.latency_spec, help="延迟分布，如 lognormal:1.2,0.4")
+    parser.add_argument('--ttft-ratio', type=float, default=defaults.ttft_ratio, help="流式首 token 延迟占总延迟的比例")
+    parser.add_argument('--stream-chunks', type=int, default=defaults.stream_chunks, help="流式回复拆分的事件数")
+    parser.add_argument('--reply-chars', type=int, default=defaults.reply_chars, help="中文回复的大致字数")
+    parser.add_argument('--error-rate', type=float, default=defaults.error_rate, help="返回 500/503 的概率")
+    parser.add_argument('--rate-limit-rate', type=float, default=defaults.rate_limit_rate, help="返回 429 的概率")
+    parser.add_argument('--retry-after', type=float, default=defaults.retry_after, help="429 响应的 Retry-After 秒数")
+    parser.add_argument('--malformed-rate', type=float, default=defaults.malformed_rate, help="JSON 回复格式错误的概率")
+    parser.add_argument('--seed', type=int, default=None, help="随机种子 (用于可复现的压测)")
+    args = parser.parse_args(argv)
+
+    try:
+        config = MockConfig(latency=args.latency, ttft_ratio=args.ttft_ratio, stream_chunks=args.stream_chunks,
+                            reply_chars=args.reply_chars, error_rate=args.error_rate,
+                            rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+                            malformed_rate=args.malformed_rate, seed=args.seed)
+    except ValueError as e:
+        parser.error(str(e))
+    print(f"DeepSeek 替身服务: http://{args.host}:{args.port}/v1/chat/completions", file=sys.stderr)
+    create_app(config).run(host=args.host, port=args.port, threaded=True)
+    return 0
+
+
+# 供 gunicorn mock_deepseek:server 使用 (参数取自 MOCK_* 环境变量)
+server = create_app(MockConfig.from_env())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
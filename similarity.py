@@ -0,0 +1,62 @@
+import random
+import re
+import zlib
+from typing import FrozenSet, Iterable, Sequence, Tuple
+
+# ==============================================================================
+# 近似重复检测：字符 n-gram 的 MinHash 签名 (估计 Jaccard 相似度) + 标签集合的精确 Jaccard
+# ==============================================================================
+# 中文描述没有空格分词，直接取去掉标点与空白后的连续 SHINGLE_SIZE 个字符作为特征；
+# 每个特征只做一次 crc32，再用 MINHASH_PERMUTATIONS 组 (a·x + b) mod p 模拟随机置换。
+# 两个签名中相同位置取值相等的比例即为 Jaccard 相似度的无偏估计。
+
+SHINGLE_SIZE = 3
+MINHASH_PERMUTATIONS = 128
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240601)  # 固定种子：同一进程内与跨 worker 的签名可以直接比较
+_PERMUTATIONS = tuple((_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(MINHASH_PERMUTATIONS))
+_IGNORED = re.compile(r'[\s\W_]+', re.UNICODE)
+
+# 几乎每条标签串都会带的质量/通用标签，参与比较只会抬高相似度
+COMMON_TAGS = frozenset({
+    'masterpiece', 'best quality', 'ultra detailed', 'high quality', 'highres', 'absurdres', '8k', '4k',
+    'extremely detailed', 'detailed background', 'solo', '1girl',
+})
+
+
+def shingles(text: str, size: int = SHINGLE_SIZE) -> FrozenSet[str]:
+    normalized = _IGNORED.sub('', text or '').lower()
+    if len(normalized) <= size:
+        return frozenset([normalized]) if normalized else frozenset()
+    return frozenset(normalized[i:i + size] for i in range(len(normalized) - size + 1))
+
+
+def minhash(features: Iterable[str]) -> Tuple[int, ...]:
+    hashes = [zlib.crc32(feature.encode('utf-8')) for feature in features]
+    if not hashes:
+        return (_PRIME,) * MINHASH_PERMUTATIONS
+    return tuple(min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMUTATIONS)
+
+
+def estimate_jaccard(a: Sequence[int], b: Sequence[int]) -> float:
+    return sum(1 for x, y in zip(a, b) if x == y) / len(a)
+
+
+def text_signature(text: str) -> Tuple[int, ...]:
+    return minhash(shingles(text))
+
+
+def tag_set(final_tag: str) -> FrozenSet[str]:
+    """把逗号分隔的标签串规范化为集合 (小写、下划线视同空格、去掉权重括号与通用标签)"""
+    tags = set()
+    for tag in (final_tag or '').split(','):
+        tag = re.sub(r'[(){}\[\]]|:[\d.]+', '', tag).replace('_', ' ').strip().lower()
+        if tag and tag not in COMMON_TAGS:
+            tags.add(' '.join(tag.split()))
+    return frozenset(tags)
+
+
+def jaccard(a: FrozenSet[str], b: FrozenSet[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
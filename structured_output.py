@@ -0,0 +1,121 @@
+import json
+import re
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# ==============================================================================
+# 结构化输出：容错 JSON 提取、常见缺陷修复与必需键校验
+# ==============================================================================
+# 模型偶尔会在 JSON 前后附加说明文字、输出被截断、或留下尾随逗号。
+# 这里尽量在本地修复，而不是让用户重新跑一遍完整的两次调用。
+
+_FENCE_RE = re.compile(r'```(?:json)?\s*|```', re.IGNORECASE)
+_TRAILING_COMMA_RE = re.compile(r',\s*([}\]])')
+
+_stats_lock = threading.Lock()
+_stats = {
+    'clean': 0,          # 直接 json.loads 成功
+    'repaired': 0,       # 经过提取/修复后成功
+    'unrecoverable': 0,  # 无法得到 JSON 对象
+    'reasked': 0,        # 发起了只补缺失键的追问
+    'reask_recovered': 0,  # 追问后补齐了全部键 (省下一次完整重跑)
+    'reask_failed': 0,
+}
+
+
+def count(field: str) -> None:
+    with _stats_lock:
+        _stats[field] += 1
+
+
+def stats() -> Dict[str, Any]:
+    with _stats_lock:
+        snapshot = dict(_stats)
+    parsed = snapshot['clean'] + snapshot['repaired'] + snapshot['unrecoverable']
+    snapshot['repair_rate'] = round(snapshot['repaired'] / parsed, 4) if parsed else 0.0
+    snapshot['reask_rate'] = round(snapshot['reasked'] / parsed, 4) if parsed else 0.0
+    return snapshot
+
+
+def _scan_object(text: str, start: int) -> Tuple[str, List[str]]:
+    """从 start 处的 '{' 开始做括号配对扫描 (跳过字符串内部)。
+
+    返回 (扫描到的片段, 未闭合的括号栈)，括号栈为空表示找到了完整的对象。
+    如果文本在字符串中间结束 (输出被截断)，片段会截止到该字符串之前，丢弃不完整的值。
+    """
+    stack: List[str] = []
+    in_string = False
+    escaped = False
+    string_start = start
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+            string_start = i
+        elif ch in '{[':
+            stack.append('}' if ch == '{' else ']')
+        elif ch in '}]':
+            if not stack or stack[-1] != ch:
+                # 括号不匹配：截止到这里，交给修复逻辑处理
+                return text[start:i], stack
+            stack.pop()
+            if not stack:
+                return text[start:i + 1], []
+    if in_string:
+        return text[start:string_start], stack
+    return text[start:], stack
+
+
+def _close_truncated(fragment: str, stack: List[str]) -> str:
+    """补全被截断的对象：去掉悬空的键或逗号，再按栈补齐括号。"""
+    fragment = re.sub(r'"(?:[^"\\]|\\.)*"\s*:\s*$', '', fragment.rstrip())
+    fragment = re.sub(r'[,:\s]+$', '', fragment)
+    return fragment + ''.join(reversed(stack))
+
+
+def _loads(candidate: str) -> Optional[Any]:
+    for text in (candidate, _TRAILING_COMMA_RE.sub(r'\1', candidate)):
+        try:
+            # strict=False 允许字符串内出现未转义的换行等控制字符
+            return json.loads(text, strict=False)
+        except json.JSONDecodeError:
+            continue
+    return None
+
+
+def extract_json_object(reply: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """从模型回复中提取 JSON 对象，返回 (对象, 错误)。会记录 clean/repaired/unrecoverable 计数。"""
+    text = _FENCE_RE.sub('', reply).strip()
+    try:
+        data = json.loads(text)
+        if isinstance(data, dict):
+            count('clean')
+            return data, None
+    except json.JSONDecodeError:
+        pass
+
+    start = text.find('{')
+    while start != -1:
+        fragment, stack = _scan_object(text, start)
+        candidate = _close_truncated(fragment, stack) if stack else fragment
+        data = _loads(candidate)
+        if isinstance(data, dict):
+            count('repaired')
+            return data, None
+        start = text.find('{', start + 1)
+
+    count('unrecoverable')
+    return None, "无法从回复中提取有效的 JSON 对象"
+
+
+def missing_keys(data: Dict[str, Any], required: Iterable[str]) -> List[str]:
+    """返回缺失、非字符串或为空的必需键。"""
+    return [key for key in required if not isinstance(data.get(key), str) or not data[key].strip()]
@@ -0,0 +1,123 @@
+import json
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+import tag_index
+
+# ==============================================================================
+# 风格注册表：styles.json → 按键索引的只读表 (导入后首次访问时加载，文件修改后自动热加载)
+# ==============================================================================
+# styles.json 结构：
+#   {"unknown_instructions": "...", "unknown_negative_profile": "sfw",
+#    "groups": [{"title": "分组标题", "styles": [{"key", "label", "color", "negative_profile", "instructions"}, ...]}]}
+# 每个风格在加载时用注册的构造函数 (如 创意共享前缀 + 风格说明) 预先拼接好全部系统提示词，
+# 请求路径上只有一次字典查找。表对象不可变，热加载时整体替换，读者无需加锁。
+# 各 gunicorn worker 各自检查文件的修改时间 (最多每 STYLES_RELOAD_INTERVAL 秒一次)，因此修改文件后无需重启；
+# 新文件无效时保留旧表并告警。
+
+STYLES_PATH = os.environ.get('STYLES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'styles.json'))
+STYLES_RELOAD_INTERVAL = float(os.environ.get('STYLES_RELOAD_INTERVAL', '2'))
+
+# 未知风格 (例如页面打开后风格已被删除) 在表中的键
+UNKNOWN_STYLE = "UNKNOWN"
+STYLE_FIELDS = ('key', 'label', 'color', 'negative_profile', 'instructions')
+
+
+class Style(NamedTuple):
+    index: int
+    key: str
+    label: str
+    color: str
+    group: str
+    negative_profile: str
+    instructions: str
+    prompts: Dict[str, str]  # 构造函数名 → 预先拼接好的系统提示词
+
+
+class StyleTable(NamedTuple):
+    version: int  # 文件修改时间 (纳秒)
+    styles: Tuple[Style, ...]
+    by_key: Dict[str, Style]
+    groups: Tuple[Tuple[str, Tuple[Style, ...]], ...]
+    unknown: Style
+
+    def get(self, key: Optional[str]) -> Style:
+        return self.by_key.get(key, self.unknown)
+
+
+def build_table(data: Dict[str, Any], builders: Dict[str, Callable[[str], str]], version: int = 0) -> StyleTable:
+    """校验注册表内容并预先生成全部系统提示词；格式错误时抛出 ValueError"""
+    def make(index: int, group: str, entry: Dict[str, Any]) -> Style:
+        missing = [field for field in STYLE_FIELDS if not isinstance(entry.get(field), str) or not entry[field]]
+        if missing:
+            raise ValueError(f"风格 #{index + 1} 缺少字段: {', '.join(missing)}")
+        _check_profile(entry['negative_profile'], entry['key'])
+        text = entry['instructions']
+        return Style(index, entry['key'], entry['label'], entry['color'], group, entry['negative_profile'], text,
+                     {name: build(text) for name, build in builders.items()})
+
+    styles: List[Style] = []
+    groups = []
+    for group in data.get('groups') or []:
+        members = tuple(make(len(styles) + i, group['title'], entry) for i, entry in enumerate(group.get('styles') or []))
+        styles.extend(members)
+        groups.append((group['title'], members))
+    by_key = {style.key: style for style in styles}
+    if len(by_key) != len(styles):
+        raise ValueError("风格键重复")
+    if not styles:
+        raise ValueError("注册表中没有任何风格")
+    text = data.get('unknown_instructions', '')
+    profile = data.get('unknown_negative_profile', tag_index.DEFAULT_NEGATIVE_PROFILE)
+    _check_profile(profile, UNKNOWN_STYLE)
+    unknown = Style(-1, UNKNOWN_STYLE, UNKNOWN_STYLE, 'secondary', "", profile, text,
+                    {name: build(text) for name, build in builders.items()})
+    return StyleTable(version, tuple(styles), by_key, tuple(groups), unknown)
+
+
+def _check_profile(profile: Any, key: str) -> None:
+    if profile not in tag_index.NEGATIVE_PROFILES:
+        raise ValueError(f"风格 {key} 的负面提示词档位 {profile!r} 无效 (可选: {', '.join(tag_index.NEGATIVE_PROFILES)})")
+
+
+class StyleRegistry:
+    def __init__(self, path: str, builders: Dict[str, Callable[[str], str]]):
+        self.path = path
+        self.builders = builders
+        self._lock = threading.Lock()
+        self._table: Optional[StyleTable] = None
+        self._checked = 0.0
+        self.reloads = 0
+
+    def table(self) -> StyleTable:
+        """当前风格表；距上次检查超过 STYLES_RELOAD_INTERVAL 时先检查文件是否被修改"""
+        table = self._table
+        if table is None or time.monotonic() - self._checked >= STYLES_RELOAD_INTERVAL:
+            table = self._refresh()
+        return table
+
+    def get(self, key: Optional[str]) -> Style:
+        return self.table().get(key)
+
+    def _refresh(self) -> StyleTable:
+        with self._lock:
+            if self._table is not None and time.monotonic() - self._checked < STYLES_RELOAD_INTERVAL:
+                return self._table
+            self._checked = time.monotonic()
+            try:
+                version = os.stat(self.path).st_mtime_ns
+                if self._table is None or version != self._table.version:
+                    with open(self.path, encoding='utf-8') as f:
+                        table = build_table(json.load(f), self.builders, version)
+                    if self._table is not None:
+                        self.reloads += 1
+                        print(f"风格注册表已重新加载：{len(table.styles)} 种风格 ({self.path})")
+                    self._table = table
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # 首次加载失败直接抛出 (没有风格无法提供服务)；热加载失败保留旧表
+                if self._table is None:
+                    raise
+                print(f"警告：风格注册表 {self.path} 加载失败，继续使用旧版本: {e}")
+            return self._table
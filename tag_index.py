@@ -0,0 +1,540 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import metrics
+
+# ==============================================================================
+# 本地中文 → Danbooru 标签索引：替代 (或缩短) 第二次格式化调用
+# ==============================================================================
+# 格式化调用的大部分输出是可以本地确定的：常见描述短语对应的 Danbooru 标签、固定的质量标签、
+# 以及几乎每次都相同的负面提示词。这里在导入时把短语词典编译成 Aho-Corasick 自动机，
+# 对原始中文提示词做一次线性扫描，得到：
+#   1. 规范化、去重 (含蕴含关系，如 very long hair 覆盖 long hair) 的标签列表；
+#   2. 覆盖率：实词字符中被短语命中的比例 (虚词、量词不计)。只要子句里有一个词没有对应标签
+#      (如 "穿着紧身宇航服的女性" 中只命中 "女性")，覆盖率就会相应降低，不会因为命中一个短语而整句算作覆盖；
+#   3. 按优先级裁剪到 CLIP 77 token 窗口内的 final_tag；
+#   4. 按风格档位从模板拼出的中英文负面提示词。
+# 覆盖率达到 TAG_INDEX_LOCAL_COVERAGE 时标签与负面提示词完全由本地给出，模型只写两段自然语言描述；
+# 达到 TAG_INDEX_HINT_COVERAGE 时把已匹配标签与未覆盖的子句作为提示发给模型，让它再补充缺失的标签；
+# 两种情况下输出都显著变短。否则仍走完整的格式化调用。
+# 自然语言描述需要模型才能写好，本地模板只是占位；设置 TAG_INDEX_OFFLINE=1 才在高覆盖率时完全跳过调用。
+# 词典规模有限，覆盖率阈值尚未用真实流量校准，因此默认关闭；设置 TAG_INDEX=1 开启。
+
+TAG_INDEX_ENABLED = os.environ.get('TAG_INDEX', '0') == '1'
+TAG_INDEX_OFFLINE = os.environ.get('TAG_INDEX_OFFLINE', '0') == '1'
+TAG_INDEX_LOCAL_COVERAGE = float(os.environ.get('TAG_INDEX_LOCAL_COVERAGE', '0.85'))
+TAG_INDEX_HINT_COVERAGE = float(os.environ.get('TAG_INDEX_HINT_COVERAGE', '0.3'))
+TAG_INDEX_STATS_WINDOW = 1000
+
+# CLIP 文本编码器的窗口为 77 token，去掉首尾的 BOS/EOS 后可用 75 个
+CLIP_TOKEN_BUDGET = int(os.environ.get('CLIP_TOKEN_BUDGET', '75'))
+
+FORMAT_PATH_LOCAL = "local"
+FORMAT_PATH_HINTED = "hinted"
+FORMAT_PATH_FULL = "full"
+FORMAT_PATHS = (FORMAT_PATH_LOCAL, FORMAT_PATH_HINTED, FORMAT_PATH_FULL)
+
+QUALITY_TAGS = ('masterpiece', 'best quality', 'ultra detailed')
+
+# 类别 → (预算裁剪优先级，越小越先保留；自然语言模板中的连接词)
+CATEGORIES: Dict[str, Tuple[int, str]] = {
+    'subject': (0, ""),
+    'nsfw': (1, ""),
+    'body': (1, "with"),
+    'clothing': (2, "wearing"),
+    'expression': (3, "with"),
+    'pose': (3, ""),
+    'scene': (4, "in"),
+    'lighting': (5, "under"),
+    'composition': (6, ""),
+    'atmosphere': (6, "with"),
+}
+# 模型补充的标签不知道类别，排在主体细节之后、背景之前
+EXTRA_TAG_PRIORITY = 4
+
+# 短语 → 标签 (逗号分隔，可以一对多)。同一文本位置按最长短语匹配，因此 "双马尾" 不会再命中 "马尾"。
+TAG_DICTIONARY: Dict[str, Dict[str, str]] = {
+    'subject': {
+        "少女": "1girl", "女孩": "1girl", "女性": "1girl", "女人": "1girl", "女子": "1girl",
+        "两位少女": "2girls", "两个女孩": "2girls", "两名女性": "2girls", "姐妹": "2girls, sisters",
+        "三位少女": "3girls", "一群少女": "multiple girls", "众多女性": "multiple girls",
+        "精灵": "elf, pointy ears", "猫娘": "cat girl, cat ears", "猫耳": "cat ears", "狐耳": "fox ears",
+        "兔耳": "rabbit ears", "狐尾": "fox tail", "天使": "angel, angel wings", "恶魔": "demon girl, horns",
+        "魅魔": "succubus, demon wings", "女神": "goddess", "修女": "nun", "女仆": "maid", "巫女": "miko",
+        "女骑士": "female knight", "骑士": "knight", "女王": "queen", "公主": "princess", "魔女": "witch",
+        "女巫": "witch", "忍者": "ninja", "偶像": "idol", "护士": "nurse", "女警": "policewoman",
+        "人鱼": "mermaid", "吸血鬼": "vampire", "机器人": "android", "盗贼": "thief", "祭司": "priestess",
+        "囚犯": "prisoner", "女学生": "schoolgirl", "模特": "model",
+    },
+    'body': {
+        "长发": "long hair", "及腰长发": "very long hair", "超长发": "very long hair", "短发": "short hair",
+        "中长发": "medium hair", "双马尾": "twintails", "马尾": "ponytail", "侧马尾": "side ponytail",
+        "麻花辫": "braid", "丸子头": "hair bun", "卷发": "wavy hair", "刘海": "bangs", "齐刘海": "blunt bangs",
+        "呆毛": "ahoge", "金发": "blonde hair", "金色长发": "blonde hair, long hair", "银发": "silver hair",
+        "白发": "white hair", "黑发": "black hair", "黑色长发": "black hair, long hair", "红发": "red hair",
+        "粉发": "pink hair", "粉色头发": "pink hair", "蓝发": "blue hair", "紫发": "purple hair",
+        "棕发": "brown hair", "绿发": "green hair", "渐变发色": "gradient hair", "挑染": "streaked hair",
+        "蓝眼": "blue eyes", "蓝色眼眸": "blue eyes", "碧蓝的眼": "blue eyes", "红瞳": "red eyes",
+        "红色眼眸": "red eyes", "金瞳": "yellow eyes", "金色眼眸": "yellow eyes", "绿眸": "green eyes",
+        "紫瞳": "purple eyes", "紫色眼眸": "purple eyes", "异色瞳": "heterochromia", "黑瞳": "black eyes",
+        "白皙": "pale skin", "雪白的肌肤": "pale skin", "小麦色": "tan", "古铜色": "dark skin",
+        "巨乳": "large breasts", "丰满": "large breasts", "贫乳": "small breasts", "娇小": "petite",
+        "修长的双腿": "long legs", "长腿": "long legs", "纤腰": "narrow waist", "锁骨": "collarbone",
+        "腹肌": "abs", "雀斑": "freckles", "泪痣": "mole under eye", "尖耳": "pointy ears", "翅膀": "wings",
+        "犄角": "horns", "尾巴": "tail", "纹身": "tattoo", "汗水": "sweat", "汗珠": "sweat",
+        "皮肤光泽": "shiny skin", "油光": "shiny skin, oiled", "湿润的肌肤": "wet, shiny skin",
+    },
+    'expression': {
+        "微笑": "smile", "浅笑": "light smile", "大笑": "laughing", "笑容": "smile", "脸红": "blush",
+        "红晕": "blush", "害羞": "embarrassed, blush", "羞涩": "shy, blush", "哭泣": "crying", "泪水": "tears",
+        "泪光": "tears", "闭眼": "closed eyes", "闭着眼": "closed eyes", "眯眼": "half-closed eyes",
+        "张嘴": "open mouth", "咬唇": "lip biting", "吐舌": "tongue out", "面无表情": "expressionless",
+        "忧郁": "sad", "悲伤": "sad", "惊讶": "surprised", "愤怒": "angry", "坚定": "serious",
+        "恍惚": "empty eyes", "迷离": "half-closed eyes", "诱惑的眼神": "seductive smile", "媚眼": "bedroom eyes",
+        "恐惧": "scared", "无助": "scared, tears",
+    },
+    'clothing': {
+        "连衣裙": "dress", "白色连衣裙": "white dress", "长裙": "long dress", "短裙": "miniskirt",
+        "百褶裙": "pleated skirt", "半身裙": "skirt", "衬衫": "shirt", "白衬衫": "white shirt", "毛衣": "sweater",
+        "外套": "jacket", "风衣": "trench coat", "大衣": "coat", "斗篷": "cloak", "披风": "cape",
+        "和服": "kimono", "浴衣": "yukata", "旗袍": "china dress", "汉服": "hanfu", "婚纱": "wedding dress",
+        "礼服": "evening gown", "晚礼服": "evening gown", "校服": "school uniform", "水手服": "serafuku",
+        "制服": "uniform", "女仆装": "maid, maid headdress, apron", "护士服": "nurse uniform",
+        "修女服": "nun, habit", "巫女服": "miko, hakama", "盔甲": "armor", "铠甲": "armor", "比基尼": "bikini",
+        "泳装": "swimsuit", "泳衣": "swimsuit", "死库水": "school swimsuit", "内衣": "lingerie",
+        "蕾丝": "lace", "胸罩": "bra", "内裤": "panties", "吊带袜": "garter straps", "睡衣": "pajamas",
+        "睡裙": "nightgown", "浴巾": "towel", "丝袜": "pantyhose", "黑丝": "black pantyhose",
+        "白丝": "white pantyhose", "过膝袜": "thighhighs", "长筒袜": "thighhighs", "高跟鞋": "high heels",
+        "长靴": "boots", "赤脚": "barefoot", "赤足": "barefoot", "手套": "gloves", "长手套": "elbow gloves",
+        "帽子": "hat", "巫师帽": "witch hat", "贝雷帽": "beret", "发带": "hairband", "丝带": "ribbon",
+        "蝴蝶结": "bow", "发饰": "hair ornament", "花环": "flower wreath", "头冠": "tiara", "王冠": "crown",
+        "面纱": "veil", "眼镜": "glasses", "项链": "necklace", "项圈": "collar", "颈环": "choker",
+        "耳环": "earrings", "手镯": "bracelet", "围巾": "scarf", "领带": "necktie", "披肩": "shawl",
+        "透视": "see-through", "薄纱": "see-through, transparent fabric", "湿透": "wet clothes",
+        "破损": "torn clothes", "撕裂": "torn clothes", "解开": "open clothes", "敞开": "open clothes",
+        "露肩": "bare shoulders", "露背": "backless outfit", "露脐": "midriff", "开衩": "side slit",
+        "紧身衣": "bodysuit", "皮衣": "leather", "胶衣": "latex", "绷带": "bandages", "锁链": "chain",
+        "镣铐": "shackles", "手铐": "handcuffs", "眼罩": "blindfold", "口球": "ball gag",
+    },
+    'pose': {
+        "站在": "standing", "站立": "standing", "伫立": "standing", "坐在": "sitting", "坐着": "sitting",
+        "跪坐": "seiza", "跪在": "kneeling", "跪着": "kneeling", "躺在": "lying", "仰躺": "lying, on back",
+        "侧躺": "lying, on side", "趴在": "lying, on stomach", "蹲": "squatting", "弯腰": "bent over",
+        "回眸": "looking back", "回头": "looking back", "望向远方": "looking afar", "凝视远方": "looking afar",
+        "看向镜头": "looking at viewer", "直视镜头": "looking at viewer", "注视着观者": "looking at viewer",
+        "仰望": "looking up", "低头": "looking down", "奔跑": "running", "行走": "walking", "漫步": "walking",
+        "跳跃": "jumping", "漂浮": "floating", "悬浮": "floating", "飞翔": "flying", "攀爬": "climbing",
+        "游泳": "swimming", "跳舞": "dancing", "舞动": "dancing", "伸展": "stretching", "伸手": "reaching",
+        "抱膝": "hugging own legs", "双手合十": "own hands together", "祈祷": "praying", "托腮": "head rest",
+        "撩发": "hand in own hair", "叉腰": "hand on hip", "双臂交叉": "crossed arms", "张开双臂": "outstretched arms",
+        "持剑": "holding sword", "握剑": "holding sword", "手持": "holding", "捧着": "holding", "撑伞": "holding umbrella",
+        "双腿交叉": "crossed legs", "张开双腿": "spread legs", "分开双腿": "spread legs", "被绑": "bound, bondage",
+        "束缚": "bondage, restrained", "被捆": "bound, rope", "吊起": "suspension", "反绑": "arms behind back, bound",
+        "背影": "from behind", "背对": "from behind",
+    },
+    'nsfw': {
+        "裸体": "nude", "全裸": "completely nude", "全身裸露": "completely nude", "一丝不挂": "completely nude",
+        "赤裸": "nude", "裸露": "nude", "半裸": "topless", "乳房": "breasts", "胸部": "breasts",
+        "乳头": "nipples", "露胸": "breasts out", "阴部": "pussy", "阴户": "pussy", "私处": "pussy",
+        "生殖器": "pussy", "臀部": "ass", "翘臀": "ass", "大腿": "thighs", "走光": "wardrobe malfunction",
+        "爱液": "pussy juice", "高潮": "orgasm", "性行为": "sex", "自慰": "masturbation", "触手": "tentacles",
+        "体液": "bodily fluids", "羞耻": "embarrassed", "公开暴露": "exhibitionism",
+    },
+    'scene': {
+        "森林": "forest", "树林": "forest", "海边": "beach", "海滩": "beach", "沙滩": "beach", "大海": "ocean",
+        "海面": "ocean", "海底": "underwater", "水下": "underwater", "湖面": "lake", "湖边": "lake", "湖泊": "lake",
+        "河边": "river", "溪流": "stream", "瀑布": "waterfall", "温泉": "onsen", "浴室": "bathroom",
+        "浴缸": "bathtub", "淋浴": "shower", "卧室": "bedroom", "床上": "on bed", "教室": "classroom",
+        "图书馆": "library", "咖啡馆": "cafe", "街道": "street", "城市": "city", "都市": "cityscape",
+        "屋顶": "rooftop", "天台": "rooftop", "神殿": "temple", "神社": "shrine", "寺庙": "temple",
+        "教堂": "church", "大教堂": "cathedral", "城堡": "castle", "宫殿": "palace", "王座": "throne",
+        "废墟": "ruins", "遗迹": "ruins", "地牢": "dungeon", "监狱": "prison cell", "牢房": "prison cell",
+        "祭坛": "altar", "沙漠": "desert", "雪山": "snowy mountain", "山顶": "mountain top", "草原": "grassland",
+        "草地": "grass", "花田": "flower field", "花海": "flower field", "花园": "garden", "樱花": "cherry blossoms",
+        "竹林": "bamboo forest", "雪地": "snow", "下雪": "snowing", "雪花": "snowflakes", "雨中": "rain",
+        "下雨": "rain", "星空": "starry sky", "夜空": "night sky", "银河": "milky way", "月亮": "moon",
+        "满月": "full moon", "天空": "sky", "蓝天": "blue sky", "云层": "cloud", "白云": "cloud",
+        "室内": "indoors", "户外": "outdoors", "舞台": "stage", "摄影棚": "studio", "窗边": "window",
+        "窗前": "window", "阳台": "balcony", "泳池": "pool", "战场": "battlefield", "太空": "space",
+        "宇宙": "space", "赛博朋克": "cyberpunk", "霓虹街道": "neon lights, street", "水面": "water",
+        "背景": "detailed background", "场景": "detailed background",
+    },
+    'lighting': {
+        "逆光": "backlighting", "侧逆光": "backlighting", "侧光": "sidelighting", "轮廓光": "rim light",
+        "阳光": "sunlight", "日光": "sunlight", "夕阳": "sunset", "黄昏": "sunset", "晚霞": "sunset",
+        "日出": "sunrise", "黎明": "dawn", "月光": "moonlight", "烛光": "candlelight", "火光": "firelight",
+        "霓虹": "neon lights", "丁达尔": "light rays", "光束": "light rays", "光柱": "light rays",
+        "柔光": "soft lighting", "柔和的光": "soft lighting", "扩散光": "diffused light", "明暗对比": "chiaroscuro",
+        "强烈的明暗": "high contrast", "光影": "light and shadow", "阴影": "shadow", "暖色调": "warm colors",
+        "冷色调": "cool colors", "深色调": "dark", "暗调": "dark", "高光": "specular highlights",
+        "光晕": "lens flare", "夜晚": "night", "夜色": "night", "白天": "day",
+    },
+    'composition': {
+        "特写": "close-up", "近景": "close-up", "全身": "full body", "半身": "upper body", "上半身": "upper body",
+        "俯视": "from above", "俯瞰": "from above", "仰视": "from below", "仰拍": "from below", "侧面": "from side",
+        "侧脸": "profile", "广角": "wide shot", "远景": "wide shot", "宏大构图": "wide shot, scenery",
+        "景深": "depth of field", "背景虚化": "blurry background", "虚化": "blurry background",
+        "柔焦": "soft focus", "画面中央": "centered", "对称": "symmetry", "动态": "dynamic pose",
+        "荷兰角": "dutch angle", "偷窥": "voyeurism, peeking", "隐蔽的角度": "peeking",
+    },
+    'atmosphere': {
+        "微风": "wind", "风中": "wind", "飘扬": "floating hair, wind", "发丝": "floating hair", "花瓣": "petals",
+        "落叶": "falling leaves", "羽毛": "feathers", "水珠": "water drops", "水滴": "water drops",
+        "水花": "splashing", "水汽": "steam", "蒸汽": "steam", "雾气": "fog", "薄雾": "mist", "雾": "fog",
+        "烟雾": "smoke", "光点": "sparkle", "光斑": "bokeh", "萤火虫": "fireflies", "蝴蝶": "butterfly",
+        "火焰": "fire", "魔法阵": "magic circle", "魔法": "magic", "哥特": "gothic", "维多利亚": "victorian",
+        "神秘": "mysterious", "史诗": "epic", "神圣": "holy", "梦幻": "dreamlike", "复古": "retro",
+        "极简": "minimalism", "几何": "geometric", "鲜血": "blood", "烛台": "candlestand", "蜡烛": "candle",
+    },
+}
+
+# 同义写法 → 规范写法 (作用于模型补充的标签和外部传入的标签)
+TAG_ALIASES: Dict[str, str] = {
+    'blond hair': 'blonde hair', 'female': '1girl', '1woman': '1girl', 'woman': '1girl', 'girl': '1girl',
+    'solo female': '1girl', 'two girls': '2girls', 'nsfw nude': 'nude', 'naked': 'nude', 'fully nude': 'completely nude',
+    'back light': 'backlighting', 'backlight': 'backlighting', 'sun light': 'sunlight', 'moon light': 'moonlight',
+    'high quality': 'best quality', 'highly detailed': 'ultra detailed', 'extremely detailed': 'ultra detailed',
+    'upperbody': 'upper body', 'fullbody': 'full body', 'closeup': 'close-up', 'close up': 'close-up',
+    'thigh highs': 'thighhighs', 'thigh-highs': 'thighhighs', 'twin tails': 'twintails', 'pony tail': 'ponytail',
+}
+
+# 具体标签 → 被它蕴含、同时出现时应去掉的泛化标签
+TAG_IMPLIES: Dict[str, Tuple[str, ...]] = {
+    'very long hair': ('long hair',), 'completely nude': ('nude', 'topless'), 'black pantyhose': ('pantyhose',),
+    'white pantyhose': ('pantyhose',), 'white dress': ('dress',), 'long dress': ('dress',), 'white shirt': ('shirt',),
+    'elbow gloves': ('gloves',), 'witch hat': ('hat',), 'pleated skirt': ('skirt',), 'miniskirt': ('skirt',),
+    'school swimsuit': ('swimsuit',), 'full moon': ('moon',), 'cathedral': ('church',), 'cat girl': ('cat ears',),
+    'blunt bangs': ('bangs',), 'light smile': ('smile',), 'breasts out': ('breasts',), 'starry sky': ('night sky', 'sky'),
+    'blue sky': ('sky',), 'snowing': ('snow',), 'cityscape': ('city',),
+    'seiza': ('sitting', 'kneeling'), '2girls': ('1girl',), '3girls': ('1girl', '2girls'),
+    'multiple girls': ('1girl', '2girls', '3girls'),
+}
+
+# 负面提示词模板 (英文, 中文)。所有档位共用 NEGATIVE_BASE，再按风格档位追加排除项。
+NEGATIVE_BASE: Tuple[Tuple[str, str], ...] = (
+    ('no males', "无男性"), ('no boys', "无男孩"), ('male focus', "男性焦点"), ('lowres', "低分辨率"),
+    ('bad anatomy', "糟糕的解剖结构"), ('bad hands', "糟糕的手部"), ('missing fingers', "缺失手指"),
+    ('extra digit', "多余的手指"), ('fewer digits', "手指过少"), ('text', "文字"), ('error', "错误"),
+    ('cropped', "裁切"), ('worst quality', "最差质量"), ('low quality', "低质量"), ('normal quality', "普通质量"),
+    ('jpeg artifacts', "JPEG 压缩痕迹"), ('signature', "签名"), ('watermark', "水印"), ('username', "用户名"),
+    ('blurry', "模糊"),
+)
+NEGATIVE_PROFILES: Dict[str, Tuple[Tuple[str, str], ...]] = {
+    'sfw': (('nsfw', "成人内容"), ('nude', "裸体"), ('completely nude', "全裸"), ('nipples', "乳头"),
+            ('breasts out', "露胸"), ('pussy', "阴部"), ('sex', "性行为")),
+    'suggestive': (('nipples', "乳头"), ('pussy', "阴部"), ('completely nude', "全裸"), ('sex', "性行为")),
+    'breasts_only': (('pussy', "阴部"), ('sex', "性行为")),
+    'genitals_only': (('nipples', "乳头"), ('breasts out', "露胸"), ('topless', "半裸")),
+    'art_nude': (('sex', "性行为"), ('pussy juice', "爱液"), ('masturbation', "自慰")),
+    'explicit': (),
+}
+DEFAULT_NEGATIVE_PROFILE = 'sfw'
+
+# 子句分隔符；去掉虚词后少于 MIN_CLAUSE_CHARS 个字的子句不计入覆盖率，
+# 子句中未命中的实词达到 MIN_CLAUSE_CHARS 个字时该子句列入 uncovered
+_CLAUSE_SPLIT = re.compile(r'[，。；！？、,.;!?\n：:（）()“”"]+')
+MIN_CLAUSE_CHARS = 2
+# 本身不对应任何标签的虚词与数量词，计算覆盖率时不计入分母
+_FILLER_RE = re.compile(r'一[位名个只件条把片道]|[的了着在和与及并而她他它是有正其之也很都被把将]|\s')
+# 命中位置前 NEGATION_WINDOW 个字内出现否定词时忽略该命中 (如 "没有长发" 不应产生 "long hair")，
+# "无数"、"无比" 等不表示否定的词除外
+NEGATION_WINDOW = 2
+_NEGATION_RE = re.compile(r'不|没|禁止|避免|并非|未穿|无(?![数比尽限边垠际穷])')
+_WORD_RE = re.compile(r'[a-z]+|\d|[^\sa-z\d]')
+_WEIGHT_RE = re.compile(r'[(){}\[\]]|:\s*[\d.]+')
+
+TAG_INDEX_PATHS = metrics.Counter(
+    'prompt_tag_index_formatting_total', "格式化阶段的执行路径 (path: local 为纯本地，hinted 为带提示的精简调用，full 为完整调用)",
+    ('path',))
+TAG_INDEX_COVERAGE = metrics.Histogram(
+    'prompt_tag_index_coverage', "本地标签索引对原始中文提示词的子句覆盖率",
+    buckets=(0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.85, 0.9, 0.95, 1.0))
+
+
+class PhraseMatcher:
+    """Aho-Corasick 自动机：一次扫描找出文本中出现的全部词典短语 (与词典大小无关)"""
+
+    def __init__(self, phrases: Iterable[str]):
+        self.phrases: List[str] = []
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._out: List[Tuple[int, ...]] = [()]
+        for phrase in phrases:
+            self._insert(phrase)
+        self._link()
+
+    def _insert(self, phrase: str) -> None:
+        state = 0
+        for ch in phrase:
+            nxt = self._goto[state].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[state][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            state = nxt
+        self._out[state] += (len(self.phrases),)
+        self.phrases.append(phrase)
+
+    def _link(self) -> None:
+        # 广度优先计算失配指针，并把失配链上的输出合并到每个状态，匹配时无需沿链回溯
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                fallback = self._fail[state]
+                while fallback and ch not in self._goto[fallback]:
+                    fallback = self._fail[fallback]
+                self._fail[nxt] = self._goto[fallback].get(ch, 0) if state else 0
+                self._out[nxt] += self._out[self._fail[nxt]]
+
+    def find_all(self, text: str) -> List[Tuple[int, int, str]]:
+        """返回全部 (起始位置, 结束位置, 短语)，可能互相重叠"""
+        matches = []
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(ch, 0)
+            for index in self._out[state]:
+                phrase = self.phrases[index]
+                matches.append((i + 1 - len(phrase), i + 1, phrase))
+        return matches
+
+    def find_longest(self, text: str) -> List[Tuple[int, int, str]]:
+        """从左到右选取互不重叠的匹配，同一起点取最长的短语"""
+        chosen = []
+        end = 0
+        for start, stop, phrase in sorted(self.find_all(text), key=lambda m: (m[0], -m[1])):
+            if start >= end:
+                chosen.append((start, stop, phrase))
+                end = stop
+        return chosen
+
+
+# 导入时预先展开词典：短语 → (规范化标签, 类别)，再编译自动机
+PHRASE_TAGS: Dict[str, Tuple[Tuple[str, ...], str]] = {}
+TAG_CATEGORIES: Dict[str, str] = {}
+
+
+def canonical_tag(tag: str) -> str:
+    """标签规范化：去掉权重括号、下划线视同空格、小写、合并空白、替换同义写法"""
+    tag = ' '.join(_WEIGHT_RE.sub('', tag).replace('_', ' ').lower().split())
+    return TAG_ALIASES.get(tag, tag)
+
+
+for _category, _phrases in TAG_DICTIONARY.items():
+    for _phrase, _tags in _phrases.items():
+        _canonical = tuple(canonical_tag(tag) for tag in _tags.split(','))
+        PHRASE_TAGS[_phrase] = (_canonical, _category)
+        for _tag in _canonical:
+            TAG_CATEGORIES.setdefault(_tag, _category)
+for _tag in QUALITY_TAGS:
+    TAG_CATEGORIES[_tag] = 'quality'
+MATCHER = PhraseMatcher(PHRASE_TAGS)
+
+
+def canonicalize(tags: Iterable[str]) -> List[str]:
+    """规范化并去重 (保留首次出现的顺序)，同时去掉被更具体标签蕴含的泛化标签"""
+    ordered = list(dict.fromkeys(tag for tag in map(canonical_tag, tags) if tag))
+    implied = {generic for tag in ordered for generic in TAG_IMPLIES.get(tag, ())}
+    return [tag for tag in ordered if tag not in implied]
+
+
+def clip_token_count(tags: Sequence[str]) -> int:
+    """估算标签串在 CLIP BPE 下的 token 数 (不加载词表)：
+    常见英文单词 1 个 token、长词每 8 个字母多 1 个，数字与标点各 1 个，标签之间的逗号各 1 个"""
+    total = max(0, len(tags) - 1)
+    for tag in tags:
+        for word in _WORD_RE.findall(tag.lower()):
+            total += 1 + (len(word) - 1) // 8 if word.isalpha() else 1
+    return total
+
+
+def fit_budget(tags: Sequence[str], budget: int = CLIP_TOKEN_BUDGET) -> Tuple[List[str], List[str]]:
+    """按类别优先级保留标签直到用完 token 预算，保留的标签维持原顺序。返回 (保留, 丢弃)"""
+    def priority(position: int) -> Tuple[int, int]:
+        category = TAG_CATEGORIES.get(tags[position])
+        rank = -1 if category == 'quality' else CATEGORIES[category][0] if category else EXTRA_TAG_PRIORITY
+        return rank, position
+
+    kept, used = set(), -1
+    for position in sorted(range(len(tags)), key=priority):
+        cost = clip_token_count([tags[position]]) + 1
+        if used + cost <= budget:
+            kept.add(position)
+            used += cost
+    return ([tag for i, tag in enumerate(tags) if i in kept],
+            [tag for i, tag in enumerate(tags) if i not in kept])
+
+
+class TagAnalysis(NamedTuple):
+    tags: Tuple[str, ...]          # 规范化去重后的标签 (不含质量标签、未做预算裁剪)
+    coverage: float                # 实词字符中被短语命中的比例
+    uncovered: Tuple[str, ...]     # 仍有实词未被命中的子句，作为提示交给模型补充
+    phrases: Tuple[str, ...]       # 实际命中的短语 (调试用)
+    seconds: float
+
+
+def analyze(raw_chinese_prompt: str) -> TagAnalysis:
+    """扫描原始中文提示词，得到本地标签与子句覆盖率"""
+    started = time.perf_counter()
+    text = raw_chinese_prompt or ''
+    hits = [(start, stop, phrase) for start, stop, phrase in MATCHER.find_longest(text)
+            if not _NEGATION_RE.search(text[max(0, start - NEGATION_WINDOW):start])]
+    tags = canonicalize(tag for _, _, phrase in hits for tag in PHRASE_TAGS[phrase][0])
+
+    matched = bytearray(len(text))
+    for start, stop, _ in hits:
+        matched[start:stop] = b'\x01' * (stop - start)
+    filler = bytearray(len(text))
+    for m in _FILLER_RE.finditer(text):
+        filler[m.start():m.end()] = b'\x01' * (m.end() - m.start())
+
+    total, covered, uncovered, position = 0, 0, [], 0
+    for clause in _CLAUSE_SPLIT.split(text):
+        start = text.find(clause, position) if clause else position
+        position = start + len(clause)
+        content = [i for i in range(start, position) if not filler[i] or matched[i]]
+        if len(content) < MIN_CLAUSE_CHARS:
+            continue
+        hit = sum(matched[i] for i in content)
+        total += len(content)
+        covered += hit
+        if len(content) - hit >= MIN_CLAUSE_CHARS:
+            uncovered.append(clause.strip())
+    coverage = round(covered / total, 4) if total else 0.0
+    return TagAnalysis(tuple(tags), coverage, tuple(dict.fromkeys(uncovered)), tuple(phrase for _, _, phrase in hits),
+                       time.perf_counter() - started)
+
+
+def choose_path(analysis: TagAnalysis) -> str:
+    if analysis.coverage >= TAG_INDEX_LOCAL_COVERAGE:
+        return FORMAT_PATH_LOCAL
+    if analysis.coverage >= TAG_INDEX_HINT_COVERAGE:
+        return FORMAT_PATH_HINTED
+    return FORMAT_PATH_FULL
+
+
+def _profile_pairs(profile: str) -> Tuple[Tuple[str, str], ...]:
+    # 档位在风格注册表加载时已校验，这里再出现未知档位说明调用方有错，不能悄悄退回到其他档位
+    if profile not in NEGATIVE_PROFILES:
+        raise ValueError(f"未知的负面提示词档位: {profile!r} (可选: {', '.join(NEGATIVE_PROFILES)})")
+    return NEGATIVE_PROFILES[profile]
+
+
+def negative_prompt(profile: str) -> Tuple[str, str]:
+    """按风格档位拼出 (英文负面提示词, 中文负面提示词)；未知档位抛出 ValueError"""
+    pairs = NEGATIVE_BASE + _profile_pairs(profile)
+    return ', '.join(en for en, _ in pairs), "，".join(zh for _, zh in pairs)
+
+
+def final_tags(tags: Iterable[str], profile: str, budget: int = CLIP_TOKEN_BUDGET) -> List[str]:
+    """质量标签 + 内容标签，去掉该档位负面模板中排除的标签后裁剪到 token 预算内"""
+    excluded = {en for en, _ in _profile_pairs(profile)}
+    merged = [tag for tag in canonicalize(list(QUALITY_TAGS) + list(tags)) if tag not in excluded]
+    return fit_budget(merged, budget)[0]
+
+
+def natural_description(tags: Sequence[str]) -> str:
+    """按类别把标签套进固定句式，作为离线模式 (TAG_INDEX_OFFLINE=1) 下的英文自然语言描述"""
+    groups: Dict[str, List[str]] = {}
+    for tag in tags:
+        category = TAG_CATEGORIES.get(tag)
+        if category in CATEGORIES:
+            groups.setdefault(category, []).append(tag)
+    parts = []
+    for category in sorted(groups, key=lambda c: CATEGORIES[c][0]):
+        joiner = CATEGORIES[category][1]
+        items = groups[category]
+        phrase = items[0] if len(items) == 1 else f"{', '.join(items[:-1])} and {items[-1]}"
+        parts.append(f"{joiner} {phrase}" if joiner else phrase)
+    return f"A masterpiece illustration of {', '.join(parts)}." if parts else "A masterpiece illustration."
+
+
+def offline_natural(raw_chinese_prompt: str, analysis: TagAnalysis) -> Dict[str, str]:
+    """离线模式下代替模型输出的两段自然语言描述 (英文为模板句式，中文直接沿用原始提示词)"""
+    return {
+        'final_natural': natural_description(final_tags(analysis.tags, DEFAULT_NEGATIVE_PROFILE)),
+        'final_chinese_natural': raw_chinese_prompt,
+    }
+
+
+def hint_text(analysis: TagAnalysis) -> str:
+    """附加在格式化请求末尾的提示：已匹配的标签与尚未覆盖的子句"""
+    uncovered = "；".join(analysis.uncovered) or "无"
+    return f"\n\n【已匹配标签】{', '.join(analysis.tags) or '无'}\n【未覆盖的描述】{uncovered}"
+
+
+def merge_local(data: Dict[str, str], analysis: TagAnalysis, profile: str) -> Dict[str, str]:
+    """本地路径与精简调用的结果合并：模型补充的标签 (如有) 并入本地标签，负面提示词使用模板"""
+    negative, chinese_negative = negative_prompt(profile)
+    # 没有需要补充的标签时模型返回空字符串 (或省略该键)；个别回复会给出 JSON 数组
+    extra = data.get('final_extra_tags') or ''
+    extra = [str(tag) for tag in extra] if isinstance(extra, list) else str(extra).split(',')
+    return {
+        'final_tag': ', '.join(final_tags(list(analysis.tags) + extra, profile)),
+        'final_natural': data['final_natural'],
+        'final_negative': negative,
+        'final_chinese_natural': data['final_chinese_natural'],
+        'final_chinese_negative': chinese_negative,
+    }
+
+
+# ------------------------------------------------------------------------------
+# 统计：各路径的次数与延迟 (本进程最近 TAG_INDEX_STATS_WINDOW 次)，节省的延迟以完整调用的平均耗时为基线估算
+# ------------------------------------------------------------------------------
+
+_stats_lock = threading.Lock()
+_coverages: deque = deque(maxlen=TAG_INDEX_STATS_WINDOW)
+_analysis_seconds: deque = deque(maxlen=TAG_INDEX_STATS_WINDOW)
+_latencies: Dict[str, deque] = {path: deque(maxlen=TAG_INDEX_STATS_WINDOW) for path in FORMAT_PATHS}
+_counts: Dict[str, int] = {path: 0 for path in FORMAT_PATHS}
+
+
+def record(path: str, analysis: Optional[TagAnalysis], seconds: float) -> None:
+    TAG_INDEX_PATHS.inc(path=path)
+    if analysis is not None:
+        TAG_INDEX_COVERAGE.observe(analysis.coverage)
+    with _stats_lock:
+        _counts[path] += 1
+        _latencies[path].append(seconds)
+        if analysis is not None:
+            _coverages.append(analysis.coverage)
+            _analysis_seconds.append(analysis.seconds)
+
+
+def stats() -> Dict[str, object]:
+    """覆盖率分布、各路径占比与平均耗时，以及相对完整格式化调用估算的节省延迟"""
+    with _stats_lock:
+        counts = dict(_counts)
+        means = {path: (sum(values) / len(values) if values else None) for path, values in _latencies.items()}
+        coverages = sorted(_coverages)
+        analysis_seconds = list(_analysis_seconds)
+    total = sum(counts.values())
+    baseline = means[FORMAT_PATH_FULL]
+    saved = {}
+    for path in (FORMAT_PATH_LOCAL, FORMAT_PATH_HINTED):
+        saved[path] = round(max(0.0, baseline - means[path]), 3) if baseline is not None and means[path] is not None else None
+    pick = lambda p: round(coverages[min(len(coverages) - 1, int(p * len(coverages)))], 4) if coverages else None
+    return {
+        'enabled': TAG_INDEX_ENABLED,
+        'thresholds': {'local': TAG_INDEX_LOCAL_COVERAGE, 'hinted': TAG_INDEX_HINT_COVERAGE},
+        'dictionary_phrases': len(PHRASE_TAGS),
+        'formatting_calls': total,
+        'paths': {path: {'count': counts[path], 'rate': round(counts[path] / total, 4) if total else 0.0,
+                         'latency_mean': round(means[path], 3) if means[path] is not None else None}
+                  for path in FORMAT_PATHS},
+        'coverage_mean': round(sum(coverages) / len(coverages), 4) if coverages else None,
+        'coverage_p50': pick(0.50), 'coverage_p95': pick(0.95),
+        'analysis_ms_mean': round(1000 * sum(analysis_seconds) / len(analysis_seconds), 3) if analysis_seconds else None,
+        # 每次调用相对完整格式化调用平均节省的秒数 (尚无完整调用样本时为 None)
+        'latency_saved_per_call': saved,
+        'latency_saved_total': round(sum(counts[path] * saved[path] for path in saved if saved[path] is not None), 3),
+    }
@@ -0,0 +1,15 @@
+import os
+import sys
+import tempfile
+
+# 测试直接导入仓库根目录下的模块；数据库与历史目录指向临时目录，避免在仓库中留下文件
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+_STATE_DIR = tempfile.mkdtemp(prefix='prompt-tests-')
+for name, value in (('JOB_DB', 'jobs.sqlite3'), ('PROMPT_CACHE_DB', 'cache.sqlite3'),
+                    ('ADMISSION_DB', 'admission.sqlite3'), ('HISTORY_DIR', 'history')):
+    os.environ.setdefault(name, os.path.join(_STATE_DIR, value))
+os.environ.setdefault('DEEPSEEK_API_KEY', 'test-key')
+os.environ.setdefault('PROMPT_CACHE', '0')
+os.environ.setdefault('TRACE_LOG', '0')
@@ -0,0 +1,178 @@
+import time
+
+import pytest
+import requests
+
+import admission
+import llm_client
+
+
+class FakeClock:
+    """代替 admission 模块中的 time：sleep 只推进时钟，令牌桶测试不需要真实等待"""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(admission, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def controller(tmp_path, monkeypatch):
+    monkeypatch.setattr(admission, 'ADMISSION_ENABLED', True)
+    return admission.AdmissionController(str(tmp_path / 'admission.sqlite3'))
+
+
+# --- 令牌桶 ---
+
+def test_rpm_bucket_allows_burst_then_refills(controller, clock, monkeypatch):
+    # 每秒 1 个令牌，容量 2
+    monkeypatch.setattr(admission, 'UPSTREAM_RPM', 60.0)
+    monkeypatch.setattr(admission, 'UPSTREAM_TPM', 0.0)
+    monkeypatch.setattr(admission, 'BURST_SECONDS', 2.0)
+    assert controller.try_acquire(100) == 0
+    assert controller.try_acquire(100) == 0
+    assert controller.try_acquire(100) == pytest.approx(1.0)
+    clock.now += 0.5
+    assert controller.try_acquire(100) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert controller.try_acquire(100) == 0
+    # 桶不会超过容量：空闲很久之后也只能突发 2 次
+    clock.now += 3600
+    assert [controller.try_acquire(100) for _ in range(3)][:2] == [0, 0]
+    assert controller.try_acquire(100) > 0
+
+
+def test_tpm_bucket_caps_oversized_request_at_capacity(controller, clock, monkeypatch):
+    # 每秒 10 个 token，容量 10；超过容量的单次请求按满桶计，而不是永远等待
+    monkeypatch.setattr(admission, 'UPSTREAM_RPM', 0.0)
+    monkeypatch.setattr(admission, 'UPSTREAM_TPM', 600.0)
+    monkeypatch.setattr(admission, 'BURST_SECONDS', 1.0)
+    assert controller.try_acquire(50) == 0
+    assert controller.try_acquire(5) == pytest.approx(0.5)
+
+
+def test_failed_acquire_does_not_consume_tokens(controller, clock, monkeypatch):
+    # RPM 桶有余量、TPM 桶不足时两个桶都不扣除
+    monkeypatch.setattr(admission, 'UPSTREAM_RPM', 60.0)
+    monkeypatch.setattr(admission, 'UPSTREAM_TPM', 600.0)
+    monkeypatch.setattr(admission, 'BURST_SECONDS', 1.0)
+    assert controller.try_acquire(10) == 0
+    clock.now += 1.0
+    assert controller.try_acquire(20) == 0
+    assert controller.try_acquire(10) == pytest.approx(1.0)
+    clock.now += 1.0
+    assert controller.try_acquire(10) == 0
+
+
+def test_acquire_upstream_waits_or_rejects(controller, clock, monkeypatch):
+    monkeypatch.setattr(admission, 'UPSTREAM_RPM', 60.0)
+    monkeypatch.setattr(admission, 'UPSTREAM_TPM', 0.0)
+    monkeypatch.setattr(admission, 'BURST_SECONDS', 1.0)
+    monkeypatch.setattr(admission, 'MAX_WAIT_SECONDS', 5.0)
+    controller.acquire_upstream(1)
+    started = clock.now
+    controller.acquire_upstream(1)
+    assert clock.now - started == pytest.approx(1.0)
+
+    monkeypatch.setattr(admission, 'MAX_WAIT_SECONDS', 0.5)
+    with pytest.raises(admission.AdmissionRejected):
+        controller.acquire_upstream(1)
+
+
+# --- 公平排队 ---
+
+def test_fair_queue_alternates_between_clients(controller, monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_ACTIVE', 1)
+    monkeypatch.setattr(admission, 'PER_CLIENT_LIMIT', 10)
+    monkeypatch.setattr(admission, 'QUEUE_LIMIT', 10)
+    for ticket, client in (('a1', 'A'), ('a2', 'A'), ('a3', 'A'), ('b1', 'B'), ('b2', 'B')):
+        assert controller.enqueue(ticket, client) is None
+
+    assert controller.try_admit('a1') == (True, 0)
+    # A 已占用一个名额，后到的 B 排在 A 的其余请求之前，之后两个客户端轮流
+    assert [controller.position(t) for t in ('b1', 'a2', 'b2', 'a3')] == [1, 2, 3, 4]
+    assert controller.try_admit('a2') == (False, 2)
+
+    # 名额释放后按同样规则重新排序：两个客户端都没有占用名额，先到先得
+    controller.release('a1')
+    assert [controller.position(t) for t in ('a2', 'b1', 'a3', 'b2')] == [1, 2, 3, 4]
+    assert controller.try_admit('b1') == (False, 2)
+    assert controller.try_admit('a2') == (True, 0)
+    assert [controller.position(t) for t in ('b1', 'a3', 'b2')] == [1, 2, 3]
+
+
+def test_enqueue_rejects_when_client_or_queue_is_full(controller, monkeypatch):
+    monkeypatch.setattr(admission, 'PER_CLIENT_LIMIT', 2)
+    monkeypatch.setattr(admission, 'QUEUE_LIMIT', 3)
+    assert controller.enqueue('a1', 'A') is None
+    assert controller.enqueue('a2', 'A') is None
+    assert "处理中" in controller.enqueue('a3', 'A')
+    assert controller.enqueue('b1', 'B') is None
+    assert "排队人数已满" in controller.enqueue('c1', 'C')
+    # 释放后名额立即可用
+    controller.release('a1')
+    assert controller.enqueue('c1', 'C') is None
+    assert controller.try_admit('missing') == (False, 0)
+
+
+# --- 熔断器探测名额 ---
+
+class _FailingSession:
+    def __init__(self, exc: Exception):
+        self.exc = exc
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        raise self.exc
+
+
+@pytest.fixture
+def half_open(monkeypatch):
+    breaker = llm_client.CircuitBreaker(1, 0.2)
+    breaker.record_failure()
+    time.sleep(0.25)
+    monkeypatch.setattr(llm_client, 'breaker', breaker)
+    monkeypatch.setattr(llm_client, 'BACKOFF_BASE', 0.0)
+    monkeypatch.setattr(llm_client, 'BACKOFF_MAX', 0.0)
+    assert breaker.state == "half-open"
+    return breaker
+
+
+def test_probe_released_when_retry_is_rejected_by_admission(half_open, monkeypatch):
+    calls = []
+
+    def acquire_upstream(tokens):
+        calls.append(tokens)
+        if len(calls) > 1:
+            raise admission.AdmissionRejected("上游配额已用尽")
+
+    monkeypatch.setattr(admission.controller, 'acquire_upstream', acquire_upstream)
+    monkeypatch.setattr(llm_client, 'get_session', lambda: _FailingSession(requests.ConnectionError("reset")))
+    monkeypatch.setattr(llm_client, 'MAX_RETRIES', 1)
+    response, error = llm_client.post_json('http://upstream.invalid', {}, {'messages': []})
+    assert response is None and "配额" in error
+    # 探测没有得出结果：名额归还，下一个请求仍可作为探测
+    assert half_open.acquire() == "probe"
+
+
+def test_request_exception_is_reported_and_reopens_breaker(half_open, monkeypatch):
+    session = _FailingSession(requests.exceptions.ChunkedEncodingError("truncated"))
+    monkeypatch.setattr(admission.controller, 'acquire_upstream', lambda tokens: None)
+    monkeypatch.setattr(llm_client, 'get_session', lambda: session)
+    monkeypatch.setattr(llm_client, 'MAX_RETRIES', 1)
+    response, error = llm_client.post_json('http://upstream.invalid', {}, {'messages': []})
+    assert response is None and error.startswith("API 请求异常")
+    assert session.calls == 2
+    assert half_open.state == "open"
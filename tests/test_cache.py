@@ -0,0 +1,141 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import app
+import cache
+
+
+class FakeClock:
+    """代替 cache 中的 time：sleep 只推进时钟，租约过期无需真实等待"""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def disk(tmp_path):
+    return cache.SQLiteCache(str(tmp_path / 'cache.sqlite3'), ttl_seconds=60)
+
+
+def _two_tier(disk=None):
+    return cache.TwoTierCache('test', cache.LRUCache(16, 60), disk)
+
+
+def test_format_key_covers_model_temperature_and_system_prompt(monkeypatch):
+    base = app._format_cache_key('一位少女')
+    assert app._format_cache_key('一位少女') == base
+    assert app._format_cache_key('一位少年') != base
+    for name, value in (('DEEPSEEK_MODEL_NAME', 'other-model'), ('DEEPSEEK_TEMPERATURE', 0.3),
+                        ('SYSTEM_PROMPT_FORMATTING', app.SYSTEM_PROMPT_FORMATTING + '。')):
+        with monkeypatch.context() as m:
+            m.setattr(app, name, value)
+            assert app._format_cache_key('一位少女') != base, name
+
+
+def test_text_digest_is_short_and_stable():
+    assert cache.text_digest('系统提示词') == cache.text_digest('系统提示词')
+    assert len(cache.text_digest('系统提示词')) == 16
+    assert cache.text_digest('系统提示词') != cache.text_digest('系统提示词 ')
+
+
+def test_concurrent_misses_call_compute_once():
+    tiered = _two_tier()
+    release = threading.Event()
+    calls = []
+
+    def compute():
+        calls.append(1)
+        release.wait(5)
+        return 'value', None
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(tiered.get_or_compute('k', compute))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    # 等 leader 进入 compute，其余线程都在等待同一个 Event
+    while not calls:
+        time.sleep(0.01)
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert len(calls) == 1
+    assert results == [('value', None)] * 5
+    assert tiered.stats['misses'] == 1 and tiered.stats['coalesced'] == 4
+
+
+def test_errors_are_not_cached():
+    tiered = _two_tier()
+    assert tiered.get_or_compute('k', lambda: (None, '上游错误')) == (None, '上游错误')
+    assert tiered.get_or_compute('k', lambda: ('value', None)) == ('value', None)
+    assert tiered.get_or_compute('k', lambda: ('other', None)) == ('value', None)
+
+
+def test_async_concurrent_misses_call_compute_once():
+    tiered = _two_tier()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value', None
+
+    async def run():
+        return await asyncio.gather(*(tiered.get_or_compute_async('k', compute) for _ in range(5)))
+
+    assert asyncio.run(run()) == [('value', None)] * 5
+    assert len(calls) == 1
+    assert tiered.stats['misses'] == 1 and tiered.stats['coalesced'] == 4
+
+
+def test_lease_blocks_until_expiry_then_can_be_taken_over(disk, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', clock)
+    assert disk.try_lease('k', 10)
+    assert not disk.try_lease('k', 10)
+    assert disk.lease_active('k')
+
+    clock.now += 10.1
+    assert not disk.lease_active('k')
+    assert disk.try_lease('k', 10)
+
+    disk.release_lease('k')
+    assert disk.try_lease('k', 10)
+
+
+def test_waiter_takes_result_from_lease_holder(disk, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', clock)
+    # 另一个进程持有租约，并在当前进程第一次轮询等待时写入结果
+    assert disk.try_lease('k', 10)
+    sleep = clock.sleep
+    monkeypatch.setattr(clock, 'sleep', lambda seconds: (disk.set('k', 'from-other-worker'), sleep(seconds)))
+    tiered = _two_tier(disk)
+    calls = []
+    assert tiered.get_or_compute('k', lambda: calls.append(1) or ('mine', None)) == ('from-other-worker', None)
+    assert not calls
+    assert tiered.stats['coalesced'] == 1
+
+
+def test_expired_lease_is_taken_over_and_computed(disk, monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(cache, 'time', clock)
+    monkeypatch.setattr(cache, 'LEASE_SECONDS', 1.0)
+    # 持有租约的进程崩溃，既没有写入结果也没有释放租约
+    assert disk.try_lease('k', 1.0)
+    tiered = _two_tier(disk)
+
+    assert tiered.get_or_compute('k', lambda: ('mine', None)) == ('mine', None)
+    assert 1.0 <= clock.now - 1_000_000.0 < 2.0
+    assert tiered.stats['misses'] == 1
+    assert disk.get('k') == 'mine'
@@ -0,0 +1,161 @@
+import time
+
+import pytest
+
+import history
+
+DAY = 86400.0
+
+
+class FakeClock:
+    """代替 history 模块中的 time，用于控制记录时间戳与过期时间"""
+
+    perf_counter = staticmethod(time.perf_counter)
+    sleep = staticmethod(time.sleep)
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def time(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(history, 'time', clock)
+    return clock
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    # 分段很小，几条记录就会轮转
+    monkeypatch.setattr(history, 'HISTORY_SEGMENT_BYTES', 600)
+    return history.HistoryStore(str(tmp_path / 'history'))
+
+
+WORDS = ('alpha', 'beta', 'gamma')
+
+
+def _record(i: int, **fields):
+    record = {'style': 'even' if i % 2 == 0 else 'odd', 'theme': f"主题{i}", 'mode': 'two_pass',
+              'raw': f"{WORDS[i % 3]} raw {i}", 'final_tag': f"tag{i}", 'final_natural': f"natural {i}",
+              'final_chinese_natural': f"中文 {i}", 'final_negative': 'lowres'}
+    record.update(fields)
+    return record
+
+
+def _fill(store, clock, count: int = 20):
+    for i in range(count):
+        clock.now += 10
+        assert store.append(_record(i), client='A' if i < 10 else 'B') == i
+
+
+def test_append_and_get_across_rollover(store, clock):
+    _fill(store, clock)
+    assert len(store.segments()) > 2
+    for i in range(20):
+        record = store.get(i)
+        assert record['id'] == i and record['theme'] == f"主题{i}"
+    assert store.get(20) is None
+    assert store.get(3, client='A')['id'] == 3
+    assert store.get(3, client='B') is None
+    assert store.stats()['entries'] == 20
+
+
+def test_query_pages_newest_first_across_segments(store, clock):
+    _fill(store, clock)
+    page, has_more = store.query(limit=7)
+    assert [r['id'] for r in page] == list(range(19, 12, -1)) and has_more
+    page, has_more = store.query(offset=14, limit=7)
+    assert [r['id'] for r in page] == list(range(5, -1, -1)) and not has_more
+
+    page, _ = store.query(style='even', limit=100)
+    assert [r['id'] for r in page] == list(range(18, -1, -2))
+    page, _ = store.query(client='A', style='odd', limit=100)
+    assert [r['id'] for r in page] == [9, 7, 5, 3, 1]
+
+
+def test_query_time_range(store, clock):
+    _fill(store, clock)
+    since, until = store.get(5)['ts'], store.get(9)['ts']
+    page, _ = store.query(since=since, until=until, limit=100)
+    assert [r['id'] for r in page] == [9, 8, 7, 6, 5]
+    page, _ = store.query(since=clock.now + 1, limit=100)
+    assert page == []
+
+
+def test_search_across_rollover(store, clock):
+    _fill(store, clock)
+    page, _ = store.query(text='beta', limit=100)
+    assert [r['id'] for r in page] == [i for i in range(19, -1, -1) if i % 3 == 1]
+    # 中文按 JSON 编码后的字节搜索；一行内多次命中只返回一次
+    page, _ = store.query(text='主题1', limit=100)
+    assert [r['id'] for r in page] == list(range(19, 9, -1)) + [1]
+    store.append(_record(20, raw='beta beta beta'))
+    page, _ = store.query(text='beta', limit=1)
+    assert [r['id'] for r in page] == [20]
+    page, _ = store.query(text='beta', client='B', offset=1, limit=100)
+    assert [r['id'] for r in page] == [16, 13, 10]
+    assert store.query(text='不存在')[0] == []
+
+
+def test_compact_expires_and_deduplicates_closed_segments(store, clock, monkeypatch):
+    monkeypatch.setattr(history, 'HISTORY_SEGMENT_BYTES', 1 << 20)
+    for i in range(5):
+        store.append(_record(i))
+    clock.now += 2 * DAY
+    duplicate = _record(5)
+    for _ in range(5):
+        store.append(duplicate)
+    # 之后每条记录单独一个分段
+    monkeypatch.setattr(history, 'HISTORY_SEGMENT_BYTES', 1)
+    store.append(_record(10))
+    store.append(_record(11))
+    assert len(store.segments()) == 3
+
+    monkeypatch.setattr(history, 'HISTORY_RETENTION_DAYS', 1.0)
+    clock.now += 10
+    stats = store.compact()
+    assert stats['compacted'] == 2 and stats['removed'] == 0
+    assert stats['expired'] == 5 and stats['deduplicated'] == 4 and stats['bytes_saved'] > 0
+
+    # ID 不变：过期记录成为墓碑，重复记录通过 same_as 还原出完整内容
+    assert [store.get(i) for i in range(5)] == [None] * 5
+    for i in range(5, 10):
+        record = store.get(i)
+        assert record['id'] == i and record['theme'] == "主题5" and 'same_as' not in record
+    page, _ = store.query(limit=100)
+    assert [r['id'] for r in page] == list(range(11, 4, -1))
+    page, _ = store.query(text='主题5', limit=100)
+    assert [r['id'] for r in page] == [5]
+    page, _ = store.query(text='主题10', limit=100)
+    assert [r['id'] for r in page] == [10]
+
+    # 已压缩且没有新的过期记录的分段不会重复压缩
+    assert store.compact()['compacted'] == 0
+
+    # 全部过期的已关闭分段被删除，活动分段保持不动
+    clock.now += 10 * DAY
+    stats = store.compact()
+    assert stats['removed'] == 2
+    assert len(store.segments()) == 1
+    assert store.get(7) is None and store.get(11)['id'] == 11
+    assert store.append(_record(12)) == 12
+
+
+def test_filters_use_postings_after_compaction(store, clock):
+    _fill(store, clock)
+    queries = [dict(client='A'), dict(client='B', style='even'), dict(style='odd'), dict(client='nobody'),
+               # 与风格同名的客户端：哈希相同，但只能匹配索引中客户端那一列
+               dict(client='even')]
+    before = [store.query(limit=100, **q)[0] for q in queries]
+    assert [len(page) for page in before] == [10, 5, 10, 0, 0]
+    assert all(view.keys is None for view in store._views())
+
+    store.compact()
+    views = list(store._views(newest_first=False))
+    assert all(view.keys is not None for view in views[:-1]) and views[-1].keys is None
+    assert [store.query(limit=100, **q)[0] for q in queries] == before
+    page, has_more = store.query(client='A', offset=3, limit=4)
+    assert [r['id'] for r in page] == [6, 5, 4, 3] and has_more
@@ -0,0 +1,79 @@
+import threading
+import time
+
+import pytest
+
+import admission
+import jobs
+
+
+@pytest.fixture
+def app_module(tmp_path, monkeypatch):
+    import app
+    monkeypatch.setattr(admission, 'ADMISSION_ENABLED', True)
+    monkeypatch.setattr(admission, 'controller', admission.AdmissionController(str(tmp_path / 'admission.sqlite3')))
+    monkeypatch.setattr(jobs, 'job_store', jobs.JobStore(str(tmp_path / 'jobs.sqlite3')))
+    return app
+
+
+def _wait_idle(runner, timeout=5.0):
+    deadline = time.time() + timeout
+    while runner.queue_depth and time.time() < deadline:
+        time.sleep(0.01)
+    assert runner.queue_depth == 0
+
+
+def test_delete_queued_job_releases_admission_ticket(app_module):
+    owner = 'o' * 32
+    runner = jobs.JobRunner(jobs.job_store, 1, 10)
+    blocker = threading.Event()
+    ran = []
+
+    def task(job):
+        ran.append(job.job_id)
+        blocker.wait(5)
+        return {}
+
+    controller = admission.controller
+    tickets = []
+    for ticket in ('t1', 't2'):
+        assert controller.enqueue(ticket, '127.0.0.1') is None
+        tickets.append(runner.submit('generate', {'ticket': ticket, 'client': '127.0.0.1', 'owner': owner}, task))
+    running_id, queued_id = tickets
+
+    client = app_module.server.test_client()
+    client.set_cookie(app_module.HISTORY_COOKIE, owner)
+    response = client.delete(f'/api/jobs/{queued_id}')
+    assert response.get_json() == {'cancelled': True}
+    blocker.set()
+    _wait_idle(runner)
+
+    # 被取消的任务从未执行，它的票据也不再占用排队名额
+    assert ran == [running_id]
+    assert jobs.job_store.status(queued_id) == 'cancelled'
+    assert controller.position('t2') == 0
+    assert controller.try_admit('t2') == (False, 0)
+
+
+def test_job_get_hides_private_params_and_delete_checks_owner(app_module):
+    owner = 'o' * 32
+    params = {'style': 'NORMAL', 'theme': "主题", 'ticket': 't1', 'client': '10.0.0.1', 'owner': owner}
+    job_id = jobs.job_store.create('generate', params)
+    assert admission.controller.enqueue('t1', '10.0.0.1') is None
+    client = app_module.server.test_client()
+
+    job = client.get(f'/api/jobs/{job_id}').get_json()
+    assert job['params'] == {'style': 'NORMAL', 'theme': "主题"}
+    assert client.get('/api/jobs/missing').status_code == 404
+
+    # 没有 Cookie 或 Cookie 不匹配时不能取消别人的任务
+    assert client.delete(f'/api/jobs/{job_id}').status_code == 403
+    client.set_cookie(app_module.HISTORY_COOKIE, 'x' * 32)
+    assert client.delete(f'/api/jobs/{job_id}').status_code == 403
+    assert jobs.job_store.status(job_id) == 'queued'
+
+    client.set_cookie(app_module.HISTORY_COOKIE, owner)
+    assert client.delete(f'/api/jobs/{job_id}').get_json() == {'cancelled': True}
+    assert jobs.job_store.status(job_id) == 'cancelled'
+    assert admission.controller.position('t1') == 0
+    assert client.delete(f'/api/jobs/{job_id}').get_json() == {'cancelled': False}
@@ -0,0 +1,108 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def store(tmp_path):
+    return jobs.JobStore(str(tmp_path / 'jobs.sqlite3'))
+
+
+def _wait_idle(runner, timeout=5.0):
+    deadline = time.time() + timeout
+    while runner.queue_depth and time.time() < deadline:
+        time.sleep(0.01)
+    assert runner.queue_depth == 0
+
+
+def test_job_runs_to_done(store):
+    runner = jobs.JobRunner(store, 1, 10)
+    job_id = runner.submit('generate', {'theme': "主题"}, lambda job: {'final_tag': '1girl', 'timings': {'total': 1}})
+    _wait_idle(runner)
+    job = store.get(job_id)
+    assert job['status'] == 'done' and job['stage'] == 'done'
+    assert job['result']['final_tag'] == '1girl' and job['timings'] == {'total': 1}
+
+
+def test_cancel_before_start_skips_task(store):
+    runner = jobs.JobRunner(store, 1, 10)
+    blocker, ran = threading.Event(), []
+
+    def task(job):
+        ran.append(job.job_id)
+        blocker.wait(5)
+        return {}
+
+    first = runner.submit('generate', {}, task)
+    queued = runner.submit('generate', {}, task)
+    assert store.cancel(queued, "用户取消")
+    blocker.set()
+    _wait_idle(runner)
+    assert ran == [first]
+    job = store.get(queued)
+    assert (job['status'], job['error'], job['started_at']) == ('cancelled', "用户取消", None)
+    # 已结束的任务不能再取消
+    assert not store.cancel(first)
+
+
+def test_cancel_while_running_stops_at_next_check(store):
+    runner = jobs.JobRunner(store, 1, 10)
+    started, proceed = threading.Event(), threading.Event()
+
+    def task(job):
+        started.set()
+        proceed.wait(5)
+        job.report('formatting', {'raw': "部分结果"})
+        return {'final_tag': 'never'}
+
+    job_id = runner.submit('generate', {}, task)
+    assert started.wait(5)
+    assert store.cancel(job_id, "用户取消")
+    proceed.set()
+    _wait_idle(runner)
+    job = store.get(job_id)
+    assert (job['status'], job['error'], job['result']) == ('cancelled', "用户取消", None)
+
+
+def test_cancel_during_last_stage_is_not_overwritten(store):
+    # 任务最后一次检查之后、写入最终状态之前被取消：最终状态保持取消，结果丢弃
+    class RacingRunner(jobs.JobRunner):
+        def _finish(self, handle, result, exc):
+            store.cancel(handle.job_id, "用户取消")
+            return super()._finish(handle, result, exc)
+
+    runner = RacingRunner(store, 1, 10)
+    job_id = runner.submit('generate', {}, lambda job: {'final_tag': '1girl'})
+    _wait_idle(runner)
+    job = store.get(job_id)
+    assert (job['status'], job['stage'], job['result']) == ('cancelled', 'queued', None)
+
+
+def test_store_finish_only_updates_running_jobs(store):
+    job_id = store.create('generate', {})
+    assert not store.finish(job_id, status='done')
+    assert store.start(job_id) and not store.start(job_id)
+    assert store.finish(job_id, status='done', result={'a': 1})
+    assert not store.finish(job_id, status='failed')
+    assert store.get(job_id)['status'] == 'done' and store.get(job_id)['result'] == {'a': 1}
+
+
+def test_async_runner_cancel_while_running(store):
+    runner = jobs.AsyncJobRunner(store, 4, 10)
+    started = threading.Event()
+
+    async def task(job):
+        started.set()
+        while True:
+            job.check()
+            await asyncio.sleep(0.01)
+
+    job_id = runner.submit('generate', {}, task)
+    assert started.wait(5)
+    assert store.cancel(job_id, "用户取消")
+    _wait_idle(runner)
+    assert store.get(job_id)['status'] == 'cancelled' and runner.running == 0
@@ -0,0 +1,206 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+import pytest
+import requests
+
+import admission
+import llm_client
+
+
+class FakeTime:
+    """代替 llm_client 中的 time：sleep 只记录并推进时钟，熔断器的冷却时间同样可控"""
+
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+        self.sleeps = []
+
+    def time(self) -> float:
+        return self.now
+
+    def monotonic(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float) -> None:
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeResponse:
+    def __init__(self, status_code: int, headers=None, text: str = ''):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.text = text
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class FakeSession:
+    """按顺序返回预设的响应或抛出预设的异常"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def post(self, *args, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return outcome
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(llm_client, 'time', clock)
+    # 退避抖动取上限，便于断言
+    monkeypatch.setattr(llm_client.random, 'uniform', lambda low, high: high)
+    monkeypatch.setattr(admission.controller, 'acquire_upstream', lambda tokens: None)
+    monkeypatch.setattr(llm_client, 'MAX_RETRIES', 3)
+    monkeypatch.setattr(llm_client, 'BACKOFF_BASE', 0.5)
+    monkeypatch.setattr(llm_client, 'BACKOFF_MAX', 8.0)
+    return clock
+
+
+@pytest.fixture
+def breaker(monkeypatch, clock):
+    breaker = llm_client.CircuitBreaker(2, 30)
+    monkeypatch.setattr(llm_client, 'breaker', breaker)
+    return breaker
+
+
+def _post(monkeypatch, session):
+    monkeypatch.setattr(llm_client, 'get_session', lambda: session)
+    return llm_client.post_json('http://upstream.invalid', {}, {'messages': []})
+
+
+# --- 重试与退避 ---
+
+def test_retries_5xx_with_exponential_backoff(monkeypatch, clock, breaker):
+    ok = FakeResponse(200)
+    session = FakeSession(FakeResponse(503), FakeResponse(502), ok)
+    assert _post(monkeypatch, session) == (ok, None)
+    assert session.calls == 3
+    assert clock.sleeps == [0.5, 1.0]
+    assert breaker.state == "closed"
+
+
+def test_backoff_is_capped(monkeypatch, clock):
+    monkeypatch.setattr(llm_client, 'MAX_RETRIES', 6)
+    monkeypatch.setattr(llm_client, 'BACKOFF_BASE', 1.0)
+    monkeypatch.setattr(llm_client, 'BACKOFF_MAX', 3.0)
+    assert [llm_client._next_delay(attempt, None) for attempt in range(7)] == [1.0, 2.0, 3.0, 3.0, 3.0, 3.0, None]
+
+
+def test_gives_up_after_max_retries_and_counts_one_failure(monkeypatch, clock, breaker):
+    responses = [FakeResponse(503, text='busy') for _ in range(4)]
+    session = FakeSession(*responses)
+    response, error = _post(monkeypatch, session)
+    assert response is None and error == "API Error: Status 503, busy"
+    assert session.calls == 4 and len(clock.sleeps) == 3
+    assert all(r.closed for r in responses)
+    assert breaker._failures == 1 and breaker.state == "closed"
+
+
+def test_client_errors_are_not_retried_or_counted(monkeypatch, clock, breaker):
+    session = FakeSession(FakeResponse(400, text='bad request'))
+    response, error = _post(monkeypatch, session)
+    assert response is None and "Status 400" in error
+    assert session.calls == 1 and clock.sleeps == []
+    assert breaker._failures == 0
+
+
+def test_transport_errors_are_retried(monkeypatch, clock, breaker):
+    ok = FakeResponse(200)
+    session = FakeSession(requests.ConnectionError("reset"), requests.Timeout("read timeout"),
+                          requests.exceptions.ChunkedEncodingError("truncated"), ok)
+    assert _post(monkeypatch, session) == (ok, None)
+    assert session.calls == 4
+
+
+# --- Retry-After ---
+
+def test_retry_after_seconds_is_honoured(monkeypatch, clock, breaker):
+    ok = FakeResponse(200)
+    session = FakeSession(FakeResponse(429, {'Retry-After': '2'}), ok)
+    assert _post(monkeypatch, session) == (ok, None)
+    assert clock.sleeps == [2.0]
+
+
+def test_retry_after_http_date(clock):
+    when = datetime.fromtimestamp(clock.now + 5, tz=timezone.utc)
+    response = FakeResponse(503, {'Retry-After': format_datetime(when, usegmt=True)})
+    assert llm_client._retry_after_seconds(response) == pytest.approx(5, abs=1)
+    assert llm_client._retry_after_seconds(FakeResponse(503, {'Retry-After': 'soon'})) is None
+    assert llm_client._retry_after_seconds(FakeResponse(503, {'Retry-After': '-3'})) == 0.0
+
+
+def test_retry_after_beyond_backoff_max_fails_fast(monkeypatch, clock, breaker):
+    session = FakeSession(FakeResponse(429, {'Retry-After': '60'}, 'slow down'), FakeResponse(200))
+    response, error = _post(monkeypatch, session)
+    assert response is None and "Status 429" in error
+    assert session.calls == 1 and clock.sleeps == []
+    assert breaker._failures == 1
+
+
+# --- 熔断器 ---
+
+def test_breaker_open_half_open_closed(clock, breaker):
+    assert breaker.state == "closed" and breaker.acquire() == "closed"
+    breaker.record_failure()
+    assert breaker.state == "closed"
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.acquire() is None
+
+    clock.now += 30
+    assert breaker.state == "half-open"
+    assert breaker.acquire() == "probe"
+    # 半开状态下只放行一个探测请求
+    assert breaker.acquire() is None
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.acquire() == "closed"
+
+
+def test_failed_probe_reopens_breaker(clock, breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    assert breaker.acquire() == "probe"
+    breaker.record_failure()
+    assert breaker.state == "open"
+    clock.now += 29
+    assert breaker.acquire() is None
+    clock.now += 1
+    assert breaker.acquire() == "probe"
+
+
+def test_open_breaker_fails_fast_without_calling_upstream(monkeypatch, clock, breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    session = FakeSession(FakeResponse(200))
+    response, error = _post(monkeypatch, session)
+    assert response is None and "熔断器" in error
+    assert session.calls == 0
+
+
+def test_probe_success_closes_breaker(monkeypatch, clock, breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    ok = FakeResponse(200)
+    assert _post(monkeypatch, FakeSession(ok)) == (ok, None)
+    assert breaker.state == "closed"
+
+
+def test_probe_released_on_unexpected_exception(monkeypatch, clock, breaker):
+    breaker.record_failure()
+    breaker.record_failure()
+    clock.now += 30
+    with pytest.raises(RuntimeError):
+        _post(monkeypatch, FakeSession(RuntimeError("bug")))
+    # 探测没有得出结果：熔断状态不变，名额归还
+    assert breaker.state == "half-open"
+    assert breaker.acquire() == "probe"
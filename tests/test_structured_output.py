@@ -0,0 +1,110 @@
+import pytest
+
+import structured_output
+
+
+def _counts():
+    return {key: value for key, value in structured_output.stats().items() if not key.endswith('_rate')}
+
+
+def _delta(before):
+    after = _counts()
+    return {key: after[key] - before[key] for key in after if after[key] != before[key]}
+
+
+# --- JSON 提取与修复 ---
+
+def test_clean_object():
+    before = _counts()
+    assert structured_output.extract_json_object('{"a": "x", "b": 2}') == ({'a': 'x', 'b': 2}, None)
+    assert _delta(before) == {'clean': 1}
+
+
+@pytest.mark.parametrize('reply, expected', [
+    # 代码块围栏与前后说明文字
+    ('结果如下：\n```json\n{"a": "x"}\n```\n希望有帮助', {'a': 'x'}),
+    ('Sure! {"a": "x"} Let me know.', {'a': 'x'}),
+    # 尾随逗号
+    ('{"a": [1, 2,], "b": "y",}', {'a': [1, 2], 'b': 'y'}),
+    # 输出被截断：丢弃不完整的值，补齐括号
+    ('{"a": "ok", "b": "被截断的', {'a': 'ok'}),
+    ('{"a": "ok", "b": ', {'a': 'ok'}),
+    ('{"a": {"b": [1, 2', {'a': {'b': [1, 2]}}),
+    # 字符串内的括号与转义引号不影响配对
+    ('{"a": "x}\\"{" } 之后还有 {"c": 3}', {'a': 'x}"{'}),
+    # 字符串内未转义的换行
+    ('{"a": "第一行\n第二行"} 多余', {'a': "第一行\n第二行"}),
+])
+def test_repaired_object(reply, expected):
+    before = _counts()
+    assert structured_output.extract_json_object(reply) == (expected, None)
+    assert _delta(before) == {'repaired': 1}
+
+
+@pytest.mark.parametrize('reply', ['没有 JSON', '[1, 2, 3]', '{"a" 1}', ''])
+def test_unrecoverable_reply(reply):
+    before = _counts()
+    data, error = structured_output.extract_json_object(reply)
+    assert data is None and error
+    assert _delta(before) == {'unrecoverable': 1}
+
+
+def test_missing_keys_reports_absent_empty_and_non_string():
+    data = {'a': 'x', 'b': '  ', 'c': None, 'd': 3, 'e': ['x']}
+    assert structured_output.missing_keys(data, ('a', 'b', 'c', 'd', 'e', 'f')) == ['b', 'c', 'd', 'e', 'f']
+    assert structured_output.missing_keys(data, ('a',)) == []
+
+
+# --- 缺失键追问 ---
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+
+def _fake_llm(monkeypatch, app_module, replies):
+    calls = []
+
+    def llm_api_call(system_prompt, user_prompt, is_json_output=True, stage="other", **kwargs):
+        calls.append((stage, user_prompt))
+        return replies[len(calls) - 1]
+
+    monkeypatch.setattr(app_module, 'llm_api_call', llm_api_call)
+    return calls
+
+
+def test_format_call_reasks_only_missing_keys(app_module, monkeypatch):
+    first = {'final_tag': '1girl', 'final_natural': 'A girl.', 'final_negative': '',
+             'final_chinese_natural': "一位少女。"}
+    patch = {'final_negative': 'lowres', 'final_chinese_negative': "低分辨率", 'final_tag': 'ignored'}
+    calls = _fake_llm(monkeypatch, app_module, [(first, None), (patch, None)])
+    before = _counts()
+
+    data, error = app_module._format_call('system', 'raw prompt', app_module.FORMAT_KEYS)
+
+    assert error is None
+    assert data == dict(first, final_negative='lowres', final_chinese_negative="低分辨率")
+    assert [stage for stage, _ in calls] == ['formatting', 'reask']
+    assert 'final_negative, final_chinese_negative' in calls[1][1]
+    assert _delta(before) == {'reasked': 1, 'reask_recovered': 1}
+
+
+def test_format_call_skips_reask_when_complete(app_module, monkeypatch):
+    complete = {key: 'x' for key in app_module.FORMAT_KEYS}
+    calls = _fake_llm(monkeypatch, app_module, [(complete, None)])
+    assert app_module._format_call('system', 'raw prompt', app_module.FORMAT_KEYS) == (complete, None)
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('reask_reply, message', [
+    (({'final_negative': ''}, None), "缺少键: final_negative"),
+    ((None, "API 请求超时"), "API 请求超时"),
+])
+def test_format_call_reports_failed_reask(app_module, monkeypatch, reask_reply, message):
+    first = {key: 'x' for key in app_module.FORMAT_KEYS if key != 'final_negative'}
+    _fake_llm(monkeypatch, app_module, [(first, None), reask_reply])
+    before = _counts()
+    data, error = app_module._format_call('system', 'raw prompt', app_module.FORMAT_KEYS)
+    assert data is None and message in error
+    assert _delta(before) == {'reasked': 1, 'reask_failed': 1}
@@ -0,0 +1,122 @@
+import pytest
+
+import tag_index
+
+
+# --- Aho-Corasick 短语匹配 ---
+
+def test_matcher_finds_overlapping_phrases():
+    matcher = tag_index.PhraseMatcher(['马尾', '双马尾', '尾巴', '巴士'])
+    assert sorted(matcher.find_all('双马尾巴士')) == [
+        (0, 3, '双马尾'), (1, 3, '马尾'), (2, 4, '尾巴'), (3, 5, '巴士')]
+
+
+def test_matcher_longest_match_does_not_overlap():
+    matcher = tag_index.PhraseMatcher(['马尾', '双马尾', '尾巴', '侧马尾'])
+    assert matcher.find_longest('双马尾和尾巴') == [(0, 3, '双马尾'), (4, 6, '尾巴')]
+    assert matcher.find_longest('侧马尾，马尾') == [(0, 3, '侧马尾'), (4, 6, '马尾')]
+    assert matcher.find_longest('没有匹配') == []
+
+
+def test_analyze_uses_longest_phrase_and_skips_negated():
+    analysis = tag_index.analyze("少女，双马尾，微笑，不戴眼镜，在奇怪的地方徘徊")
+    assert analysis.phrases == ('少女', '双马尾', '微笑')
+    assert analysis.tags == ('1girl', 'twintails', 'smile')
+    assert 'ponytail' not in analysis.tags and 'glasses' not in analysis.tags
+    # 实词 17 个字 (不计 "在"、"的")，命中 7 个
+    assert analysis.coverage == pytest.approx(7 / 17, abs=1e-4)
+    assert analysis.uncovered == ('不戴眼镜', '在奇怪的地方徘徊')
+
+
+def test_coverage_counts_unmatched_terms_inside_a_clause():
+    # 子句中命中一个短语不代表整句被覆盖：宇航服、长剑等没有对应标签
+    analysis = tag_index.analyze("骑士站在城堡前，手握长剑")
+    assert analysis.coverage < tag_index.TAG_INDEX_LOCAL_COVERAGE
+    assert analysis.uncovered == ('手握长剑',)
+    analysis = tag_index.analyze("金发少女，蓝眼，微笑")
+    assert analysis.coverage == 1.0 and analysis.uncovered == ()
+
+
+def test_default_theme_does_not_take_local_path():
+    analysis = tag_index.analyze("一位穿着紧身宇航服的女性，漂浮在太空中")
+    assert analysis.coverage < tag_index.TAG_INDEX_LOCAL_COVERAGE
+    assert tag_index.choose_path(analysis) != tag_index.FORMAT_PATH_LOCAL
+    assert analysis.uncovered == ('一位穿着紧身宇航服的女性',)
+
+
+# --- 覆盖率阈值 ---
+
+@pytest.mark.parametrize('coverage, path', [
+    (1.0, tag_index.FORMAT_PATH_LOCAL),
+    (0.85, tag_index.FORMAT_PATH_LOCAL),
+    (0.84, tag_index.FORMAT_PATH_HINTED),
+    (0.3, tag_index.FORMAT_PATH_HINTED),
+    (0.29, tag_index.FORMAT_PATH_FULL),
+    (0.0, tag_index.FORMAT_PATH_FULL),
+])
+def test_choose_path_thresholds(coverage, path, monkeypatch):
+    monkeypatch.setattr(tag_index, 'TAG_INDEX_LOCAL_COVERAGE', 0.85)
+    monkeypatch.setattr(tag_index, 'TAG_INDEX_HINT_COVERAGE', 0.3)
+    analysis = tag_index.TagAnalysis((), coverage, (), (), 0.0)
+    assert tag_index.choose_path(analysis) == path
+
+
+def test_analyze_empty_text_has_zero_coverage():
+    analysis = tag_index.analyze('')
+    assert analysis.coverage == 0.0
+    assert tag_index.choose_path(analysis) == tag_index.FORMAT_PATH_FULL
+
+
+# --- CLIP token 预算 ---
+
+def test_clip_token_count():
+    assert tag_index.clip_token_count([]) == 0
+    assert tag_index.clip_token_count(['smile']) == 1
+    # 两个单词 + 标签之间的逗号
+    assert tag_index.clip_token_count(['long hair', 'smile']) == 4
+    # 长词每 8 个字母多 1 个 token，数字单独计
+    assert tag_index.clip_token_count(['1girl']) == 2
+    assert tag_index.clip_token_count(['heterochromia']) == 2
+
+
+def test_fit_budget_keeps_priority_tags_in_original_order():
+    tags = ['night sky', 'masterpiece', 'some custom extra tag', 'long hair', '1girl', 'smile']
+    kept, dropped = tag_index.fit_budget(tags, budget=10)
+    # 质量标签与主体优先，保留的标签维持原顺序
+    assert kept == ['masterpiece', 'long hair', '1girl', 'smile']
+    assert dropped == ['night sky', 'some custom extra tag']
+    assert tag_index.clip_token_count(kept) <= 10
+
+
+def test_fit_budget_keeps_everything_within_budget():
+    tags = ['masterpiece', '1girl', 'smile']
+    assert tag_index.fit_budget(tags, budget=75) == (tags, [])
+    assert tag_index.fit_budget(tags, budget=0) == ([], tags)
+
+
+# --- 合并与负面提示词 ---
+
+def test_merge_local_accepts_empty_or_list_extra_tags():
+    analysis = tag_index.analyze("少女，双马尾，微笑")
+    base = {'final_natural': 'A girl.', 'final_chinese_natural': "一位少女。"}
+    for extra in ('', None, []):
+        merged = tag_index.merge_local(dict(base, final_extra_tags=extra), analysis, 'sfw')
+        assert merged['final_tag'] == 'masterpiece, best quality, ultra detailed, 1girl, twintails, smile'
+    merged = tag_index.merge_local(base, analysis, 'sfw')
+    assert merged['final_tag'].endswith('smile')
+    merged = tag_index.merge_local(dict(base, final_extra_tags=['night sky', 'smile']), analysis, 'sfw')
+    assert merged['final_tag'].endswith('smile, night sky')
+    assert merged['final_natural'] == 'A girl.'
+    assert (merged['final_negative'], merged['final_chinese_negative']) == tag_index.negative_prompt('sfw')
+
+
+def test_final_tags_drop_tags_excluded_by_profile():
+    assert 'nude' not in tag_index.final_tags(['1girl', 'nude'], 'sfw')
+    assert 'nude' in tag_index.final_tags(['1girl', 'nude'], 'explicit')
+
+
+def test_unknown_negative_profile_raises():
+    with pytest.raises(ValueError):
+        tag_index.negative_prompt('no-such-profile')
+    with pytest.raises(ValueError):
+        tag_index.final_tags(['1girl'], 'no-such-profile')
@@ -0,0 +1,48 @@
+import threading
+import time
+
+import pytest
+
+import jobs
+
+
+@pytest.fixture
+def app_module():
+    import app
+    return app
+
+
+def test_cancelled_variant_run_does_not_wait_for_inflight_calls(app_module, monkeypatch):
+    release = threading.Event()
+    started = []
+
+    def creative(style, user_theme, on_delta=None, variant=0):
+        started.append(variant)
+        if variant:
+            # 其余变体的上游调用迟迟不返回 (例如正在重试退避)
+            release.wait(10)
+        return f"原始描述 {variant}", None
+
+    def on_progress(stage, result):
+        # 第一个变体完成时用户取消了任务
+        if any(variant.get('raw') for variant in result['variants']):
+            raise jobs.JobCancelled("任务已被新的请求取代")
+
+    monkeypatch.setattr(app_module, 'ai_generate_raw_prompt', creative)
+    began = time.perf_counter()
+    try:
+        with pytest.raises(jobs.JobCancelled):
+            app_module.run_variant_pipeline('NORMAL', "主题", 3, on_progress=on_progress)
+        assert time.perf_counter() - began < 2
+        assert sorted(started) == [0, 1, 2]
+    finally:
+        release.set()
+
+
+def test_variant_run_completes_when_not_cancelled(app_module, monkeypatch):
+    monkeypatch.setattr(app_module, 'ai_generate_raw_prompt',
+                        lambda style, theme, on_delta=None, variant=0: (f"完全不同的描述 {'甲乙丙'[variant] * 20}", None))
+    monkeypatch.setattr(app_module, 'deepseek_format_prompt',
+                        lambda raw, style=None: ({key: f"{raw} {key}" for key in app_module.FORMAT_KEYS}, None))
+    result = app_module.run_variant_pipeline('NORMAL', "主题", 3)
+    assert [variant['status'] for variant in result['variants']] == ['done'] * 3
@@ -0,0 +1,102 @@
+import contextvars
+import os
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Tuple
+
+# ==============================================================================
+# Token 用量、上下文缓存命中率与费用估算 (按 风格 × 阶段 汇总)
+# ==============================================================================
+# DeepSeek 的 usage 中包含 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+# 命中上下文缓存的输入 token 价格远低于未命中的部分。
+
+# 单价：美元 / 百万 token，可通过环境变量按当前官方价格调整
+PRICE_INPUT_CACHE_HIT = float(os.environ.get('DEEPSEEK_PRICE_INPUT_CACHE_HIT', '0.028'))
+PRICE_INPUT_CACHE_MISS = float(os.environ.get('DEEPSEEK_PRICE_INPUT_CACHE_MISS', '0.28'))
+PRICE_OUTPUT = float(os.environ.get('DEEPSEEK_PRICE_OUTPUT', '0.42'))
+
+_current_style: contextvars.ContextVar[str] = contextvars.ContextVar('usage_style', default='-')
+_current_collector: contextvars.ContextVar[Optional[Dict[str, Any]]] = contextvars.ContextVar('usage_collector', default=None)
+
+_lock = threading.Lock()
+_totals: Dict[Tuple[str, str], Dict[str, float]] = {}
+
+_FIELDS = ('calls', 'prompt_tokens', 'completion_tokens', 'cache_hit_tokens', 'cache_miss_tokens', 'latency_seconds', 'cost_usd')
+
+
+def estimate_cost(cache_hit_tokens: int, cache_miss_tokens: int, completion_tokens: int) -> float:
+    return (cache_hit_tokens * PRICE_INPUT_CACHE_HIT + cache_miss_tokens * PRICE_INPUT_CACHE_MISS
+            + completion_tokens * PRICE_OUTPUT) / 1_000_000
+
+
+def current_style() -> str:
+    """当前流水线的风格标签 (不在流水线内时为 '-')。"""
+    return _current_style.get()
+
+
+@contextmanager
+def track(style: str) -> Iterator[Dict[str, Any]]:
+    """在一次生成流水线内设置风格标签，并收集该流水线所有上游调用的用量汇总。"""
+    collector = {field: 0 for field in _FIELDS}
+    style_token = _current_style.set(style)
+    collector_token = _current_collector.set(collector)
+    try:
+        yield collector
+    finally:
+        _current_style.reset(style_token)
+        _current_collector.reset(collector_token)
+
+
+def record(stage: str, usage: Optional[Dict[str, Any]], latency: float) -> None:
+    """记录一次上游调用的用量；usage 为上游返回的 usage 字段 (可能缺失)。"""
+    usage = usage or {}
+    prompt_tokens = int(usage.get('prompt_tokens') or 0)
+    completion_tokens = int(usage.get('completion_tokens') or 0)
+    cache_hit = int(usage.get('prompt_cache_hit_tokens') or 0)
+    # 上游未返回缓存明细时，按全部未命中计费
+    cache_miss = int(usage.get('prompt_cache_miss_tokens', prompt_tokens - cache_hit) or 0)
+    delta = {
+        'calls': 1, 'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+        'cache_hit_tokens': cache_hit, 'cache_miss_tokens': cache_miss, 'latency_seconds': latency,
+        'cost_usd': estimate_cost(cache_hit, cache_miss, completion_tokens),
+    }
+    key = (_current_style.get(), stage)
+    with _lock:
+        totals = _totals.setdefault(key, {field: 0 for field in _FIELDS})
+        for field, value in delta.items():
+            totals[field] += value
+    collector = _current_collector.get()
+    if collector is not None:
+        for field, value in delta.items():
+            collector[field] += value
+
+
+def _summarize(totals: Dict[str, float]) -> Dict[str, Any]:
+    summary = {field: round(value, 6) if isinstance(value, float) else value for field, value in totals.items()}
+    cached_input = totals['cache_hit_tokens'] + totals['cache_miss_tokens']
+    summary['cache_hit_ratio'] = round(totals['cache_hit_tokens'] / cached_input, 4) if cached_input else 0.0
+    summary['avg_latency_seconds'] = round(totals['latency_seconds'] / totals['calls'], 3) if totals['calls'] else 0.0
+    return summary
+
+
+def snapshot() -> Dict[str, Any]:
+    """按 风格 × 阶段、按阶段、按风格以及总计四个维度汇总 (当前 worker 进程)。"""
+    with _lock:
+        items = [(key, dict(totals)) for key, totals in _totals.items()]
+
+    def merge(group_key) -> Dict[str, Dict[str, float]]:
+        merged: Dict[str, Dict[str, float]] = {}
+        for key, totals in items:
+            target = merged.setdefault(group_key(key), {field: 0 for field in _FIELDS})
+            for field, value in totals.items():
+                target[field] += value
+        return merged
+
+    return {
+        'prices_usd_per_million': {
+            'input_cache_hit': PRICE_INPUT_CACHE_HIT, 'input_cache_miss': PRICE_INPUT_CACHE_MISS, 'output': PRICE_OUTPUT},
+        'total': _summarize(merge(lambda key: 'total').get('total', {field: 0 for field in _FIELDS})),
+        'by_stage': {stage: _summarize(t) for stage, t in merge(lambda key: key[1]).items()},
+        'by_style': {style: _summarize(t) for style, t in merge(lambda key: key[0]).items()},
+        'by_style_stage': {f"{style}/{stage}": _summarize(t) for (style, stage), t in items},
+    }